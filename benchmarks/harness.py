@@ -0,0 +1,48 @@
+"""
+   Shared setup for the benchmark scripts: a bot stand-in with a real
+   database, scheduler, config and stats tracker, but no discord
+   connection. Run the scripts from the top level directory, e.g.
+
+       python3 -m benchmarks.loop_stall
+"""
+import os
+import tempfile
+
+from src.database.database import Database
+from src.utils.blocking import BlockingPool
+from src.utils.cluster import Cluster
+from src.utils.config import Config
+from src.utils.jobs import Jobs
+from src.utils.stats import StatsTracker
+
+class BenchBot:
+    """
+       Just enough of MyBot for the database layer to run against. The
+       database goes in a fresh temporary file unless a path is given.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix=".db", prefix="bench-")
+            os.close(fd)
+        self.path = path
+        self.cluster = Cluster()
+        self.database = Database(f"sqlite:///{path}")
+        self.database.safe_start()
+        self.engine = self.database.engine
+        self.async_engine = self.database.async_engine
+        self.blocking = BlockingPool()
+        self.jobs = Jobs(self)
+        self.sched = self.jobs.sched
+        self.config = Config(self)
+        self.stats = StatsTracker(self)
+
+    async def run_blocking(self, fn, *args, process=False, **kwargs):
+        return await self.blocking.run(fn, *args, process=process, **kwargs)
+
+    def cleanup(self):
+        self.engine.dispose()
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(self.path + suffix)
+            except FileNotFoundError:
+                pass
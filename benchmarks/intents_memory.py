@@ -0,0 +1,156 @@
+"""
+   Compares how much memory the bot's discord caches take under
+   different intent and cache settings. Each configuration runs in its
+   own process, which builds the bot, feeds it a synthetic set of large
+   guilds as GUILD_CREATE events (with their member lists, if the
+   settings mean discord would send them) and a stream of messages, then
+   reports what it retained.
+
+       python3 -m benchmarks.intents_memory [--guilds N] [--members N] [--messages N]
+
+   The configurations are the old everything-on setup, the default
+   (what the cogs declare), members without chunking, and the default
+   with no message cache.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import subprocess
+import sys
+import tracemalloc
+
+CONFIGURATIONS = {
+    "all": {"DISCORD_INTENTS": "all", "DISCORD_MEMBER_CACHE": "all",
+            "DISCORD_MAX_MESSAGES": "1000", "DISCORD_CHUNK_GUILDS": "true"},
+    "auto": {"DISCORD_INTENTS": "auto", "DISCORD_MEMBER_CACHE": "auto",
+             "DISCORD_MAX_MESSAGES": "1000", "DISCORD_CHUNK_GUILDS": "auto"},
+    "members_unchunked": {"DISCORD_INTENTS": "members",
+                          "DISCORD_MEMBER_CACHE": "auto",
+                          "DISCORD_MAX_MESSAGES": "1000",
+                          "DISCORD_CHUNK_GUILDS": "false"},
+    "lean": {"DISCORD_INTENTS": "auto", "DISCORD_MEMBER_CACHE": "none",
+             "DISCORD_MAX_MESSAGES": "0", "DISCORD_CHUNK_GUILDS": "false"},
+}
+
+# Discord only sends the member list with GUILD_CREATE for guilds smaller
+# than this; bigger ones have to be chunked.
+LARGE_THRESHOLD = 250
+
+async def measure(args):
+    import psutil
+
+    from benchmarks.replay import (DB_PATH, FakeHTTP, ids, member_payload,
+                                   message_payload, user_payload)
+    from src.bot import MyBot
+
+    import discord
+
+    try:
+        bot = MyBot()
+        await bot._async_setup_hook()
+        bot_user = user_payload(next(ids), "memory-bot", bot=True)
+        bot.http = FakeHTTP(asyncio.get_running_loop(), bot_user)
+        bot._connection.http = bot.http
+        bot._connection.user = discord.ClientUser(state=bot._connection,
+                                                  data=bot_user)
+        options = bot.gateway_options
+        # Without the members intent discord only tells us about
+        # ourselves; with it we get everyone, either in GUILD_CREATE or
+        # by chunking.
+        send_members = (options["intents"].members
+                        and (options["chunk_guilds_at_startup"]
+                             or args.members <= LARGE_THRESHOLD))
+
+        process = psutil.Process()
+        gc.collect()
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        rss = process.memory_info().rss
+
+        channels = []
+        for _ in range(args.guilds):
+            guild_id = next(ids)
+            channel_id = next(ids)
+            users = [user_payload(next(ids), f"user{n}")
+                     for n in range(args.members)]
+            members = [member_payload(bot_user, [])]
+            if send_members:
+                members.extend(member_payload(u, []) for u in users)
+            bot._connection.parse_guild_create({
+                "id": str(guild_id), "name": f"guild {guild_id}",
+                "owner_id": users[0]["id"], "member_count": args.members + 1,
+                "large": args.members > LARGE_THRESHOLD, "features": [],
+                "emojis": [], "stickers": [], "unavailable": False,
+                "roles": [{"id": str(guild_id), "name": "@everyone",
+                           "permissions": "0", "position": 0, "color": 0,
+                           "hoist": False, "managed": False,
+                           "mentionable": False}],
+                "channels": [{"id": str(channel_id), "type": 0,
+                              "name": "general", "position": 0,
+                              "permission_overwrites": []}],
+                "members": members})
+            channels.append((guild_id, channel_id, users[:50]))
+
+        for n in range(args.messages):
+            guild_id, channel_id, users = channels[n % len(channels)]
+            bot._connection.parse_message_create(message_payload(
+                next(ids), channel_id, users[n % len(users)],
+                f"message {n} " + "x" * 64, guild_id))
+            if n % 1000 == 0:
+                await asyncio.sleep(0)
+        await asyncio.sleep(0.1)
+
+        del channels
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0] - base
+        report = {"retained_bytes": retained,
+                  "rss_delta_bytes": process.memory_info().rss - rss,
+                  "guilds": len(bot.guilds),
+                  "cached_members": sum(len(g.members) for g in bot.guilds),
+                  "cached_users": len(bot.users),
+                  "cached_messages": len(bot.cached_messages)}
+        tracemalloc.stop()
+        await bot.close()
+        return report
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(DB_PATH + suffix)
+            except FileNotFoundError:
+                pass
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--members", type=int, default=2_000,
+                        help="members per guild")
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument("--child", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(measure(args))))
+        return
+
+    results = {}
+    for name, settings in CONFIGURATIONS.items():
+        env = dict(os.environ, **settings)
+        out = subprocess.run([sys.executable, "-m", "benchmarks.intents_memory",
+                              "--child", "--guilds", str(args.guilds),
+                              "--members", str(args.members),
+                              "--messages", str(args.messages)],
+                             env=env, capture_output=True, text=True)
+        if out.returncode != 0:
+            results[name] = {"settings": settings, "error": out.stderr[-2000:]}
+            continue
+        report = json.loads(out.stdout.strip().splitlines()[-1])
+        results[name] = {"settings": settings, **report}
+    print(json.dumps({"guilds": args.guilds, "members": args.members,
+                      "messages": args.messages, "results": results},
+                     indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+   Measures what a logger.debug call costs the caller, with the sinks
+   attached directly to the logger (the old setup) and behind the
+   queue. Logs go to a temporary directory, with stdout sent to
+   /dev/null so the terminal isn't the bottleneck.
+
+       python3 -m benchmarks.logging_cost [--calls N]
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import sys
+import tempfile
+import time
+
+from logging.handlers import QueueListener
+
+import src.logging as botlog
+
+def measure(logger, calls):
+    timings = []
+    for i in range(calls):
+        start = time.perf_counter_ns()
+        logger.debug(f"benchmark message {i}")
+        timings.append(time.perf_counter_ns() - start)
+    timings.sort()
+    return {"mean_us": sum(timings) / len(timings) / 1000,
+            "p50_us": timings[len(timings) // 2] / 1000,
+            "p99_us": timings[int(len(timings) * 0.99)] / 1000,
+            "max_us": timings[-1] / 1000}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=50000)
+    parser.add_argument("--queue-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory, \
+         open(os.devnull, "w") as devnull:
+        real_stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            handlers = botlog.make_handlers(directory)
+
+            direct = logging.getLogger("bench.direct")
+            direct.propagate = False
+            direct.setLevel(logging.DEBUG)
+            for handler in handlers:
+                direct.addHandler(handler)
+            results["direct"] = measure(direct, args.calls)
+
+            for policy in ("drop", "block"):
+                log_queue = queue.Queue(maxsize=args.queue_size)
+                queue_handler = botlog.BoundedQueueHandler(log_queue, policy)
+                listener = QueueListener(log_queue, *handlers,
+                                         respect_handler_level=True)
+                queued = logging.getLogger(f"bench.queued.{policy}")
+                queued.propagate = False
+                queued.setLevel(logging.DEBUG)
+                queued.addHandler(queue_handler)
+                listener.start()
+                results[f"queued_{policy}"] = measure(queued, args.calls)
+                results[f"queued_{policy}"]["dropped"] = queue_handler.dropped
+                listener.stop()
+
+            for handler in handlers:
+                handler.close()
+        finally:
+            sys.stdout = real_stdout
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
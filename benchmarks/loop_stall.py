@@ -0,0 +1,73 @@
+"""
+   Measures how long the event loop stalls while a pile of coroutines hit
+   the config table, first through the sync Config.get and then through
+   Config.get_async. A ticker coroutine wakes every millisecond and
+   records how late it was; with the sync API the ticker can't run while
+   SQLite is working, with the async one it can.
+
+       python3 -m benchmarks.loop_stall [--workers N] [--calls N]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.harness import BenchBot
+
+async def ticker(stalls, stop):
+    while not stop.is_set():
+        before = time.perf_counter()
+        await asyncio.sleep(0.001)
+        stalls.append(time.perf_counter() - before - 0.001)
+
+async def run(bot, use_async, workers, calls):
+    stalls = []
+    stop = asyncio.Event()
+    tick = asyncio.create_task(ticker(stalls, stop))
+
+    async def worker(n):
+        for i in range(calls):
+            guild = n * calls + i
+            if use_async:
+                await bot.config.get_async(guild, "prefix", "$")
+            else:
+                bot.config.get(guild, "prefix", "$")
+                await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(n) for n in range(workers)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await tick
+
+    stalls.sort()
+    def pct(p):
+        if not stalls:
+            return 0.0
+        return stalls[min(len(stalls) - 1, int(len(stalls) * p))] * 1000
+    return {"mode": "async" if use_async else "sync",
+            "elapsed_s": elapsed,
+            "ticks": len(stalls),
+            "stall_p50_ms": pct(0.50),
+            "stall_p99_ms": pct(0.99),
+            "stall_max_ms": pct(1.0)}
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=20)
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    results = []
+    for use_async in (False, True):
+        bot = BenchBot()
+        try:
+            results.append(await run(bot, use_async, args.workers, args.calls))
+        finally:
+            if bot.async_engine is not None:
+                await bot.async_engine.dispose()
+            bot.cleanup()
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,167 @@
+"""
+   Checks the web cog's OAuth cache against a local stub of discord's
+   OAuth endpoints. Logs in through the real /login/ and /callback/
+   routes, renders a page that looks up the user and their guilds a
+   number of times, and counts the lookups that got past the cache
+   (upstream_calls) and the requests that reached the stub (http_calls).
+   Within the TTL there should be one upstream call per lookup; after
+   the TTL runs out, after logging out, and after logging in again (as
+   someone else) there should be exactly one more each. quart_discord
+   keeps its own copy of the user, so a lookup after the TTL may not
+   need to go over HTTP, but one after a new login always does.
+
+       python3 -m benchmarks.oauth_cache [--requests N] [--ttl SECONDS]
+"""
+import argparse
+import asyncio
+import json
+import os
+
+from urllib.parse import parse_qs, urlparse
+
+from aiohttp import web
+
+from benchmarks.harness import BenchBot
+
+class StubDiscord:
+    """
+       Just enough of discord's OAuth API to log in and look the user up.
+       Each login hands out a new token for a new user, so a stale cache
+       entry shows up as the wrong user.
+    """
+    def __init__(self):
+        self.logins = 0
+        self.calls = {"token": 0, "user": 0, "guilds": 0}
+        app = web.Application()
+        app.router.add_post("/api/oauth2/token", self.token)
+        app.router.add_get("/api/users/@me", self.user)
+        app.router.add_get("/api/users/@me/guilds", self.guilds)
+        self.runner = web.AppRunner(app)
+
+    async def start(self):
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/api"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def user_id(self, request):
+        return int(request.headers["Authorization"].split("-")[-1])
+
+    async def token(self, request):
+        self.calls["token"] = self.calls["token"] + 1
+        self.logins = self.logins + 1
+        return web.json_response({"access_token": f"token-{self.logins}",
+                                  "token_type": "Bearer",
+                                  "expires_in": 3600,
+                                  "refresh_token": f"refresh-{self.logins}",
+                                  "scope": "identify guilds"})
+
+    async def user(self, request):
+        self.calls["user"] = self.calls["user"] + 1
+        user_id = self.user_id(request)
+        return web.json_response({"id": str(user_id),
+                                  "username": f"user{user_id}",
+                                  "discriminator": "0001"})
+
+    async def guilds(self, request):
+        self.calls["guilds"] = self.calls["guilds"] + 1
+        user_id = self.user_id(request)
+        return web.json_response([{"id": str(1000 + user_id),
+                                   "name": f"guild{user_id}",
+                                   "icon": None, "owner": False,
+                                   "permissions": "0"}])
+
+def point_at(base):
+    import quart_discord.configs as configs
+    configs.DISCORD_API_BASE_URL = base
+    configs.DISCORD_AUTHORIZATION_BASE_URL = base + "/oauth2/authorize"
+    configs.DISCORD_TOKEN_URL = base + "/oauth2/token"
+
+def build_web(bot):
+    from src.cogs.web import Web
+
+    cog = Web(bot)
+    cog.build_app()
+
+    # A page that does what the dashboard's pages do several times
+    # over: look up who's logged in and which guilds they're in.
+    @cog.app.route("/whoami")
+    async def whoami():
+        user = None
+        for i in range(3):
+            user = await cog.oauth.fetch_user()
+            await cog.oauth.fetch_guilds()
+        return str(user.id)
+    return cog
+
+async def login(client):
+    response = await client.get("/login/")
+    state = parse_qs(urlparse(response.headers["Location"]).query)["state"][0]
+    await client.get(f"/callback/?code=stub&state={state}")
+
+async def pages(client, count):
+    users = set()
+    for i in range(count):
+        response = await client.get("/whoami")
+        users.add(int(await response.get_data(as_text=True)))
+    return sorted(users)
+
+async def run(args):
+    bot = BenchBot()
+    bot.caches = {}
+    stub = StubDiscord()
+    point_at(await stub.start())
+    try:
+        cog = build_web(bot)
+        client = cog.app.test_client()
+        results = []
+
+        async def step(name):
+            http = dict(stub.calls)
+            upstream = cog.oauth.upstream_calls
+            users = await pages(client, args.requests)
+            results.append({"step": name, "users_seen": users,
+                            "upstream_calls": cog.oauth.upstream_calls - upstream,
+                            "http_calls": {k: stub.calls[k] - http[k]
+                                           for k in ("user", "guilds")}})
+
+        await login(client)
+        await step("first pages")
+        await step("within ttl")
+
+        await asyncio.sleep(args.ttl + 0.1)
+        await step("after ttl")
+
+        await client.get("/logout/")
+        await login(client)
+        await step("after logout and login")
+
+        # Logging in again without logging out first, which is what
+        # happens when someone else picks up the browser.
+        await login(client)
+        await step("after re-login")
+
+        return {"ttl_s": args.ttl, "requests": args.requests,
+                "logins": stub.logins, "steps": results,
+                "cache": cog.oauth.stats()}
+    finally:
+        await stub.stop()
+        bot.cleanup()
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--ttl", type=float, default=1.0)
+    args = parser.parse_args()
+    # The cache reads its TTL when the app is built.
+    os.environ["DISCORD_OAUTH_CACHE_TTL"] = str(args.ttl)
+    os.environ.setdefault("APPLICATION_ID", "1")
+    os.environ.setdefault("CLIENT_SECRET", "stub")
+    print(json.dumps(await run(args), indent=2))
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,270 @@
+"""
+   Per-call overhead of the config and stats queries. Each hot query is
+   timed three ways against the same seeded database:
+
+   - session: the way Config and StatsTracker used to run it, building
+     the select (or upsert) from the ORM model and opening a Session on
+     every call.
+   - prepared: the way they do now, via Config.get/set and
+     StatsTracker.get/fetch/flush, with statements built once and run on
+     a plain connection.
+   - driver: the same SQL straight through the sqlite3 cursor, which is
+     the floor; anything above it is SQLAlchemy and our own code.
+
+       python3 -m benchmarks.query_overhead [--rows N] [--ops N] [--output FILE]
+
+   The results are JSON. Each query gets p50 and mean microseconds for
+   each method, plus how much of the prepared path's p50 sits above the
+   driver's.
+"""
+import argparse
+import json
+import platform
+import time
+
+from datetime import datetime
+from sqlalchemy import func, select, union_all
+from sqlalchemy.orm import Session
+
+from benchmarks.harness import BenchBot
+from benchmarks.suite import SETTINGS, Workload, seed
+from src.utils.config import ConfigEntry
+from src.utils.metrics import percentile
+from src.utils.stats import ROLLUPS, StatEntry
+
+def timed(ops, fn):
+    samples = []
+    for _ in range(ops):
+        before = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - before)
+    samples.sort()
+    return {"p50_us": percentile(samples, 0.50) * 1_000_000,
+            "mean_us": sum(samples) / len(samples) * 1_000_000}
+
+def driver_call(bot, stmt, params, commit=False):
+    """
+       A function that runs stmt with params through the DBAPI cursor,
+       compiled once up front.
+    """
+    compiled = stmt.compile(bot.engine)
+    sql = str(compiled)
+    values = compiled.construct_params(params)
+    args = [values[name] for name in compiled.positiontup]
+    conn = bot.engine.raw_connection()
+
+    def call():
+        cursor = conn.cursor()
+        cursor.execute(sql, args)
+        cursor.fetchall()
+        if commit:
+            conn.commit()
+    return call, conn
+
+# The old ways of building the queries, for comparison.
+
+def session_window(stats, guild_id, stat, substat, days):
+    today = stats.get_current_day()
+    legs = [select(func.sum(model.count).label("count")).where(
+                model.guild_id == guild_id,
+                model.statname == stat,
+                model.substat == substat,
+                column.between(first, last))
+            for model, column, first, last
+            in stats.plan_window(today-days, today, stat)]
+    if len(legs) == 1:
+        u = legs[0].subquery()
+    else:
+        u = union_all(*legs).subquery()
+    return select(func.coalesce(func.sum(u.c.count), 0))
+
+def session_leaderboard(stats, guild_id, stat, count, days):
+    today = stats.get_current_day()
+    plan = stats.plan_window(today-days, today, stat)
+    legs = [select(model.substat, model.count).where(
+                model.guild_id == guild_id,
+                model.statname == stat,
+                column.between(first, last))
+            for model, column, first, last in plan]
+    if len(legs) == 1:
+        model = plan[0][0]
+        substat = model.substat
+        total = func.sum(model.count)
+        s = legs[0].with_only_columns(substat, total)
+    else:
+        u = union_all(*legs).subquery()
+        substat = u.c.substat
+        total = func.sum(u.c.count)
+        s = select(substat, total)
+    return s.group_by(substat).order_by(total.desc()).limit(count)
+
+def session_flush(bot, pending):
+    db = bot.database
+    totals = {}
+    for (guild_id, stat, substat, day), count in pending.items():
+        key = (guild_id, stat, substat)
+        totals[key] = totals.get(key, 0) + count
+    now = datetime.now()
+    with Session(bot.engine) as session:
+        session.execute(db.upsert(StatEntry.__table__,
+                                  ["guild_id", "statname", "substat"],
+                                  increment=["count"],
+                                  update=["last_update"]),
+                        [{"guild_id": guild_id, "statname": stat,
+                          "substat": substat, "count": count,
+                          "last_update": now}
+                         for (guild_id, stat, substat), count in totals.items()])
+        for model, column, days in ROLLUPS:
+            buckets = {}
+            for (guild_id, stat, substat, day), count in pending.items():
+                key = (guild_id, stat, substat, day // days)
+                buckets[key] = buckets.get(key, 0) + count
+            session.execute(db.upsert(model.__table__,
+                                      ["guild_id", "statname", "substat",
+                                       column.key],
+                                      increment=["count"]),
+                            [{"guild_id": guild_id, "statname": stat,
+                              "substat": substat, column.key: bucket,
+                              "count": count}
+                             for (guild_id, stat, substat, bucket), count
+                             in buckets.items()])
+        session.commit()
+
+def scenarios(bot, work, ops, batch):
+    config = bot.config
+    stats = bot.stats
+    db = bot.database
+    results = {}
+    connections = []
+
+    def run(name, session, prepared, driver=None):
+        entry = {"session": timed(ops, session),
+                 "prepared": timed(ops, prepared)}
+        if driver is not None:
+            call, conn = driver
+            connections.append(conn)
+            entry["driver"] = timed(ops, call)
+            entry["prepared_overhead_us"] = (entry["prepared"]["p50_us"]
+                                             - entry["driver"]["p50_us"])
+        entry["speedup"] = (entry["session"]["mean_us"]
+                            / entry["prepared"]["mean_us"])
+        results[name] = entry
+
+    # The same key every time, so each method does the same work; the
+    # cache entry is dropped first so the read goes to the database.
+    guild_id = work.guild()
+    setting = SETTINGS[0]
+    def session_get():
+        config.cache.invalidate((guild_id, setting))
+        with Session(bot.engine) as session:
+            for r in session.execute(select(ConfigEntry.value).where(
+                    ConfigEntry.guild_id == guild_id,
+                    ConfigEntry.setting == setting)):
+                return r[0]
+    def prepared_get():
+        config.cache.invalidate((guild_id, setting))
+        return config.get(guild_id, setting)
+    run("config_get", session_get, prepared_get,
+        driver_call(bot, config.get_statement,
+                    {"guild_id": guild_id, "setting": setting}))
+
+    def session_set():
+        with Session(bot.engine) as session:
+            session.execute(db.upsert(ConfigEntry.__table__,
+                                      ["guild_id", "setting"],
+                                      update=["value"]),
+                            {"guild_id": guild_id, "setting": setting,
+                             "value": "1"})
+            session.commit()
+    def prepared_set():
+        config.set(guild_id, setting, "1")
+    run("config_set", session_set, prepared_set,
+        driver_call(bot, config.set_statement,
+                    {"guild_id": guild_id, "setting": setting, "value": "1"},
+                    commit=True))
+
+    stat = work.stat()
+    substat = work.substat()
+    def session_total():
+        stats.flush()
+        with Session(bot.engine) as session:
+            return session.execute(select(StatEntry.count).where(
+                StatEntry.guild_id == guild_id,
+                StatEntry.statname == stat,
+                StatEntry.substat == substat)).scalar()
+    def prepared_total():
+        return stats.get(guild_id, stat, substat)
+    run("stats_get_all", session_total, prepared_total,
+        driver_call(bot, *stats.get_statement(guild_id, stat, substat, None)))
+
+    def session_window_get():
+        stats.flush()
+        with Session(bot.engine) as session:
+            return session.execute(session_window(stats, guild_id, stat,
+                                                  substat, 30)).scalar()
+    def prepared_window_get():
+        return stats.get(guild_id, stat, substat, 30)
+    run("stats_get_30", session_window_get, prepared_window_get,
+        driver_call(bot, *stats.get_statement(guild_id, stat, substat, 30)))
+
+    def session_fetch():
+        stats.flush()
+        with Session(bot.engine) as session:
+            return [[r[0], r[1]] for r in session.execute(
+                session_leaderboard(stats, guild_id, stat, 10, 7))]
+    def prepared_fetch():
+        return stats.fetch(guild_id, stat, 10, 7)
+    run("stats_fetch_7d", session_fetch, prepared_fetch,
+        driver_call(bot, *stats.fetch_statement(guild_id, stat, 10, 7,
+                                                True, None)))
+
+    # A flush of a small batch, the size a quiet interval leaves behind.
+    day = stats.get_current_day()
+    pending = {(work.guild(), work.stat(), work.substat(), day): 1
+               for _ in range(batch)}
+    def session_batch():
+        session_flush(bot, pending)
+    def prepared_batch():
+        stats.pending = dict(pending)
+        stats.flush()
+    run(f"stats_flush_{batch}", session_batch, prepared_batch)
+
+    for conn in connections:
+        conn.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, default=1_000)
+    parser.add_argument("--substats", type=int, default=100)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--rows", type=int, default=100_000,
+                        help="rows of per-day history to seed")
+    parser.add_argument("--ops", type=int, default=2_000,
+                        help="calls per query and method")
+    parser.add_argument("--batch", type=int, default=20,
+                        help="buffered counters per flush")
+    parser.add_argument("--output", help="write the JSON here too")
+    args = parser.parse_args()
+
+    work = Workload(args.guilds, args.substats)
+    bot = BenchBot()
+    try:
+        seed(bot, work, args.rows, args.days)
+        results = scenarios(bot, work, args.ops, args.batch)
+    finally:
+        bot.cleanup()
+
+    text = json.dumps({"python": platform.python_version(),
+                       "params": {"guilds": args.guilds,
+                                  "substats": args.substats,
+                                  "days": args.days, "rows": args.rows,
+                                  "ops": args.ops, "batch": args.batch},
+                       "results": results}, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+if __name__ == '__main__':
+    main()
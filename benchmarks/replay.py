@@ -0,0 +1,316 @@
+"""
+   End-to-end load test for the whole bot, with no discord connection.
+   The bot from main.py (with its error handler and all the cogs) is
+   started against a temporary database and a fake HTTP layer that
+   records whatever the bot sends instead of sending it. A set of
+   synthetic guilds is fed in as GUILD_CREATE events, then MESSAGE_CREATE
+   events are injected at a fixed rate, and each reply is matched up with
+   the message that caused it.
+
+       python3 -m benchmarks.replay [--rate N] [--messages N] [--commands ...]
+       python3 -m benchmarks.replay --events recorded.jsonl
+
+   --events takes gateway frames ({"t": "MESSAGE_CREATE", "d": {...}}) or
+   bare message payloads, one per line; their content is replayed into
+   the synthetic guilds in order. Otherwise messages are drawn from
+   --commands, with --chatter of them being plain non-command messages.
+
+   The JSON report has commands/sec, reply latency percentiles, the
+   replies that were errors, CPU time, RSS, event loop lag and database
+   statement counts.
+"""
+import argparse
+import asyncio
+import contextvars
+import datetime
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+# The bot reads these when it's constructed, so they have to be in place
+# before main is imported.
+DB_FD, DB_PATH = tempfile.mkstemp(suffix=".db", prefix="replay-")
+os.close(DB_FD)
+os.environ["DATABASE_URL"] = f"sqlite:///{DB_PATH}"
+os.environ.setdefault("DISCORD_TOKEN", "replay")
+
+import discord
+import psutil
+
+from discord.http import HTTPClient
+
+from src.utils.metrics import percentile, registry
+
+# The id of the injected message whose handling is running, so the fake
+# HTTP layer can tell which message a reply belongs to. Event handler
+# tasks are created while it's set, so they inherit it.
+replying_to = contextvars.ContextVar("replying_to", default=None)
+
+ids = itertools.count(1_000_000)
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+def user_payload(user_id, name, bot=False):
+    return {"id": str(user_id), "username": name, "discriminator": "0",
+            "global_name": None, "avatar": None, "bot": bot}
+
+def member_payload(user, roles):
+    return {"user": user, "roles": [str(r) for r in roles],
+            "joined_at": now(), "deaf": False, "mute": False, "flags": 0}
+
+def message_payload(message_id, channel_id, author, content, guild_id=None,
+                    roles=()):
+    data = {"id": str(message_id), "channel_id": str(channel_id),
+            "author": author, "content": content, "timestamp": now(),
+            "edited_timestamp": None, "tts": False,
+            "mention_everyone": False, "mentions": [], "mention_roles": [],
+            "attachments": [], "embeds": [], "pinned": False, "type": 0}
+    if guild_id is not None:
+        data["guild_id"] = str(guild_id)
+        data["member"] = {"roles": [str(r) for r in roles],
+                          "joined_at": now(), "deaf": False, "mute": False,
+                          "flags": 0}
+    return data
+
+class FakeHTTP(HTTPClient):
+    """
+       Stands in for discord's REST API. Message sends are recorded, along
+       with which injected message (if any) they were a reply to, and get
+       back a plausible message; everything else gets an empty answer.
+    """
+    def __init__(self, loop, bot_user):
+        super().__init__(loop)
+        self.bot_user = bot_user
+        self.requests = 0
+        # Injected message id -> (time of first reply, content)
+        self.replies = {}
+        self.sent = 0
+
+    async def request(self, route, *, files=None, form=None, **kwargs):
+        self.requests = self.requests + 1
+        if route.method == "POST" and route.path == "/channels/{channel_id}/messages":
+            self.sent = self.sent + 1
+            payload = kwargs.get("json") or {}
+            content = payload.get("content") or ""
+            source = replying_to.get()
+            if source is not None and source not in self.replies:
+                self.replies[source] = (time.perf_counter(), content)
+            return message_payload(next(ids), route.channel_id, self.bot_user,
+                                   content)
+        if route.method == "GET":
+            return []
+        return {}
+
+    async def static_login(self, token):
+        return self.bot_user
+
+    async def close(self):
+        pass
+
+class Guilds:
+    """
+       Builds the synthetic guilds: each has one text channel, a few
+       members, an @everyone role that can talk, and a moderator role
+       with manage_guild that the message authors have.
+    """
+    def __init__(self, count, members, bot_user):
+        self.bot_user = bot_user
+        self.guilds = []
+        everyone = discord.Permissions(view_channel=True, send_messages=True,
+                                       read_message_history=True,
+                                       embed_links=True, attach_files=True)
+        moderator = discord.Permissions(manage_guild=True)
+        for _ in range(count):
+            guild_id = next(ids)
+            channel_id = next(ids)
+            mod_role = next(ids)
+            users = [user_payload(next(ids), f"user{n}") for n in range(members)]
+            data = {"id": str(guild_id), "name": f"guild {guild_id}",
+                    "owner_id": users[0]["id"], "member_count": members + 1,
+                    "large": False, "features": [], "emojis": [],
+                    "stickers": [], "unavailable": False,
+                    "roles": [{"id": str(guild_id), "name": "@everyone",
+                               "permissions": str(everyone.value),
+                               "position": 0, "color": 0, "hoist": False,
+                               "managed": False, "mentionable": False},
+                              {"id": str(mod_role), "name": "mod",
+                               "permissions": str(moderator.value),
+                               "position": 1, "color": 0, "hoist": False,
+                               "managed": False, "mentionable": False}],
+                    "channels": [{"id": str(channel_id), "type": 0,
+                                  "name": "general", "position": 0,
+                                  "permission_overwrites": []}],
+                    "members": ([member_payload(bot_user, [])]
+                                + [member_payload(u, [mod_role]) for u in users])}
+            self.guilds.append((data, guild_id, channel_id, mod_role, users))
+
+    def message(self, rng, content):
+        data, guild_id, channel_id, mod_role, users = rng.choice(self.guilds)
+        return message_payload(next(ids), channel_id, rng.choice(users),
+                               content, guild_id, [mod_role])
+
+def load_events(path):
+    """
+       The message contents from a file of recorded gateway events.
+    """
+    contents = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            event = json.loads(line)
+            if "t" in event:
+                if event["t"] != "MESSAGE_CREATE":
+                    continue
+                event = event["d"]
+            contents.append(event.get("content", ""))
+    return contents
+
+def db_statements():
+    metric = registry.metrics.get("bot_db_queries_total")
+    if metric is None:
+        return 0
+    return sum(metric.values.values())
+
+async def start(bot, guilds):
+    """
+       Bring the bot up as if it had connected: log in with the fake HTTP
+       layer, feed it the guilds, fire on_ready and wait for the cogs.
+    """
+    await bot._async_setup_hook()
+    bot.http = FakeHTTP(asyncio.get_running_loop(), guilds.bot_user)
+    bot._connection.http = bot.http
+    bot._connection.user = discord.ClientUser(state=bot._connection,
+                                              data=guilds.bot_user)
+    await bot.setup_hook()
+    for data, *_ in guilds.guilds:
+        bot._connection.parse_guild_create(data)
+    bot.dispatch("ready")
+    while bot.startup_report is None:
+        await asyncio.sleep(0.01)
+
+async def inject(bot, guilds, contents, rate, rng):
+    """
+       Feed the messages in at rate per second (or as fast as the loop
+       will take them if rate is 0). Returns each message's id and
+       injection time.
+    """
+    injected = {}
+    begin = time.perf_counter()
+    for n, content in enumerate(contents):
+        if rate:
+            delay = begin + n / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0)
+        data = guilds.message(rng, content)
+        message_id = int(data["id"])
+        token = replying_to.set(message_id)
+        injected[message_id] = time.perf_counter()
+        bot._connection.parse_message_create(data)
+        replying_to.reset(token)
+    return injected
+
+async def run(args):
+    import main
+    bot = main.mybot
+    prefix = bot.command_prefix if isinstance(bot.command_prefix, str) else bot.command_prefix[0]
+
+    rng = random.Random(42)
+    bot_user = user_payload(next(ids), "replay-bot", bot=True)
+    guilds = Guilds(args.guilds, args.members, bot_user)
+
+    if args.events:
+        contents = load_events(args.events)
+    else:
+        commands = [c if c.startswith(prefix) else prefix + c
+                    for c in args.commands.split(",")]
+        contents = [f"just chatting {n}" if rng.random() < args.chatter
+                    else rng.choice(commands)
+                    for n in range(args.messages)]
+
+    process = psutil.Process()
+    await start(bot, guilds)
+
+    cpu_before = sum(process.cpu_times()[:2])
+    rss_before = process.memory_info().rss
+    statements_before = db_statements()
+    begin = time.perf_counter()
+    injected = await inject(bot, guilds, contents, args.rate, rng)
+    inject_s = time.perf_counter() - begin
+
+    # Wait for the replies to stop coming in.
+    expected = sum(1 for c in contents if c.startswith(prefix))
+    deadline = time.perf_counter() + args.drain
+    while len(bot.http.replies) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - begin
+
+    latencies = sorted(sent - injected[m]
+                       for m, (sent, content) in bot.http.replies.items()
+                       if m in injected)
+    errors = [content for sent, content in bot.http.replies.values()
+              if content.startswith("Error handling") or content == "Unknown command"]
+    lag = bot.watchdog.percentiles()
+    report = {"guilds": args.guilds, "messages": len(contents),
+              "commands": expected, "replies": len(bot.http.replies),
+              "errors": len(errors), "error_samples": errors[:5],
+              "rate": args.rate, "inject_s": inject_s, "elapsed_s": elapsed,
+              "commands_per_s": len(latencies) / elapsed if elapsed else 0.0,
+              "latency_p50_ms": percentile(latencies, 0.50) * 1000,
+              "latency_p95_ms": percentile(latencies, 0.95) * 1000,
+              "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+              "latency_max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+              "cpu_s": sum(process.cpu_times()[:2]) - cpu_before,
+              "rss_bytes": process.memory_info().rss,
+              "rss_delta_bytes": process.memory_info().rss - rss_before,
+              "loop_lag_p99_ms": lag["p99"] * 1000,
+              "loop_lag_max_ms": lag["max"] * 1000,
+              "db_statements": db_statements() - statements_before,
+              "http_requests": bot.http.requests}
+    await bot.close()
+    return report
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--members", type=int, default=20,
+                        help="members per guild")
+    parser.add_argument("--messages", type=int, default=5_000)
+    parser.add_argument("--rate", type=float, default=500,
+                        help="messages per second, 0 for flat out")
+    parser.add_argument("--commands", default="ping",
+                        help="comma separated commands to send")
+    parser.add_argument("--chatter", type=float, default=0.0,
+                        help="fraction of messages that aren't commands")
+    parser.add_argument("--events", help="JSONL of recorded messages to replay")
+    parser.add_argument("--drain", type=float, default=30,
+                        help="seconds to wait for outstanding replies")
+    parser.add_argument("--output", help="write the JSON here too")
+    args = parser.parse_args()
+
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(DB_PATH + suffix)
+            except FileNotFoundError:
+                pass
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if report["replies"] < report["commands"]:
+        sys.exit(f"{report['commands'] - report['replies']} commands got no reply")
+
+if __name__ == '__main__':
+    main()
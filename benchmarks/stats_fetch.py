@@ -0,0 +1,133 @@
+"""
+   Leaderboard benchmark for StatsTracker.fetch. Builds a synthetic
+   stats_granular table (10M rows by default) and its weekly and monthly
+   rollups, checks with EXPLAIN QUERY PLAN that fetch is served from the
+   leaderboard indexes, both for a short window that only reads days and
+   a year-long one that sums months, weeks and days, and times fetch over
+   a few windows.
+
+       python3 -m benchmarks.stats_fetch [--rows N] [--repeat N]
+
+   Exits non-zero if the planner isn't using the indexes.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+from benchmarks.harness import BenchBot
+from src.utils.stats import ROLLUPS
+
+# The windows whose query plans get checked: one that's all days, and one
+# long enough to use every rollup level.
+EXPLAIN_WINDOWS = (7, 365)
+
+def populate(bot, rows, guilds, stats, substats):
+    """
+       Fill stats_granular with rows spread over guilds, stats and
+       substats, going back as many days as it takes, then build the
+       weekly and monthly rollups from it.
+    """
+    today = bot.stats.get_current_day()
+    per_day = guilds * len(stats) * substats
+    days = max(1, rows // per_day)
+    rng = random.Random(42)
+
+    def generate():
+        produced = 0
+        for day in range(today - days + 1, today + 1):
+            for guild_id in range(guilds):
+                for stat in stats:
+                    for substat in range(substats):
+                        if produced >= rows:
+                            return
+                        produced = produced + 1
+                        yield (guild_id, stat, f"sub{substat}", day,
+                               rng.randint(1, 50))
+
+    conn = bot.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        batch = []
+        for row in generate():
+            batch.append(row)
+            if len(batch) >= 100000:
+                cursor.executemany("insert into stats_granular values (?, ?, ?, ?, ?)", batch)
+                batch = []
+        if batch:
+            cursor.executemany("insert into stats_granular values (?, ?, ?, ?, ?)", batch)
+        conn.commit()
+    finally:
+        conn.close()
+
+    # The rollup tables were backfilled (from nothing) when the tracker
+    # started, so fill them in again now there's something to fill them
+    # from.
+    for model, column, bucket_days in ROLLUPS[1:]:
+        bot.stats.backfill(bot, model, column, bucket_days)
+    with bot.engine.connect() as conn:
+        conn.exec_driver_sql("analyze")
+    return days
+
+def explain(bot, stmt):
+    sql = str(stmt.compile(bot.engine, compile_kwargs={"literal_binds": True}))
+    with bot.engine.connect() as conn:
+        return [r[-1] for r in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql)]
+
+def check_plan(bot, days):
+    """
+       EXPLAIN the fetch query for a window of days. Returns the plan and
+       whether every table it reads is read through its leaderboard
+       index.
+    """
+    stmt, params = bot.stats.fetch_statement(1, "emoji", 10, days, True,
+                                             None)
+    plan = explain(bot, stmt.params(params))
+    today = bot.stats.get_current_day()
+    tables = list(dict.fromkeys(
+        model.__tablename__ for model, column, first, last
+        in bot.stats.plan_window(today - days, today, "emoji")))
+    uses_index = all(any(f"ix_{table}_leaderboard" in line for line in plan)
+                     for table in tables)
+    return {"tables": tables, "plan": plan, "uses_index": uses_index}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--substats", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    stats = ["emoji", "messages"]
+    bot = BenchBot()
+    try:
+        start = time.perf_counter()
+        days = populate(bot, args.rows, args.guilds, stats, args.substats)
+        load_time = time.perf_counter() - start
+
+        plans = {f"{window}d": check_plan(bot, window)
+                 for window in EXPLAIN_WINDOWS}
+        uses_index = all(p["uses_index"] for p in plans.values())
+
+        timings = {}
+        for window in (1, 7, 30, 365):
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                bot.stats.fetch(random.randrange(args.guilds), "emoji",
+                                days=window)
+            timings[f"fetch_{window}d_ms"] = ((time.perf_counter() - start)
+                                              / args.repeat * 1000)
+
+        print(json.dumps({"rows": args.rows, "days": days,
+                          "load_s": load_time, "plans": plans,
+                          "uses_index": uses_index, **timings}, indent=2))
+    finally:
+        bot.cleanup()
+
+    if not uses_index:
+        sys.exit("fetch is not using the leaderboard indexes")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""
+   Benchmark suite for the stats and config layer. Seeds a SQLite file
+   with a realistic amount of history (10k guilds, 1k substats, a year of
+   days by default), then times StatsTracker increment/decrement/flush/
+   get/fetch and Config get/set, one call at a time and from a pile of
+   concurrent coroutines. No discord connection needed.
+
+       python3 -m benchmarks.suite [--rows N] [--ops N] [--output FILE]
+       python3 -m benchmarks.suite --compare baseline.json
+
+   Results are JSON: one entry per scenario with the op count, ops/sec
+   and p50/p95/p99 latency. With --compare, any scenario whose ops/sec
+   dropped by more than --tolerance against the baseline is reported
+   and the exit status is non-zero, so it can gate a CI job. --label
+   tags a run (say, with the storage setup being tried) so runs can be
+   told apart.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sys
+import time
+
+from benchmarks.harness import BenchBot
+from src.utils.metrics import percentile
+from src.utils.stats import ROLLUPS
+
+STATS = ["messages", "emoji", "reactions"]
+SETTINGS = ["prefix", "stats:enabled", "welcome"]
+
+def summarize(name, samples, elapsed, **extra):
+    samples = sorted(samples)
+    return {"name": name, "ops": len(samples), "elapsed_s": elapsed,
+            "ops_per_s": len(samples) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(samples, 0.50) * 1000,
+            "p95_ms": percentile(samples, 0.95) * 1000,
+            "p99_ms": percentile(samples, 0.99) * 1000,
+            **extra}
+
+class Workload:
+    """
+       Picks keys the way real traffic does: a few guilds are busy and
+       most are quiet, so guild ids are skewed towards the low end.
+    """
+    def __init__(self, guilds, substats, seed=42):
+        self.guilds = guilds
+        self.substats = substats
+        self.rng = random.Random(seed)
+
+    def guild(self):
+        return int(self.guilds * self.rng.random() ** 3)
+
+    def stat(self):
+        return self.rng.choice(STATS)
+
+    def substat(self):
+        return f"sub{int(self.substats * self.rng.random() ** 2)}"
+
+def seed(bot, work, rows, days):
+    """
+       Fill the per-day table with rows of history spread over the last
+       days days, then build the totals and rollups from it the same way
+       an upgrade would. Also gives every guild a few config settings.
+    """
+    today = bot.stats.get_current_day()
+    counts = {}
+    while len(counts) < rows:
+        key = (work.guild(), work.stat(), work.substat(),
+               today - work.rng.randrange(days))
+        counts[key] = counts.get(key, 0) + work.rng.randint(1, 20)
+
+    conn = bot.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.executemany("insert into stats_granular values (?, ?, ?, ?, ?)",
+                           [(*key, count) for key, count in counts.items()])
+        cursor.execute("insert into stats select guild_id, statname, substat, "
+                       "sum(count), null from stats_granular "
+                       "group by guild_id, statname, substat")
+        cursor.executemany("insert into config_entry values (?, ?, ?)",
+                           [(guild, setting, "1")
+                            for guild in range(work.guilds)
+                            for setting in SETTINGS])
+        conn.commit()
+    finally:
+        conn.close()
+
+    for model, column, bucket_days in ROLLUPS[1:]:
+        bot.stats.backfill(bot, model, column, bucket_days)
+    with bot.engine.connect() as conn:
+        conn.exec_driver_sql("analyze")
+    bot.config.cache.clear()
+    bot.config.warm()
+
+def timed(name, ops, fn):
+    samples = []
+    start = time.perf_counter()
+    for _ in range(ops):
+        before = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - before)
+    return summarize(name, samples, time.perf_counter() - start)
+
+def sync_scenarios(bot, work, ops):
+    stats = bot.stats
+    config = bot.config
+    results = []
+
+    def increment():
+        stats.increment(work.guild(), work.stat(), 1, work.substat())
+    results.append(timed("stats_increment", ops, increment))
+    pending = len(stats.pending)
+    start = time.perf_counter()
+    stats.flush()
+    results.append(summarize("stats_flush", [time.perf_counter() - start],
+                             time.perf_counter() - start, keys=pending))
+
+    def decrement():
+        stats.decrement(work.guild(), work.stat(), 1, work.substat())
+    results.append(timed("stats_decrement", ops, decrement))
+    stats.flush()
+
+    for days in (None, 7, 365):
+        def get():
+            stats.get(work.guild(), work.stat(), work.substat(), days)
+        results.append(timed(f"stats_get_{days or 'all'}", ops, get))
+
+    for days in (7, 30, 365):
+        def fetch():
+            stats.fetch(work.guild(), work.stat(), 10, days)
+        results.append(timed(f"stats_fetch_{days}d", max(1, ops // 10), fetch))
+
+    def config_get():
+        config.get(work.guild(), work.rng.choice(SETTINGS), "0")
+    results.append(timed("config_get_cached", ops, config_get))
+
+    def config_get_cold():
+        config.cache.clear()
+        config.get(work.guild(), work.rng.choice(SETTINGS), "0")
+    results.append(timed("config_get_uncached", ops, config_get_cold))
+
+    def config_set():
+        config.set(work.guild(), work.rng.choice(SETTINGS),
+                   str(work.rng.randrange(100)))
+    results.append(timed("config_set", ops, config_set))
+    return results
+
+async def concurrently(name, workers, ops, fn):
+    """
+       Run ops calls of the coroutine function fn spread over workers
+       coroutines, timing each call.
+    """
+    samples = []
+
+    async def worker(count):
+        for _ in range(count):
+            before = time.perf_counter()
+            await fn()
+            samples.append(time.perf_counter() - before)
+
+    share = max(1, ops // workers)
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(share) for _ in range(workers)])
+    return summarize(name, samples, time.perf_counter() - start,
+                     workers=workers)
+
+async def async_scenarios(bot, work, ops, workers):
+    stats = bot.stats
+    config = bot.config
+    results = []
+
+    async def increment():
+        stats.increment(work.guild(), work.stat(), 1, work.substat())
+        await asyncio.sleep(0)
+    results.append(await concurrently("async_stats_increment", workers, ops,
+                                      increment))
+    await stats.flush_async()
+
+    async def get():
+        await stats.get_async(work.guild(), work.stat(), work.substat(), 30)
+    results.append(await concurrently("async_stats_get_30", workers, ops, get))
+
+    async def fetch():
+        await stats.fetch_async(work.guild(), work.stat(), 10, 30)
+    results.append(await concurrently("async_stats_fetch_30d", workers,
+                                      max(workers, ops // 10), fetch))
+
+    # The uncached scenario left the cache empty.
+    config.warm()
+
+    async def config_get():
+        await config.get_async(work.guild(), work.rng.choice(SETTINGS), "0")
+    results.append(await concurrently("async_config_get_cached", workers, ops,
+                                      config_get))
+
+    async def config_set():
+        await config.set_async(work.guild(), work.rng.choice(SETTINGS),
+                               str(work.rng.randrange(100)))
+    results.append(await concurrently("async_config_set", workers, ops,
+                                      config_set))
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+       The scenarios whose throughput fell by more than tolerance (a
+       fraction) against the baseline run.
+    """
+    before = {entry["name"]: entry for entry in baseline["results"]}
+    regressions = []
+    for entry in results:
+        old = before.get(entry["name"])
+        if old is None or not old["ops_per_s"]:
+            continue
+        change = entry["ops_per_s"] / old["ops_per_s"] - 1
+        if change < -tolerance:
+            regressions.append({"name": entry["name"], "change": change,
+                                "before": old["ops_per_s"],
+                                "after": entry["ops_per_s"]})
+    return regressions
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, default=10_000)
+    parser.add_argument("--substats", type=int, default=1_000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--rows", type=int, default=1_000_000,
+                        help="rows of per-day history to seed")
+    parser.add_argument("--ops", type=int, default=2_000,
+                        help="calls per scenario")
+    parser.add_argument("--workers", type=int, default=32,
+                        help="coroutines in the concurrent scenarios")
+    parser.add_argument("--label", default="")
+    parser.add_argument("--output", help="write the JSON here too")
+    parser.add_argument("--compare", help="baseline JSON to check against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    work = Workload(args.guilds, args.substats)
+    bot = BenchBot()
+    try:
+        start = time.perf_counter()
+        seed(bot, work, args.rows, args.days)
+        seed_s = time.perf_counter() - start
+
+        results = sync_scenarios(bot, work, args.ops)
+        results.extend(await async_scenarios(bot, work, args.ops,
+                                             args.workers))
+    finally:
+        if bot.async_engine is not None:
+            await bot.async_engine.dispose()
+        bot.cleanup()
+
+    report = {"label": args.label,
+              "when": time.time(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "params": {"guilds": args.guilds, "substats": args.substats,
+                         "days": args.days, "rows": args.rows,
+                         "ops": args.ops, "workers": args.workers},
+              "seed_s": seed_s,
+              "results": results}
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        report["regressions"] = regressions
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if regressions:
+        sys.exit(f"{len(regressions)} scenarios slower than the baseline")
+
+if __name__ == '__main__':
+    asyncio.run(main())
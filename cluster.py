@@ -0,0 +1,143 @@
+# Runs the bot as several processes, each running its share of the shards.
+#
+#     python3 cluster.py [--processes N] [--shards N]
+#
+# Each worker is an ordinary `python3 main.py` with CLUSTER_ID,
+# CLUSTER_SIZE, SHARD_COUNT and SHARD_IDS set (see src/utils/cluster.py).
+# They all share the one database; worker 0 is the primary and runs the
+# web server and the cluster-wide jobs. Workers that die get restarted.
+import argparse
+import os
+import requests
+import signal
+import subprocess
+import sys
+import time
+
+from dotenv import load_dotenv
+
+# The launcher logs to its own files, not the ones the workers use.
+os.environ["LOG_NAME"] = "launcher"
+
+from src.logging import logger
+from src.utils.cluster import split_shards
+
+# Discord lets each bot start one shard every five seconds (more for very
+# big bots, but we don't do anything clever about that).
+IDENTIFY_INTERVAL = 5
+# The longest we'll wait before restarting a worker that keeps dying.
+MAX_RESTART_DELAY = 60
+
+def recommended_shards(token):
+    """
+       Ask discord how many shards it thinks we need.
+    """
+    r = requests.get("https://discord.com/api/v10/gateway/bot",
+                     headers={"Authorization": f"Bot {token}"}, timeout=30)
+    r.raise_for_status()
+    return r.json()["shards"]
+
+class Worker:
+    def __init__(self, cluster_id, size, shard_count, shard_ids):
+        self.cluster_id = cluster_id
+        self.env = dict(os.environ,
+                        CLUSTER_ID=str(cluster_id),
+                        CLUSTER_SIZE=str(size),
+                        LOG_NAME=str(cluster_id),
+                        SHARD_COUNT=str(shard_count),
+                        SHARD_IDS=",".join(str(i) for i in shard_ids))
+        self.shard_ids = shard_ids
+        self.process = None
+        self.started = 0
+        self.failures = 0
+        self.restart_at = 0
+
+    def start(self):
+        logger.info(f"Starting worker {self.cluster_id} with shards {self.shard_ids}")
+        self.process = subprocess.Popen([sys.executable, "main.py"],
+                                        env=self.env)
+        self.started = time.monotonic()
+
+    def check(self):
+        """
+           Restart the worker if it's died, backing off if it keeps on
+           doing it.
+        """
+        if self.process is None:
+            if time.monotonic() >= self.restart_at:
+                self.start()
+            return
+        code = self.process.poll()
+        if code is None:
+            return
+        # A worker that ran for a good while before dying gets a fresh
+        # start on the backoff.
+        if time.monotonic() - self.started > MAX_RESTART_DELAY * 5:
+            self.failures = 0
+        self.failures = self.failures + 1
+        delay = min(MAX_RESTART_DELAY, 2 ** self.failures)
+        logger.warning(f"Worker {self.cluster_id} exited with {code}, restarting in {delay}s")
+        self.process = None
+        self.restart_at = time.monotonic() + delay
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+
+    def wait(self, timeout):
+        if self.process is None:
+            return
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int,
+                        default=int(os.getenv("CLUSTER_PROCESSES",
+                                              str(os.cpu_count() or 1))))
+    parser.add_argument("--shards", type=int,
+                        default=int(os.getenv("SHARD_COUNT", "0")),
+                        help="total shards, 0 to ask discord")
+    args = parser.parse_args()
+
+    shard_count = args.shards
+    if not shard_count:
+        shard_count = recommended_shards(os.getenv("DISCORD_TOKEN"))
+    groups = split_shards(shard_count, args.processes)
+    workers = [Worker(n, len(groups), shard_count, shards)
+               for n, shards in enumerate(groups)]
+    logger.info(f"Running {shard_count} shards in {len(workers)} processes")
+
+    stopping = False
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    # Start the primary first, so it gets to create any tables, and space
+    # the rest out so their shards don't all try to connect at once.
+    for worker in workers:
+        if stopping:
+            break
+        worker.start()
+        deadline = time.monotonic() + IDENTIFY_INTERVAL * len(worker.shard_ids)
+        while not stopping and time.monotonic() < deadline:
+            time.sleep(0.5)
+
+    while not stopping:
+        for worker in workers:
+            worker.check()
+        time.sleep(1)
+
+    logger.info("Stopping workers")
+    for worker in workers:
+        worker.stop()
+    for worker in workers:
+        worker.wait(30)
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,8 @@
+# Start timing imports before we import anything heavy, so the admin
+# cog can report what our startup time went on.
+from src.utils.importtime import import_timer
+import_timer.install()
+
 import discord
 import logging
 import os
@@ -1,71 +1,309 @@
-import discord
+import asyncio
+import contextvars
 import os
-import psutil
+import sys
+import time
 
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from discord.ext import commands
 
 from src.database.database import Database
-from src.logging import logger
+from src.logging import logger, dropped_records
+from src.utils.cluster import Cluster
+from src.utils.blocking import BlockingPool
+from src.utils.commandstats import CommandStats
 from src.utils.config import Config
+from src.utils.intents import describe, gateway_options
+from src.utils.jobs import Jobs
+from src.utils.memory import MemoryTracer, mem_usage
+from src.utils.metrics import registry
+from src.utils.profiler import SamplingProfiler
 from src.utils.stats import StatsTracker
+from src.utils.watchdog import LoopWatchdog
 
-intents = discord.Intents.all()
-if hasattr(intents, "message_content"):
-    intents.message_content = True
+# How long a cog will wait for another cog it depends on to load.
+COG_DEPENDENCY_TIMEOUT = 30
 
-def mem_usage():
-    process = psutil.Process(os.getpid())
-    mem_info = process.memory_info()
-    return mem_info.rss
+# The startup report entry for the cog being loaded by the current task.
+loading_cog = contextvars.ContextVar("loading_cog", default=None)
 
-class MyBot(commands.Bot):
+def cog_names():
+    """
+       The extension names of all the cogs in src/cogs, sorted.
+    """
+    cogs = [name for name in os.listdir("./src/cogs")
+            if name.endswith(".py")
+            and not name.startswith("_")
+            and not name.startswith("#")
+            and not name.startswith("~")]
+    cogs.sort()
+    return [f"src.cogs.{cog[:-3]}" for cog in cogs]
+
+class MyBot(commands.AutoShardedBot):
     def __init__(self, command_prefix="$", description="simple discord bot",
                  app_id=-1):
+        # Which shards this process runs. By default that's all of them,
+        # with discord picking how many; cluster.py splits them up
+        # between processes.
+        self.cluster = Cluster()
+
+        # The database and config come up before the discord side does,
+        # as the config has a say in which intents and caches we use.
+        self.database = Database()
+        self.database.safe_start()
+        self.engine = self.database.engine # A handy little shortcut
+        self.async_engine = self.database.async_engine # May be None
+
+        # Blocking work (database calls from coroutines, psutil and so
+        # on) goes to this, through run_blocking.
+        self.blocking = BlockingPool()
+        self.jobs = Jobs(self)
+        self.sched = self.jobs.sched
+
+        self.config = Config(self)
+        self.gateway_options = gateway_options(self.config.get_guild(-1),
+                                               cog_names())
+        logger.info(f"Gateway: {describe(self.gateway_options)}")
+
         super(MyBot, self).__init__(command_prefix=command_prefix,
                                     help_command=None,
                                     case_insensitive=True,
                                     description=description,
-                                    intents=intents,
-                                    application_id=app_id)
+                                    application_id=app_id,
+                                    shard_count=self.cluster.shard_count,
+                                    shard_ids=self.cluster.shard_ids,
+                                    **self.gateway_options)
 
         self.token = os.getenv("DISCORD_TOKEN", "<no token>")
 
-        self.database = Database()
-        self.database.safe_start()
-        self.engine = self.database.engine # A handy little shortcut
+        self.stats = StatsTracker(self)
+        self.command_stats = CommandStats(self)
 
-        self.sched = AsyncIOScheduler(timezone='utc')
+        # on_ready fires again after every gateway reconnect, but we only
+        # want to load cogs and start things up the first time.
+        self.started = False
+        self.startup_report = None
+        # Events set as each extension finishes loading, so cogs that
+        # depend on others can wait for them.
+        self.extension_events = {}
 
-        self.config = Config(self)
-        self.stats = StatsTracker(self)
+        # Caches whose hit rates we export. Cogs can add theirs.
+        self.caches = {"config": self.config.cache}
+        self.init_metrics()
+
+        # Watches for things blocking the event loop. Started in on_ready.
+        self.watchdog = LoopWatchdog()
+        # Only runs when asked to, with the profile command.
+        self.profiler = SamplingProfiler()
+        # Memory accounting for cog loads, with tracemalloc if asked for.
+        self.memtrace = MemoryTracer()
+
+    def init_metrics(self):
+        """
+           Register the bot's runtime metrics and install the hooks that
+           feed them. They're served from /metrics by the web cog.
+        """
+        def latency():
+            return self.latency
+        registry.gauge("bot_gateway_latency_seconds",
+                       "Gateway heartbeat latency", fn=latency)
+        registry.gauge("bot_resident_memory_bytes", "Resident set size",
+                       fn=mem_usage)
+        registry.gauge("bot_guilds", "Guilds the bot is in",
+                       fn=lambda: len(self.guilds))
+        registry.gauge("bot_log_records_dropped",
+                       "Log records dropped because the log queue was full",
+                       fn=dropped_records)
+
+        def cache_stats(field):
+            def collect():
+                return [({"cache": name}, cache.stats()[field])
+                        for name, cache in self.caches.items()]
+            return collect
+        registry.gauge("bot_cache_hit_ratio", "Cache hit ratio", ("cache",),
+                       fn=cache_stats("hit_ratio"))
+        registry.gauge("bot_cache_hits", "Cache hits", ("cache",),
+                       fn=cache_stats("hits"))
+        registry.gauge("bot_cache_misses", "Cache misses", ("cache",),
+                       fn=cache_stats("misses"))
+        registry.gauge("bot_cache_size", "Cache entries", ("cache",),
+                       fn=cache_stats("size"))
+
+        self.command_count = registry.counter("bot_commands_total",
+                                              "Commands invoked", ("command",))
+        self.command_seconds = registry.histogram("bot_command_seconds",
+                                                  "Command run time",
+                                                  ("command",))
+        self.before_invoke(self.instrument_before_invoke)
+        self.after_invoke(self.instrument_after_invoke)
+        # A listener rather than an on_command_error method, as main.py
+        # puts its own handler in that slot.
+        self.add_listener(self.count_failed_command, "on_command_error")
+
+    async def instrument_before_invoke(self, ctx):
+        ctx.invoke_started = time.perf_counter()
+
+    async def instrument_after_invoke(self, ctx):
+        # Called whether or not the command succeeded; command_failed
+        # tells us which.
+        started = getattr(ctx, "invoke_started", None)
+        if started is None or ctx.command is None:
+            return
+        if (ctx.invoked_subcommand is not None
+                and ctx.command is not ctx.invoked_subcommand
+                and not ctx.command_failed):
+            # A group's own callback, with the subcommand still to run
+            # and be counted. Forget the start time so a subcommand that
+            # fails its checks gets counted by count_failed_command.
+            ctx.invoke_started = None
+            return
+        elapsed = time.perf_counter() - started
+        name = ctx.command.qualified_name
+        self.command_count.inc(command=name)
+        self.command_seconds.observe(elapsed, command=name)
+        guild_id = ctx.guild.id if ctx.guild is not None else -1
+        self.command_stats.record(name, guild_id, elapsed, ctx.command_failed)
+
+    async def count_failed_command(self, ctx, exception):
+        # Failed checks and bad arguments stop a command before
+        # before_invoke, so after_invoke never hears about them. Errors
+        # from the command itself have been counted already.
+        if ctx.command is not None and getattr(ctx, "invoke_started", None) is None:
+            name = ctx.command.qualified_name
+            self.command_count.inc(command=name)
+            guild_id = ctx.guild.id if ctx.guild is not None else -1
+            self.command_stats.record_failure(name, guild_id)
 
     async def on_ready(self):
+        if self.started:
+            logger.info("Reconnected")
+            return
+        self.started = True
+        self.watchdog.start()
+        logger.info(f"Cluster process {self.cluster.cluster_id} of {self.cluster.size} "
+                    f"running shards {sorted(self.shards)} of {self.shard_count}")
 
-        # Bot is ready. Load in all the cogs.
-        cogs = [name for name in os.listdir("./src/cogs")
-                if name.endswith(".py")
-                and not name.startswith("_")
-                and not name.startswith("#")
-                and not name.startswith("~")]
-        cogs.sort()
-        for cog in cogs:
-            try:
-                before = mem_usage()
-                await self.load_extension(f"src.cogs.{cog[:-3]}")
-                after = mem_usage()
-                mem_diff = after - before
-                logger.debug(f"{cog} loaded, {mem_diff:,} bytes of memory used")
-            except Exception as e:
-                logger.warning("{}: {}".format(type(e).__name__, e), exc_info=True)
+        # Bot is ready. Load in all the cogs. They're loaded concurrently,
+        # so a cog whose setup() waits on something (or on another cog,
+        # with require_extension) doesn't hold the rest up. If we're
+        # tracing memory they go one at a time instead, so each cog's
+        # snapshot diff only has its own allocations in it.
+        start = time.perf_counter()
+        if self.memtrace.enabled:
+            entries = [await self.timed_load(name) for name in cog_names()]
+        else:
+            entries = await asyncio.gather(*[self.timed_load(name)
+                                             for name in cog_names()])
+        self.startup_report = {"total_ms": (time.perf_counter() - start) * 1000,
+                               "cogs": entries}
+        logger.info(f"{len(entries)} cogs loaded in {self.startup_report['total_ms']:.0f}ms")
 
         # Now that the cogs are ready we can start up the
         # scheduler. We wait until after cog load in case cogs have
         # installed timer things -- we don't want timers firing while
-        # we're still initializing.
-        self.sched.start()
+        # we're still initializing. Persistent jobs that came due while
+        # we were down run now.
+        self.jobs.start()
 
         logger.info("Bot ready")
 
+    async def timed_load(self, name):
+        """
+           Load one extension and return a startup report entry for it:
+           wall time, import time (module import plus cog construction,
+           up to the first add_cog, less any time spent waiting on other
+           cogs), and the change in RSS. Cogs load concurrently and RSS
+           is process-wide, so the RSS figure is only a rough guide; with
+           memory tracing on, the entry also has the bytes the load left
+           allocated and the lines that allocated them.
+        """
+        entry = {"name": name, "start": time.perf_counter(),
+                 "import_ms": None, "wait_ms": 0.0, "ok": True}
+        loading_cog.set(entry)
+        async with self.memtrace.measure(name) as report:
+            try:
+                await self.load_extension(name)
+            except Exception as e:
+                entry["ok"] = False
+                entry["error"] = "{}: {}".format(type(e).__name__, e)
+                logger.warning(entry["error"], exc_info=True)
+        entry["wall_ms"] = (time.perf_counter() - entry.pop("start")) * 1000
+        entry["mem_delta"] = report["rss_delta"]
+        entry["retained"] = report["retained"]
+        entry["top"] = report["top"]
+        self.extension_event(name).set()
+        logger.debug(f"{name} loaded in {entry['wall_ms']:.1f}ms, {entry['mem_delta']:,} bytes of memory used")
+        return entry
+
+    def extension_event(self, name):
+        if name not in self.extension_events:
+            self.extension_events[name] = asyncio.Event()
+        return self.extension_events[name]
+
+    async def require_extension(self, name):
+        """
+           For a cog's setup() to call when it needs another cog loaded
+           first. Waits until that extension has finished loading; raises
+           an error if it doesn't load in time.
+
+           **Example:** `await bot.require_extension("src.cogs.admin")`
+        """
+        if '.' not in name:
+            name = "src.cogs." + name
+        entry = loading_cog.get()
+        start = time.perf_counter()
+        if name not in self.extensions:
+            await asyncio.wait_for(self.extension_event(name).wait(),
+                                   COG_DEPENDENCY_TIMEOUT)
+            if name not in self.extensions:
+                raise commands.ExtensionError(f"{name} failed to load",
+                                              name=name)
+        if entry is not None:
+            entry["wait_ms"] += (time.perf_counter() - start) * 1000
+
+    async def run_blocking(self, fn, *args, process=False, **kwargs):
+        """
+           Run a blocking call without holding up the event loop, in the
+           bot's thread pool (or with process=True its process pool, if
+           BLOCKING_PROCESSES is set). Functions decorated with
+           src.utils.blocking.blocking do this for themselves.
+
+           **Example:** `rows = await bot.run_blocking(bot.stats.fetch, guild_id, "messages")`
+        """
+        return await self.blocking.run(fn, *args, process=process, **kwargs)
+
+    async def add_cog(self, cog, **kwargs):
+        # The first cog added during a timed load marks the end of its
+        # import.
+        entry = loading_cog.get()
+        if entry is not None and entry["import_ms"] is None and "start" in entry:
+            entry["import_ms"] = ((time.perf_counter() - entry["start"]) * 1000
+                                  - entry["wait_ms"])
+        # Intents are fixed once we've connected, so a cog loaded later
+        # that wants more than we asked for won't get them.
+        module = sys.modules.get(type(cog).__module__)
+        missing = [name for name in getattr(module, "INTENTS", ())
+                   if not getattr(self.intents, name, False)]
+        if missing:
+            logger.warning(f"{type(cog).__name__} wants intents {', '.join(missing)}, which aren't enabled")
+        await super().add_cog(cog, **kwargs)
+
+    async def close(self):
+        # Stop the scheduler so no flush job races us, then write out
+        # anything still sitting in the stats buffer before we go.
+        self.watchdog.stop()
+        self.profiler.stop()
+        self.jobs.shutdown()
+        try:
+            await self.run_blocking(self.command_stats.flush)
+            await self.run_blocking(self.stats.flush)
+        except Exception as e:
+            logger.warning("{}: {}".format(type(e).__name__, e), exc_info=True)
+        # Unloading the cogs can still need the blocking pool and the
+        # database, so they go last.
+        await super().close()
+        await self.blocking.shutdown()
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+
     def run(self):
         super().run(self.token, reconnect=True)        
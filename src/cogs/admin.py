@@ -1,12 +1,27 @@
-import os
-import psutil
+import discord
+import io
 
 from discord.ext import commands
 
-def mem_usage():
-    process = psutil.Process(os.getpid())
-    mem_info = process.memory_info()
-    return mem_info.rss
+from src.utils.importtime import import_timer
+from src.utils.memory import LEAK_RELOADS, mem_usage
+
+def describe_memory(report, count=5):
+    """
+       Turns a memory report from the bot's MemoryTracer into a few lines
+       of text for a reply.
+    """
+    if report["retained"] is None:
+        return f"{report['rss_delta']:,} bytes of memory used."
+    lines = [f"{report['retained']:,} bytes retained in {report['blocks']:,} blocks, "
+             f"RSS {report['rss_delta']:+,} bytes."]
+    if report["top"]:
+        top = "\n".join(f"{size:>+12,} {blocks:>+7,} {where}"
+                        for where, size, blocks in report["top"][:count])
+        lines.append(f"```\n{top[:1500]}\n```")
+    if report["leak"]:
+        lines.append(f"Retained memory grew on each of the last {LEAK_RELOADS} reloads, so this cog may be leaking.")
+    return "\n".join(lines)
 
 def cleanup_name(name: str) -> str:
     """
@@ -50,6 +65,76 @@ class Admin(commands.Cog):
         latency = self.bot.latency * 1000
         await ctx.send(f"{latency:.2f}ms latency")
 
+    @commands.command(name="lag", description="Show event loop lag")
+    @commands.has_permissions(manage_guild=True)
+    async def lag(self, ctx: commands.Context, count: int = 5) -> None:
+        """
+           Shows how far behind the event loop has been running lately,
+           and the most recent times something blocked it.
+
+           **Usage:** `lag [count]`
+           [count]: How many recent stalls to show. Defaults to 5.
+        """
+        watchdog = self.bot.watchdog
+        p = watchdog.percentiles()
+        lines = [f"loop lag p50 {p['p50'] * 1000:.1f}ms, p95 {p['p95'] * 1000:.1f}ms, "
+                 f"p99 {p['p99'] * 1000:.1f}ms, max {p['max'] * 1000:.1f}ms",
+                 f"{len(watchdog.incidents)} stalls over {watchdog.threshold * 1000:.0f}ms recorded"]
+        for incident in list(watchdog.incidents)[-count:]:
+            lines.append(f"{incident['duration'] * 1000:.0f}ms at {incident['where']}")
+        text = "\n".join(lines)
+        await ctx.send(f"```\n{text[:1900]}\n```")
+
+    @commands.command(name="slow", description="Show the slowest commands")
+    @commands.has_permissions(manage_guild=True)
+    async def slow(self, ctx: commands.Context, count: int = 10) -> None:
+        """
+           Shows the slowest commands by 95th percentile run time, with
+           call and error counts, since the bot started.
+
+           **Usage:** `slow [count]`
+           [count]: How many commands to show. Defaults to 10.
+        """
+        slowest = self.bot.command_stats.slowest(count)
+        if not slowest:
+            await ctx.send("No commands have run yet.")
+            return
+        lines = [f"{'command':<24} {'calls':>7} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"]
+        for entry in slowest:
+            lines.append(f"{entry['name'][:24]:<24} {entry['calls']:>7} {entry['errors']:>6} "
+                         f"{entry['p50'] * 1000:>8.1f} {entry['p95'] * 1000:>8.1f} {entry['p99'] * 1000:>8.1f}")
+        text = "\n".join(lines)
+        await ctx.send(f"```\n{text[:1900]}\n```")
+
+    @commands.command(name="jobs", description="Show the scheduled jobs")
+    @commands.has_permissions(manage_guild=True)
+    async def jobs(self, ctx: commands.Context) -> None:
+        """
+           Shows the scheduled jobs, which job store they're in, when
+           they next run, and how their runs have gone since the bot
+           started.
+
+           **Usage:** `jobs`
+        """
+        # Persistent jobs are read from the database.
+        summary = await self.bot.run_blocking(self.bot.jobs.summary)
+        if not summary:
+            await ctx.send("There are no scheduled jobs.")
+            return
+        lines = [f"{'job':<20} {'store':<10} {'next run (UTC)':<19} {'runs':>6} {'errors':>6} {'missed':>6} {'last ms':>9}"]
+        for entry in summary:
+            next_run = entry["next_run"]
+            next_run = "-" if next_run is None else next_run.strftime("%Y-%m-%d %H:%M:%S")
+            last = entry.get("last_seconds")
+            last = "-" if last is None else f"{last * 1000:.1f}"
+            lines.append(f"{entry['id'][:20]:<20} {entry['jobstore']:<10} {next_run:<19} "
+                         f"{entry.get('runs', 0):>6} {entry.get('errors', 0):>6} "
+                         f"{entry.get('missed', 0):>6} {last:>9}")
+            if entry.get("last_error"):
+                lines.append(f"    last error: {entry['last_error'][:100]}")
+        text = "\n".join(lines)
+        await ctx.send(f"```\n{text[:1900]}\n```")
+
     @commands.group(name="cog", description="Cog management commands",
                     invoke_without_command=False)
     @commands.has_permissions(manage_guild=True)
@@ -71,11 +156,10 @@ class Admin(commands.Cog):
 
            **Example:** `cog load help`
         """
-        mem_diff = 0
         try:
-            before = mem_usage()
-            await self.bot.load_extension(cleanup_name(cog))
-            mem_diff = mem_usage() - before
+            name = cleanup_name(cog)
+            async with self.bot.memtrace.measure(name) as report:
+                await self.bot.load_extension(name)
         except commands.ExtensionNotFound:
             await ctx.send(f'{cog} cannot be found.')
             return
@@ -85,7 +169,7 @@ class Admin(commands.Cog):
         except NameException:
             await ctx.send(f'{cog} is an invalid cog name.')
             return
-        await ctx.send(f'{cog} loaded, {mem_diff:,} bytes of memory used.')
+        await ctx.send(f'{cog} loaded, {describe_memory(report)}')
 
     @admin_cog.command(name="reload", description="Reload a loaded cog")
     @commands.has_permissions(manage_guild=True)
@@ -110,21 +194,21 @@ class Admin(commands.Cog):
             await ctx.send(f"{cog} isn't a currently loaded cog")
             return
 
-        mem_diff = 0
         try:
-            before = mem_usage()
-            await self.bot.reload_extension(name)
-            mem_diff = mem_usage() - before
+            async with self.bot.memtrace.measure(name, "reload") as report:
+                await self.bot.reload_extension(name)
         except commands.ExtensionNotFound:
             await ctx.send(f'{cog} cannot be found.')
             return
         except commands.ExtensionNotLoaded:
-            await self.bot.load_extension(cog)
+            await self.bot.load_extension(name)
+            await ctx.send(f'{cog} loaded')
+            return
         except Exception as e:
             await ctx.send(f"Unable to load cog {cog}: {e} {type(e)}")
             return
 
-        await ctx.send(f'{cog} reloaded, {mem_diff:,} bytes of memory used')
+        await ctx.send(f'{cog} reloaded, {describe_memory(report)}')
     
     @admin_cog.command(name="unload", description="Reload a loaded cog")
     @commands.has_permissions(manage_guild=True)
@@ -162,7 +246,186 @@ class Admin(commands.Cog):
             return
 
         await ctx.send(f'{cog} unloaded')
-    
+
+    @admin_cog.command(name="startup", description="Show the cog startup report")
+    @commands.has_permissions(manage_guild=True)
+    async def admin_cog_startup(self, ctx: commands.Context) -> None:
+        """
+           Shows how long each cog took to load at startup, and how much
+           memory it used. The traced column is only filled in if memory
+           tracing was on at startup.
+
+           **Usage:** `cog startup`
+        """
+        report = self.bot.startup_report
+        if report is None:
+            await ctx.send("Startup hasn't finished yet.")
+            return
+
+        lines = [f"{'cog':<20} {'wall ms':>9} {'import ms':>9} {'memory':>12} {'traced':>12}"]
+        for entry in sorted(report["cogs"], key=lambda e: -e["wall_ms"]):
+            name = entry["name"].replace("src.cogs.", "")
+            import_ms = entry["import_ms"]
+            import_ms = "-" if import_ms is None else f"{import_ms:.1f}"
+            retained = entry.get("retained")
+            retained = "-" if retained is None else f"{retained:,}"
+            status = "" if entry["ok"] else " FAILED"
+            lines.append(f"{name:<20} {entry['wall_ms']:>9.1f} {import_ms:>9} {entry['mem_delta']:>12,} {retained:>12}{status}")
+        lines.append(f"total {report['total_ms']:.1f}ms")
+        text = "\n".join(lines)
+        await ctx.send(f"```\n{text[:1900]}\n```")
+
+    @admin_cog.command(name="memtrace", description="Turn memory tracing on or off")
+    @commands.has_permissions(manage_guild=True)
+    async def admin_cog_memtrace(self, ctx: commands.Context, state: str = None) -> None:
+        """
+           Turns tracemalloc tracing on or off. While it's on, cog loads
+           and reloads report the memory they left allocated and the lines
+           that allocated it, and cogs that grow on every reload get
+           flagged. Everything runs slower while it's on. With no
+           argument, says whether it's on.
+
+           **Usage:** `cog memtrace [on|off]`
+
+           **Example:** `cog memtrace on`
+        """
+        tracer = self.bot.memtrace
+        if state is None:
+            pass
+        elif state.lower() == "on":
+            tracer.enable()
+        elif state.lower() == "off":
+            tracer.disable()
+        else:
+            await ctx.send("Memory tracing can only be turned on or off.")
+            return
+        await ctx.send(f"Memory tracing is {'on' if tracer.enabled else 'off'}.")
+
+    @admin_cog.command(name="memory", description="Show cog memory reports")
+    @commands.has_permissions(manage_guild=True)
+    async def admin_cog_memory(self, ctx: commands.Context, cog: str = None) -> None:
+        """
+           Shows the memory traced for a cog's last load or reload, or
+           with no cog, the retained memory for each traced cog and the
+           ones that look like they're leaking.
+
+           **Usage:** `cog memory [cogname]`
+
+           **Example:** `cog memory web`
+        """
+        tracer = self.bot.memtrace
+        if cog is not None:
+            try:
+                name = cleanup_name(cog)
+            except NameException:
+                await ctx.send(f'{cog} is an invalid cog name.')
+                return
+            report = tracer.reports.get(name)
+            if report is None:
+                await ctx.send(f"No memory trace for {cog}.")
+                return
+            await ctx.send(f"{cog} {report['kind']}: {describe_memory(report, 10)}")
+            return
+
+        if not tracer.reports:
+            await ctx.send("No memory traces recorded.")
+            return
+        lines = [f"{'cog':<20} {'last':>6} {'retained':>12} {'reloads':>24}"]
+        for name, report in sorted(tracer.reports.items()):
+            history = " ".join(f"{size // 1024:,}k" for size in tracer.history.get(name, ()))
+            leak = " LEAK?" if report["leak"] else ""
+            lines.append(f"{name.replace('src.cogs.', ''):<20} {report['kind']:>6} "
+                         f"{report['retained']:>12,} {history:>24}{leak}")
+        text = "\n".join(lines)
+        await ctx.send(f"```\n{text[:1900]}\n```")
+
+    @admin_cog.command(name="imports", description="Show where import time went")
+    @commands.has_permissions(manage_guild=True)
+    async def admin_cog_imports(self, ctx: commands.Context, count: int = 20) -> None:
+        """
+           Shows the slowest module imports since startup, like
+           `python -X importtime` does. Modules imported lazily show up
+           once something has actually used them.
+
+           **Usage:** `cog imports [count]`
+           [count]: How many modules to show. Defaults to 20.
+        """
+        report = import_timer.report(count)
+        if not report:
+            await ctx.send("No import timings recorded.")
+            return
+        lines = [f"{'module':<40} {'self ms':>9} {'cumul ms':>9}"]
+        for name, own, total in report:
+            lines.append(f"{name[:40]:<40} {own * 1000:>9.1f} {total * 1000:>9.1f}")
+        rss = await self.bot.run_blocking(mem_usage)
+        lines.append(f"total import time {import_timer.total() * 1000:.1f}ms, "
+                     f"{len(import_timer.times)} modules, "
+                     f"{rss:,} bytes resident")
+        text = "\n".join(lines)
+        await ctx.send(f"```\n{text[:1900]}\n```")
+
+    @commands.group(name="profile", description="CPU profiling commands",
+                    invoke_without_command=True)
+    @commands.has_permissions(manage_guild=True)
+    async def profile(self, ctx: commands.Context) -> None:
+        """
+           Profile where the bot's CPU time is going, while it runs. The
+           profile samples every thread's stack and comes back as a
+           collapsed-stack file for flamegraph.pl or speedscope.
+        """
+        profiler = self.bot.profiler
+        if profiler.running:
+            await ctx.send(f"Profiling, {profiler.sample_count} samples so far.")
+        else:
+            await ctx.send(f"Not profiling. Last profile has {profiler.sample_count} samples.")
+
+    @profile.command(name="start", description="Start profiling")
+    @commands.has_permissions(manage_guild=True)
+    async def profile_start(self, ctx: commands.Context, seconds: int = 30,
+                            interval_ms: int = 10) -> None:
+        """
+           Start a profile, which stops by itself after the given time.
+
+           **Usage:** `profile start [seconds] [interval_ms]`
+           [seconds]: How long to profile for. Defaults to 30.
+           [interval_ms]: Time between samples. Defaults to 10.
+
+           **Example:** `profile start 60`
+        """
+        if not self.bot.profiler.start(seconds, max(interval_ms, 1) / 1000):
+            await ctx.send("A profile is already running.")
+            return
+        await ctx.send(f"Profiling for up to {seconds}s.")
+
+    @profile.command(name="stop", description="Stop profiling")
+    @commands.has_permissions(manage_guild=True)
+    async def profile_stop(self, ctx: commands.Context) -> None:
+        """
+           Stop a running profile early.
+
+           **Usage:** `profile stop`
+        """
+        if not self.bot.profiler.stop():
+            await ctx.send("No profile is running.")
+            return
+        await ctx.send(f"Profile stopped with {self.bot.profiler.sample_count} samples.")
+
+    @profile.command(name="dump", description="Send the profile")
+    @commands.has_permissions(manage_guild=True)
+    async def profile_dump(self, ctx: commands.Context) -> None:
+        """
+           Send the latest profile as a collapsed-stack file. It's also
+           available from the web server at /profile.
+
+           **Usage:** `profile dump`
+        """
+        data = self.bot.profiler.collapsed()
+        if not data:
+            await ctx.send("There's no profile data.")
+            return
+        await ctx.send(file=discord.File(io.BytesIO(data.encode("utf-8")),
+                                         filename="profile.collapsed"))
+
 
 async def setup(bot):
     await bot.add_cog(Admin(bot))
@@ -1,20 +1,106 @@
 import asyncio
 import discord
 import os
+import secrets
 
 from discord import Guild, Member, User
 from discord.ext import commands
-from hypercorn.asyncio import serve
-from hypercorn.config import Config as HyperConfig
-from quart import Quart, redirect, url_for, render_template, request, session, abort, send_file, send_from_directory
-from quart_discord import DiscordOAuth2Session, requires_authorization, Unauthorized
 from typing import Any
 
 from src.logging import logger
+from src.utils.cache import TTLCache
+from src.utils.lazy import lazy_import
+from src.utils.metrics import registry
+
+# Quart and its discord add-on are heavy, and most of the time the web
+# server isn't running, so they're only imported once we need them.
+quart = lazy_import("quart")
+quart_discord = lazy_import("quart_discord")
 
 WEB_SERVER_STATUS = "web:should_run"
 WEB_SERVER_DEFAULT = "False"
 
+# How long we remember which of our guilds a dashboard user is in, and how
+# many member lookups we'll have in flight at once when we have to ask
+# discord.
+GUILD_INDEX_TTL = 300
+MEMBER_FETCH_CONCURRENCY = 8
+
+# The session cookie entry that ties a browser session to its OAuth cache.
+OAUTH_CACHE_KEY = "oauth_cache_key"
+
+class OAuthCache:
+    """
+       Caches what the discord OAuth session tells us about the logged-in
+       user, so rendering a page doesn't keep asking discord the same
+       thing. Lookups are shared within a request (concurrent ones wait on
+       the same call), and kept across requests for
+       DISCORD_OAUTH_CACHE_TTL seconds, keyed by an id we put in the
+       session cookie. Logging out throws the session's entries away.
+    """
+    def __init__(self, discordd):
+        self.discordd = discordd
+        ttl = float(os.getenv("DISCORD_OAUTH_CACHE_TTL", "300"))
+        self.cache = TTLCache(maxsize=10000, ttl=ttl)
+        self.request_hits = 0
+        self.upstream_calls = 0
+
+    def session_key(self):
+        key = quart.session.get(OAUTH_CACHE_KEY)
+        if key is None:
+            key = secrets.token_hex(16)
+            quart.session[OAUTH_CACHE_KEY] = key
+        return key
+
+    async def lookup(self, what, fetch):
+        requests = quart.g.setdefault("oauth_cache", {})
+        if what in requests:
+            self.request_hits = self.request_hits + 1
+            return await requests[what]
+
+        key = (self.session_key(), what)
+        value = self.cache.get(key)
+        if value is not TTLCache.MISSING:
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(value)
+            requests[what] = future
+            return value
+
+        async def call():
+            self.upstream_calls = self.upstream_calls + 1
+            value = await fetch()
+            self.cache.set(key, value)
+            return value
+        requests[what] = asyncio.ensure_future(call())
+        try:
+            return await requests[what]
+        except Exception:
+            # Don't hang on to failures, like not being logged in.
+            del requests[what]
+            raise
+
+    async def fetch_user(self):
+        return await self.lookup("user", self.discordd.fetch_user)
+
+    async def fetch_guilds(self):
+        return await self.lookup("guilds", self.discordd.fetch_guilds)
+
+    def invalidate(self):
+        """
+           Forget everything cached for the current session.
+        """
+        key = quart.session.pop(OAUTH_CACHE_KEY, None)
+        if key is not None:
+            self.cache.invalidate((key, "user"))
+            self.cache.invalidate((key, "guilds"))
+        quart.g.pop("oauth_cache", None)
+
+    def stats(self):
+        ret = self.cache.stats()
+        ret["request_hits"] = self.request_hits
+        ret["upstream_calls"] = self.upstream_calls
+        return ret
+
 class Web(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
@@ -26,20 +112,78 @@ class Web(commands.Cog):
                                # installing in /static or having
                                # explicit handlers for.
 
-        app = Quart(__name__,
-                    template_folder="../web/templates",
-                    static_folder="../web/static")
+        # The Quart app and OAuth session aren't built until the web
+        # server is first started. See build_app.
+        self.app = None
+        self.discordd = None
+        self.oauth = None
+
+        # user id -> list of ids of our guilds they're in
+        self.membership = TTLCache(maxsize=10000, ttl=GUILD_INDEX_TTL)
+        # user id -> {guild id: Member, or None}, for the members we've
+        # had to ask discord for.
+        self.members = TTLCache(maxsize=10000, ttl=GUILD_INDEX_TTL)
+
+        # URL to your callback endpoint. The default is just localhost
+        # which won't work for anyone but you developing locally.
+        self.redirect_url = os.getenv("DISCORD_REDIRECT_URL",
+                                      "http://localhost:8080/callback/")
+        # The host the bot listens on, or if not set we listen on everything.
+        self.host = os.getenv("DISCORD_WEBSERVER_HOST", "0.0.0.0")
+        # The host port the bot listens on, or if not set we listen on 8080
+        self.port = os.getenv("DISCORD_WEBSERVER_PORT", "8080")
+        # The external URL
+        external_url = self.redirect_url.replace("/callback/",
+                                                 "").replace("/callback", "")
+        self.access_url = os.getenv("DISCORD_WEBSERVER_URL", external_url)
+        # The other processes of a cluster serve just /metrics and
+        # /profile, each on DISCORD_METRICS_PORT plus its cluster id (so
+        # the primary's would be DISCORD_METRICS_PORT itself, which by
+        # default is where the web server is). 0 turns them off.
+        self.metrics_port = int(os.getenv("DISCORD_METRICS_PORT", self.port))
+        self.metrics_shutdown = asyncio.Event()
+
+    async def cog_load(self):
+        # Only the primary process of a cluster runs the web server. It
+        # watches the config so the others can turn it on and off.
+        should_start = await self.bot.config.get_async(-1, WEB_SERVER_STATUS,
+                                                       WEB_SERVER_DEFAULT)
+        logger.debug(f"Web should start is {should_start}")
+        if self.bot.cluster.primary:
+            self.bot.config.listeners.append(self.config_changed)
+            if should_start == "True":
+                await self.start_webserver()
+        elif self.metrics_port:
+            self.start_metrics_server()
+
+    def start_metrics_server(self):
+        """
+           Serve this worker's metrics and profile, for when the bot runs
+           as several processes and the web server is in another one.
+        """
+        app = quart.Quart(__name__)
+        self.add_metrics_routes(app)
+        port = self.metrics_port + self.bot.cluster.cluster_id
+        self.metrics_shutdown = asyncio.Event()
+        self.bot.loop.create_task(app.run_task(self.host, port,
+                                               shutdown_trigger=self.metrics_shutdown.wait))
+        logger.info(f"Serving metrics on port {port}")
+
+    def build_app(self):
+        """
+           Build the Quart app, the discord OAuth session, and the routes.
+           This is where the heavy imports happen, so it's put off until
+           the web server is actually wanted.
+        """
+        app = quart.Quart(__name__,
+                          template_folder="../web/templates",
+                          static_folder="../web/static")
 
         app.secret_key = b"random bytes representing quart secret key"
         
         app.config["DISCORD_CLIENT_ID"] = os.getenv("APPLICATION_ID")   # Discord client ID.
         app.config["DISCORD_CLIENT_SECRET"] = os.getenv("CLIENT_SECRET")
-
-        # URL to your callback endpoint. The default is just localhost
-        # which won't work for anyone but you developing locally.
-        redirect_url = os.getenv("DISCORD_REDIRECT_URL",
-                                 "http://localhost:8080/callback/")
-        app.config["DISCORD_REDIRECT_URI"] = redirect_url
+        app.config["DISCORD_REDIRECT_URI"] = self.redirect_url
         
         app.config["DISCORD_BOT_TOKEN"] = os.getenv("DISCORD_TOKEN")   # Required to access bot resources.
 
@@ -48,27 +192,18 @@ class Web(commands.Cog):
 
         app.config["TEMPLATES_AUTO_RELOAD"] = True
 
-        discordd = DiscordOAuth2Session(app)
+        discordd = quart_discord.DiscordOAuth2Session(app)
 
         self.app = app
         self.discordd = discordd
-        
-        # The host the bot listens on, or if not set we listen on everything.
-        self.host = os.getenv("DISCORD_WEBSERVER_HOST", "0.0.0.0")
-        # The host port the bot listens on, or if not set we listen on 8080
-        self.port = os.getenv("DISCORD_WEBSERVER_PORT", "8080")
-        # The external URL
-        external_url = redirect_url.replace("/callback/",
-                                            "").replace("/callback", "")
-        self.access_url = os.getenv("DISCORD_WEBSERVER_URL", external_url)
-        
-        should_start = self.bot.config.get(-1, WEB_SERVER_STATUS,
-                                           WEB_SERVER_DEFAULT)
-        logger.debug(f"Web should start is {should_start}")
-        if should_start == "True":
-            self.start_webserver()
+        self.oauth = OAuthCache(discordd)
+        self.bot.caches["oauth"] = self.oauth.cache
+        self.bot.caches["guild_membership"] = self.membership
+        self.bot.caches["dashboard_members"] = self.members
+
+        requires_authorization = quart_discord.requires_authorization
 
-        # Defined inside init because we need self. This is sad and there's
+        # Defined in here because we need self. This is sad and there's
         # probably a better way but it'll do for now.
         @app.route("/")
         @app.route("/index.html")
@@ -85,7 +220,7 @@ class Web(commands.Cog):
                 cog_data['guild'] = guild
                 member = await self.get_member(guild)
             
-            return await render_template("index.html",**cog_data)
+            return await quart.render_template("index.html",**cog_data)
         
         @app.route("/login/")
         async def login():
@@ -93,36 +228,84 @@ class Web(commands.Cog):
 
         @app.route("/logout/")
         async def logout():
+            try:
+                user = await self.oauth.fetch_user()
+                self.membership.invalidate(user.id)
+                self.members.invalidate(user.id)
+            except Exception:
+                pass
+            self.oauth.invalidate()
             discordd.revoke()
-            return redirect(url_for(".home"))
+            return quart.redirect(quart.url_for(".home"))
         
         @app.route("/callback/")
         async def callback():
+            # A new login may well be someone else in the same browser,
+            # so nothing cached for the old one carries over, ours or
+            # quart_discord's own copy of the user.
+            discordd.users_cache.pop(discordd.user_id, None)
+            quart.session.pop("DISCORD_USER_ID", None)
             await discordd.callback()
+            self.oauth.invalidate()
             try:
-                redir = session['redirect']
-                del session['redirect']
-                return redirect(redir)
+                redir = quart.session['redirect']
+                del quart.session['redirect']
+                return quart.redirect(redir)
             except:            
-                return redirect("/")
+                return quart.redirect("/")
 
-        @app.errorhandler(Unauthorized)
+        @app.errorhandler(quart_discord.Unauthorized)
         async def redirect_unauthorized(e):
-            session['redirect'] = request.url
-            return redirect(url_for("login"))
+            quart.session['redirect'] = quart.request.url
+            return quart.redirect(quart.url_for("login"))
+
+        self.add_metrics_routes(app)
 
         # Yes, this duplicates the default, but without this in as an
         # explicit path handler, the catchall rule *with* the required
         # authorization does weird things when you try and log in.
         @app.route("/static/<path:path>")
         async def serve_files(path):
-            return await send_from_directory("static", path)
+            return await quart.send_from_directory("static", path)
+
+    def add_metrics_routes(self, app):
+        """
+           Add /metrics and /profile to a Quart app: the dashboard's, or
+           a worker's metrics-only one.
+        """
+        # Runtime metrics for Prometheus to scrape. There's no discord
+        # login in front of this, so it's limited to the addresses in
+        # DISCORD_METRICS_ALLOW (localhost by default, "*" for anyone).
+        @app.route("/metrics")
+        async def metrics():
+            if not self.metrics_allowed(quart.request.remote_addr):
+                quart.abort(403)
+            # Rendering calls the gauges' functions, some of which
+            # (psutil, cache stats) are best kept off the loop.
+            text = await self.bot.run_blocking(registry.render)
+            return quart.Response(text,
+                                  content_type="text/plain; version=0.0.4; charset=utf-8")
+
+        # The latest sampling profile (see the profile command), in
+        # collapsed-stack format. Stacks give away a fair bit about the
+        # code, so this has the same address check as /metrics.
+        @app.route("/profile")
+        async def profile():
+            if not self.metrics_allowed(quart.request.remote_addr):
+                quart.abort(403)
+            return quart.Response(self.bot.profiler.collapsed(),
+                                  content_type="text/plain; charset=utf-8")
+
+    def metrics_allowed(self, address):
+        allowed = [a.strip() for a in
+                   os.getenv("DISCORD_METRICS_ALLOW", "127.0.0.1,::1").split(",")]
+        return "*" in allowed or address in allowed
 
     async def get_user(self) -> User:
         """
            Return a discord User object for the current user.
         """
-        user = await self.discordd.fetch_user()
+        user = await self.oauth.fetch_user()
         if user is None:
             return None
         return self.bot.get_user(user.id)
@@ -132,45 +315,110 @@ class Web(commands.Cog):
            return the member object for the current user in the passed
            in guild.
         """
-        user = await self.discordd.fetch_user()
+        user = await self.oauth.fetch_user()
         if user is None:
             return None
         member = guild.get_member(user.id)
-        return member
+        if member is not None or self.bot.intents.members:
+            return member
+
+        # Without the members intent we don't keep member lists, so we
+        # have to ask discord. The guild index (built from the OAuth
+        # guild list) tells us whether there's any point, and the answer
+        # is kept for a while so page loads don't each cost a request.
+        if guild.id not in [g.id for g in await self.get_guilds(user)]:
+            return None
+        members = self.members.get(user.id)
+        if members is TTLCache.MISSING:
+            members = {}
+            self.members.set(user.id, members)
+        if guild.id not in members:
+            try:
+                members[guild.id] = await guild.fetch_member(user.id)
+            except discord.HTTPException:
+                members[guild.id] = None
+        return members[guild.id]
 
     async def get_guild(self) -> Guild:
         """
            Return a guild object for the currently selected guild
         """
-        guild_id = session.get('guild_id')
+        guild_id = quart.session.get('guild_id')
         if guild_id is None:
             return None
-        guild_id = int(guild_id)
-        for guild in self.bot.guilds:
-            if guild.id == guild_id:
-                # Found the guild. is the current user a member?
-                if await self.get_member(guild) is not None:
-                    return guild
-                else:
-                    return None
-        return None        
+        guild = self.bot.get_guild(int(guild_id))
+        if guild is None:
+            return None
+        # Found the guild. is the current user a member?
+        if await self.get_member(guild) is not None:
+            return guild
+        return None
 
     async def get_guilds(self, user):
         """
             Return guild objects for all guilds the user is in.
         """
-        guilds = []
+        guild_ids = self.membership.get(user.id)
+        if guild_ids is TTLCache.MISSING:
+            guild_ids = await self.find_guilds(user)
+            self.membership.set(user.id, guild_ids)
+        guilds = [self.bot.get_guild(guild_id) for guild_id in guild_ids]
+        return [guild for guild in guilds if guild is not None]
+
+    async def find_guilds(self, user):
+        """
+            Work out which of our guilds the user is in, returning their
+            ids. If it's the logged-in user we can use the guild list
+            discord gave us with their OAuth login, which is one request
+            however many guilds we're in. Otherwise we check our member
+            caches and ask discord about the rest, a few at a time.
+        """
+        try:
+            me = await self.oauth.fetch_user()
+            if me is not None and me.id == user.id:
+                return [guild.id for guild in await self.oauth.fetch_guilds()
+                        if self.bot.get_guild(guild.id) is not None]
+        except Exception as e:
+            logger.debug(f"No OAuth guild list, checking members: {e}")
+
+        guild_ids = []
+        unknown = []
         for guild in self.bot.guilds:
-            try:
-                m =  guild.get_member(user.id)
-                if m is None:
-                    m = await guild.fetch_member(user.id)
-                if m is not None:
-                    guilds.append(guild)
-            except Exception as e:
-                pass
-        return guilds
-        
+            if guild.get_member(user.id) is not None:
+                guild_ids.append(guild.id)
+            else:
+                unknown.append(guild)
+
+        limit = asyncio.Semaphore(MEMBER_FETCH_CONCURRENCY)
+        async def check(guild):
+            async with limit:
+                try:
+                    await guild.fetch_member(user.id)
+                    return guild.id
+                except Exception:
+                    return None
+        found = await asyncio.gather(*[check(guild) for guild in unknown])
+        guild_ids.extend([guild_id for guild_id in found
+                          if guild_id is not None])
+        return guild_ids
+
+    def config_changed(self, keys):
+        # Called from the scheduler's thread.
+        if (-1, WEB_SERVER_STATUS) in keys:
+            asyncio.run_coroutine_threadsafe(self.apply_web_setting(),
+                                             self.bot.loop)
+
+    async def apply_web_setting(self):
+        """
+           Start or stop the web server to match the config, after
+           another process in the cluster changed it.
+        """
+        should_run = await self.bot.config.get_async(-1, WEB_SERVER_STATUS,
+                                                     WEB_SERVER_DEFAULT) == "True"
+        if should_run and not self.webserver_running:
+            await self.start_webserver()
+        elif not should_run and self.webserver_running:
+            await self.stop_webserver()
 
     @commands.group(name="web", invoke_without_command=True)
     @commands.has_permissions(manage_guild=True)
@@ -178,6 +426,14 @@ class Web(commands.Cog):
         """
            Access the web interface.
         """
+        if not self.bot.cluster.primary:
+            should_run = await self.bot.config.get_async(-1, WEB_SERVER_STATUS,
+                                                         WEB_SERVER_DEFAULT)
+            if should_run == "True":
+                await ctx.send(f"The primary process is listening on {self.access_url}")
+            else:
+                await ctx.send("My webserver isn't currently running")
+            return
         if self.webserver_running:
             await ctx.send(f"I am listening on {self.access_url}")
         else:
@@ -190,10 +446,14 @@ class Web(commands.Cog):
         """
            Turn the web interface on
         """
+        if not self.bot.cluster.primary:
+            await self.bot.config.set_async(-1, WEB_SERVER_STATUS, "True")
+            await ctx.send("The primary process will start the webserver shortly")
+            return
         if self.webserver_running:
             await ctx.send("The webserver is already running")
             return
-        self.start_webserver()
+        await self.start_webserver()
         await ctx.send("The webserver is started")
         return
         
@@ -203,10 +463,14 @@ class Web(commands.Cog):
         """
            Turn the web interface off
         """
+        if not self.bot.cluster.primary:
+            await self.bot.config.set_async(-1, WEB_SERVER_STATUS, "False")
+            await ctx.send("The primary process will stop the webserver shortly")
+            return
         if not self.webserver_running:
             await ctx.send("The webserver isn't running")
             return
-        self.stop_webserver(manual_shutdown=True)
+        await self.stop_webserver(manual_shutdown=True)
         await ctx.send("The webserver is stopped")
         return
 
@@ -214,22 +478,33 @@ class Web(commands.Cog):
     # The cog_unload is called whenever a cog is unloaded. This
     # happens when a cog is explicitly unloaded, reloaded (which is
     # just unload/load), or the server shuts down cleanly.
-    def cog_unload(self):
-        self.stop_webserver()
+    async def cog_unload(self):
+        await self.stop_webserver()
+        self.metrics_shutdown.set()
+        if self.config_changed in self.bot.config.listeners:
+            self.bot.config.listeners.remove(self.config_changed)
+        self.bot.caches.pop("oauth", None)
+        self.bot.caches.pop("guild_membership", None)
+        self.bot.caches.pop("dashboard_members", None)
 
-    def start_webserver(self):
+    async def start_webserver(self):
+        if self.app is None:
+            self.build_app()
+        # A fresh event each time, as the last one was set by the last
+        # shutdown.
+        self.shutdown_event = asyncio.Event()
         self.bot.loop.create_task(self.app.run_task(self.host, self.port,
                                                     shutdown_trigger=self.shutdown_event.wait))
         self.webserver_running = True
-        self.bot.config.set(-1, WEB_SERVER_STATUS, "True")
+        await self.bot.config.set_async(-1, WEB_SERVER_STATUS, "True")
 
-    def stop_webserver(self, manual_shutdown=False):
+    async def stop_webserver(self, manual_shutdown=False):
         # trigger the shutdown event so the webserver, which is listening
         # on it, can cleanly shut down.
         self.shutdown_event.set()
         self.webserver_running = False
         if manual_shutdown:
-            self.bot.config.set(-1, WEB_SERVER_STATUS, "False")
+            await self.bot.config.set_async(-1, WEB_SERVER_STATUS, "False")
         
 async def setup(bot):
     await bot.add_cog(Web(bot))
@@ -1,11 +1,113 @@
-from sqlalchemy import create_engine, event, MetaData
+import os
+import time
+
+from sqlalchemy import bindparam, create_engine, event, exc, insert, select, update, MetaData
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+from src.logging import logger
+from src.utils.metrics import registry
+
+# The async engine is optional; it needs aiosqlite (or the async driver
+# for whatever database you're using) installed.
+try:
+    import aiosqlite
+    from sqlalchemy.ext.asyncio import create_async_engine
+except ImportError:
+    create_async_engine = None
+
+db_queries = registry.counter("bot_db_queries_total",
+                              "Database statements executed", ("op",))
+db_query_seconds = registry.histogram("bot_db_query_seconds",
+                                      "Time spent executing database statements",
+                                      ("op",))
+
+# The start time goes on the statement's execution context, which goes
+# away with the statement. (Not on the connection: a statement that
+# raises never gets to after_execute, and would leave it there.)
+def before_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+def after_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_query_start", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    op = statement.split(None, 1)[0].lower() if statement else ""
+    db_queries.inc(op=op)
+    db_query_seconds.observe(elapsed, op=op)
+
+class GenericUpsert:
+    """
+       Insert-or-update for databases without a native upsert: for each
+       row, an UPDATE, and then an INSERT if the UPDATE didn't find it.
+       It isn't atomic the way the native versions are, so if someone
+       else inserts the same key in between, the INSERT fails and we go
+       round again.
+
+       It's executed just like the statements Database.upsert builds
+       (conn.execute(upsert, params)), by way of _execute_on_connection,
+       which is how Connection.execute runs any statement.
+    """
+    def __init__(self, table, keys, increment=(), update_=()):
+        self.table = table
+        self.keys = list(keys)
+        where = [table.c[k] == bindparam(f"key_{k}") for k in self.keys]
+        changes = {}
+        for name in increment:
+            changes[name] = table.c[name] + bindparam(f"new_{name}")
+        for name in update_:
+            changes[name] = bindparam(f"new_{name}")
+        self.changes = list(changes)
+        if changes:
+            self.update = update(table).where(*where).values(changes)
+        else:
+            self.update = None
+        self.exists = select(table.c[self.keys[0]]).where(*where)
+        self.insert = insert(table)
+
+    def _execute_on_connection(self, connection, distilled_params,
+                               execution_options):
+        result = None
+        for row in distilled_params:
+            result = self.execute_row(connection, row)
+        return result
+
+    def execute_row(self, connection, row):
+        keys = {f"key_{k}": row[k] for k in self.keys}
+        while True:
+            if self.update is not None:
+                result = connection.execute(
+                    self.update,
+                    {**keys, **{f"new_{name}": row[name]
+                                for name in self.changes}})
+                if result.rowcount:
+                    return result
+            elif connection.execute(self.exists, keys).first() is not None:
+                return None
+            try:
+                with connection.begin_nested():
+                    return connection.execute(self.insert, row)
+            except exc.IntegrityError:
+                continue
 
 class Database:
-    def __init__(self):
-        # Parameterize this if you want to use another database engine.
-        self.engine = create_engine('sqlite:///Bot.db')
+    def __init__(self, url=None):
+        # Set DATABASE_URL if you want to use another database engine.
+        if url is None:
+            url = os.getenv("DATABASE_URL", "sqlite:///Bot.db")
+        self.engine = create_engine(url)
         self.meta_data = MetaData()
 
+        # An async engine on the same database, so coroutines can do
+        # database work without stalling the event loop. None if the
+        # async driver isn't installed, in which case the async helpers
+        # fall back to running the sync ones in a thread.
+        self.async_engine = None
+        if create_async_engine is not None and url.startswith("sqlite://"):
+            self.async_engine = create_async_engine(
+                url.replace("sqlite://", "sqlite+aiosqlite://", 1))
+
         def set_pragmas(db, conn_record):
             """
                Sets some SQLite pragmas for our DB connections. This needs
@@ -15,15 +117,94 @@ class Database:
                These make database access a little more forgiving and, most
                importantly, make sure foreign keys are respected.
             """
+            # Lets the stats retention job hand freed pages back with
+            # incremental_vacuum. Only takes effect on a new database (or
+            # after a full VACUUM, which safe_start does if it has to).
+            db.execute("pragma auto_vacuum = INCREMENTAL")
             db.execute("pragma journal_mode = WAL")
             db.execute("pragma busy_timeout = 5000")
             db.execute("pragma synchronous = NORMAL")
             db.execute("pragma foreign_keys = true")
 
-        event.listen(self.engine, 'connect', set_pragmas)
+        engines = [self.engine]
+        if self.async_engine is not None:
+            engines.append(self.async_engine.sync_engine)
+        for engine in engines:
+            event.listen(engine, 'connect', set_pragmas)
+            # Count and time every statement, for the metrics page.
+            event.listen(engine, 'before_cursor_execute', before_execute)
+            event.listen(engine, 'after_cursor_execute', after_execute)
 
     def safe_start(self):
         """
             Make sure we're all set, and create any tables we need.
         """
         self.meta_data.create_all(self.engine, checkfirst=True)
+        self.enable_auto_vacuum()
+
+    def enable_auto_vacuum(self):
+        """
+            The auto_vacuum pragma only changes an existing SQLite
+            database after a full VACUUM, so a database made before we set
+            it never gives pages back. Do that VACUUM, once; afterwards
+            the database reports incremental and we leave it alone.
+        """
+        if self.engine.dialect.name != "sqlite":
+            return
+        engine = self.engine.execution_options(isolation_level="AUTOCOMMIT")
+        with engine.connect() as conn:
+            if conn.exec_driver_sql("pragma auto_vacuum").scalar() != 0:
+                return
+            logger.warning("Database has auto_vacuum off, running a one-off "
+                           "VACUUM to turn it on. This may take a while.")
+            start = time.perf_counter()
+            conn.exec_driver_sql("vacuum")
+            mode = conn.exec_driver_sql("pragma auto_vacuum").scalar()
+        if mode == 0:
+            logger.warning("VACUUM didn't turn auto_vacuum on; the stats "
+                           "retention job won't be able to free space.")
+        else:
+            logger.info(f"VACUUM took {time.perf_counter() - start:.1f}s")
+
+    def upsert(self, table, keys, increment=(), update=()):
+        """
+            Build a single-statement insert-or-update for table. keys are
+            the names of the columns making up the conflict target (the
+            primary key, usually). On conflict the columns named in
+            increment have the new value added to the existing one and
+            the columns named in update are overwritten. If neither is
+            given then conflicting rows are left alone.
+
+            The statement has no values attached, so execute it with a
+            dict of parameters, or a list of them for an executemany.
+            Dialects other than SQLite, PostgreSQL and MySQL get a
+            GenericUpsert, which executes the same way.
+        """
+        dialect = self.engine.dialect.name
+        if dialect == "mysql" or dialect == "mariadb":
+            stmt = mysql.insert(table)
+            new = stmt.inserted
+        elif dialect == "sqlite":
+            stmt = sqlite.insert(table)
+            new = stmt.excluded
+        elif dialect == "postgresql":
+            stmt = postgresql.insert(table)
+            new = stmt.excluded
+        else:
+            # Slower, but works anywhere.
+            return GenericUpsert(table, keys, increment, update)
+
+        changes = {}
+        for name in increment:
+            changes[name] = table.c[name] + new[name]
+        for name in update:
+            changes[name] = new[name]
+
+        if dialect == "mysql" or dialect == "mariadb":
+            if not changes:
+                # MySQL has no DO NOTHING; a no-op assignment does the job.
+                changes = {keys[0]: table.c[keys[0]]}
+            return stmt.on_duplicate_key_update(**changes)
+        if not changes:
+            return stmt.on_conflict_do_nothing(index_elements=keys)
+        return stmt.on_conflict_do_update(index_elements=keys, set_=changes)
@@ -1,8 +1,10 @@
+import atexit
 import logging
 import os
+import queue
 import sys
 
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 
 # No exception handler -- not having a logging directory and not being
 # able to create one is a fatal error.
@@ -10,42 +12,88 @@ os.makedirs("./logs", exist_ok=True)
 
 formatter = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s | %(funcName)s(): %(message)s')
 
-_log_stdout = logging.StreamHandler(sys.stdout)
-_log_stdout.setLevel(logging.DEBUG)
-_log_stdout.setFormatter(formatter)
-
-_log_debug = TimedRotatingFileHandler(filename='logs/debug-level.log',
-                                       when='W0', encoding='utf-8',
-                                       backupCount=5, utc=True)
-_log_debug.setLevel(logging.DEBUG)
-_log_debug.setFormatter(formatter)
-
-_log_info = TimedRotatingFileHandler(filename='logs/info-level.log',
-                                     when='W0', encoding='utf-8',
-                                     backupCount=5, utc=True)
-_log_info.setLevel(logging.INFO)
-_log_info.setFormatter(formatter)
-
-_log_warning = TimedRotatingFileHandler(filename='logs/warning-level.log',
-                                         when='W0', encoding='utf-8',
-                                         backupCount=5, utc=True)
-_log_warning.setLevel(logging.WARNING)
-_log_warning.setFormatter(formatter)
-
-_log_error = TimedRotatingFileHandler(filename='logs/error-level.log',
-                                         when='W0', encoding='utf-8',
-                                         backupCount=5, utc=True)
-_log_error.setLevel(logging.ERROR)
-_log_error.setFormatter(formatter)
+def log_suffix():
+    """
+       What goes on the end of this process's log file names. When the bot
+       runs as several processes each one (and the cluster.py launcher)
+       writes its own files, named by LOG_NAME or else the cluster id,
+       since processes rotating the same file lose each other's lines.
+    """
+    name = os.getenv("LOG_NAME")
+    if not name and int(os.getenv("CLUSTER_SIZE", "1")) > 1:
+        name = os.getenv("CLUSTER_ID", "0")
+    return f"-{name}" if name else ""
+
+def make_handlers(directory="logs"):
+    """
+       Build our log sinks: stdout, plus a weekly-rotated file for each of
+       debug, info, warning and error level and up.
+    """
+    suffix = log_suffix()
+    handlers = []
+
+    log_stdout = logging.StreamHandler(sys.stdout)
+    log_stdout.setLevel(logging.DEBUG)
+    log_stdout.setFormatter(formatter)
+    handlers.append(log_stdout)
+
+    for name, level in (("debug", logging.DEBUG), ("info", logging.INFO),
+                        ("warning", logging.WARNING),
+                        ("error", logging.ERROR)):
+        handler = TimedRotatingFileHandler(filename=f'{directory}/{name}-level{suffix}.log',
+                                           when='W0', encoding='utf-8',
+                                           backupCount=5, utc=True)
+        handler.setLevel(level)
+        handler.setFormatter(formatter)
+        handlers.append(handler)
+
+    return handlers
+
+class BoundedQueueHandler(QueueHandler):
+    """
+       A queue handler for a bounded queue. When the queue's full, records
+       below WARNING are dropped (and counted) if the policy is "drop",
+       while warnings and up, and everything under the "block" policy,
+       wait for room. We'd rather lose a debug line than stall the bot,
+       but not an error.
+    """
+    def __init__(self, log_queue, policy="drop"):
+        super().__init__(log_queue)
+        self.policy = policy
+        self.dropped = 0
+
+    def enqueue(self, record):
+        if self.policy == "block" or record.levelno >= logging.WARNING:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped = self.dropped + 1
+
+# Writing to the sinks happens on a background thread, so a log call from
+# the event loop only has to format the record and queue it. The queue is
+# bounded by LOG_QUEUE_SIZE, and LOG_QUEUE_POLICY ("drop" or "block") says
+# what happens when it fills up.
+log_queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+queue_handler = BoundedQueueHandler(log_queue,
+                                    os.getenv("LOG_QUEUE_POLICY", "drop"))
+handlers = make_handlers()
+listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+listener.start()
+# Make sure whatever's queued gets written out when we exit.
+atexit.register(listener.stop)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-# Attach our log sinks to the logger object
-logger.addHandler(_log_stdout)
-logger.addHandler(_log_debug)
-logger.addHandler(_log_info)
-logger.addHandler(_log_warning)
-logger.addHandler(_log_error)
+# Attach our log sinks to the logger object, by way of the queue
+logger.addHandler(queue_handler)
 
 logger.propagate = False
+
+def dropped_records():
+    """
+       How many log records have been dropped because the queue was full.
+    """
+    return queue_handler.dropped
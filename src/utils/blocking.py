@@ -0,0 +1,180 @@
+# Running blocking work off the event loop.
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from src.logging import logger
+from src.utils.metrics import registry
+
+# Threads for blocking calls (database, psutil, file I/O and the like),
+# and processes for CPU-heavy work. No process pool unless
+# BLOCKING_PROCESSES is set.
+BLOCKING_THREADS = int(os.getenv("BLOCKING_THREADS")
+                       or min(32, (os.cpu_count() or 1) + 4))
+BLOCKING_PROCESSES = int(os.getenv("BLOCKING_PROCESSES", "0"))
+# How long shutdown waits for calls that are already running, in seconds.
+BLOCKING_SHUTDOWN_TIMEOUT = float(os.getenv("BLOCKING_SHUTDOWN_TIMEOUT", "10"))
+
+# The pool for the running bot, for run_blocking and @blocking to find.
+current = None
+
+def name_of(fn):
+    while isinstance(fn, functools.partial):
+        fn = fn.func
+    return getattr(fn, "__qualname__", None) or type(fn).__name__
+
+class BlockingPool:
+    """
+       Where the bot runs blocking calls, so they don't hold up the event
+       loop. Ordinary calls go to a thread pool of BLOCKING_THREADS
+       threads; calls that are CPU-bound, and whose function and
+       arguments can be pickled, can ask for the process pool
+       (BLOCKING_PROCESSES processes) to get out from under the GIL.
+
+       How many calls are waiting for a thread, how long they waited and
+       how long they ran are all exported as metrics, labelled by the
+       function called. A call that spends a while waiting means the pool
+       is too small, or something's hogging it.
+
+       Thread pool calls run in a copy of the caller's context, the same
+       as asyncio.to_thread, so context variables carry over.
+    """
+    def __init__(self, threads=BLOCKING_THREADS, processes=BLOCKING_PROCESSES):
+        global current
+        self.threads = ThreadPoolExecutor(threads,
+                                          thread_name_prefix="blocking")
+        self.processes = ProcessPoolExecutor(processes) if processes else None
+        self.closing = False
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+
+        self.wait_seconds = registry.histogram("bot_blocking_wait_seconds",
+                                               "Time blocking calls waited for a worker",
+                                               ("pool", "function"))
+        self.run_seconds = registry.histogram("bot_blocking_seconds",
+                                              "Blocking call run time",
+                                              ("pool", "function"))
+        self.errors = registry.counter("bot_blocking_errors_total",
+                                       "Blocking calls that raised",
+                                       ("pool", "function"))
+        registry.gauge("bot_blocking_queued", "Blocking calls waiting for a thread",
+                       fn=lambda: self.queued)
+        registry.gauge("bot_blocking_running", "Blocking calls running in a thread",
+                       fn=lambda: self.running)
+        current = self
+
+    async def run(self, fn, *args, process=False, **kwargs):
+        """
+           Call fn(*args, **kwargs) in the thread pool, or with
+           process=True the process pool if there is one, and wait for
+           the result.
+
+           **Example:** `rss = await bot.run_blocking(mem_usage)`
+        """
+        if self.closing:
+            raise RuntimeError("The blocking pool is shutting down")
+        name = name_of(fn)
+        if process and self.processes is not None:
+            pool = "process"
+            work = self.processes.submit(fn, *args, **kwargs)
+        else:
+            pool = "thread"
+            context = contextvars.copy_context()
+            call = functools.partial(context.run, fn, *args, **kwargs)
+            with self.lock:
+                self.queued = self.queued + 1
+            work = self.threads.submit(self.timed, call, name,
+                                       time.perf_counter())
+
+        start = time.perf_counter()
+        future = asyncio.wrap_future(work)
+        self.pending.add(future)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # If it never got a thread it never will, so it's not queued
+            # any more.
+            if work.cancel() and pool == "thread":
+                with self.lock:
+                    self.queued = self.queued - 1
+            raise
+        except Exception:
+            self.errors.inc(pool=pool, function=name)
+            raise
+        finally:
+            self.pending.discard(future)
+            if pool == "process":
+                # There's no telling wait from run time for a process, so
+                # it's all run time.
+                self.run_seconds.observe(time.perf_counter() - start,
+                                         pool=pool, function=name)
+
+    def timed(self, call, name, submitted):
+        started = time.perf_counter()
+        with self.lock:
+            self.queued = self.queued - 1
+            self.running = self.running + 1
+        self.wait_seconds.observe(started - submitted, pool="thread",
+                                  function=name)
+        try:
+            return call()
+        finally:
+            with self.lock:
+                self.running = self.running - 1
+            self.run_seconds.observe(time.perf_counter() - started,
+                                     pool="thread", function=name)
+
+    async def shutdown(self, timeout=BLOCKING_SHUTDOWN_TIMEOUT):
+        """
+           Stop taking new calls and give the ones in progress up to
+           timeout seconds to finish. Anything still queued after that
+           is cancelled; anything still running is left to finish on its
+           own, since threads can't be stopped.
+        """
+        self.closing = True
+        if self.pending:
+            done, waiting = await asyncio.wait(list(self.pending),
+                                               timeout=timeout)
+            if waiting:
+                logger.warning(f"{len(waiting)} blocking calls still running at shutdown")
+        self.threads.shutdown(wait=False, cancel_futures=True)
+        if self.processes is not None:
+            self.processes.shutdown(wait=False, cancel_futures=True)
+
+async def run_blocking(fn, *args, process=False, **kwargs):
+    """
+       Run fn(*args, **kwargs) in the bot's blocking pool. Code that
+       doesn't have the bot handy can use this; without a pool (in a
+       script, say) it falls back to asyncio.to_thread.
+    """
+    if current is None or current.closing:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    return await current.run(fn, *args, process=process, **kwargs)
+
+def blocking(fn):
+    """
+       Decorator that turns a blocking function into a coroutine that
+       runs it in the bot's blocking pool. The original is still there
+       as .sync, for callers that are already off the loop.
+
+       **Example:**
+       ```
+       @blocking
+       def export(path):
+           ...
+
+       await export("stats.csv")
+       ```
+    """
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await run_blocking(fn, *args, **kwargs)
+    wrapper.sync = fn
+    return wrapper
@@ -0,0 +1,117 @@
+# A small in-process cache with optional size and age limits.
+import threading
+import time
+
+from collections import OrderedDict
+
+class TTLCache:
+    """
+       A dict-ish cache that can be bounded by size (least recently used
+       entries get pushed out first) and by age. A maxsize or ttl of None
+       means no limit. Hits and misses are counted so we can see how well
+       it's doing.
+
+       It's guarded by a lock, since things like the stats flush job run
+       on worker threads.
+
+       Anything that changes the cache other than fill() bumps its
+       generation. Code that reads a value from somewhere slow takes the
+       generation first and hands it to fill(), which leaves the cache
+       alone if a newer value (or an invalidation) came in meanwhile.
+    """
+    MISSING = object()
+
+    def __init__(self, maxsize=None, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0
+
+    def get(self, key, default=MISSING):
+        """
+           Return the cached value for key, or default (TTLCache.MISSING
+           unless given) if it isn't cached or has expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits = self.hits + 1
+                    return value
+                del self.entries[key]
+            self.misses = self.misses + 1
+            return default
+
+    def set(self, key, value):
+        with self.lock:
+            self.generation = self.generation + 1
+            self.store(key, value)
+
+    def update(self, items):
+        """
+           Set a whole batch of key/value pairs at once.
+        """
+        with self.lock:
+            self.generation = self.generation + 1
+            for key, value in items:
+                self.store(key, value)
+
+    def fill(self, items, generation):
+        """
+           Cache a batch of key/value pairs read while the cache was at
+           generation, unless something has changed it since. Returns
+           whether they went in.
+        """
+        with self.lock:
+            if self.generation != generation:
+                return False
+            for key, value in items:
+                self.store(key, value)
+            return True
+
+    def store(self, key, value):
+        # Caller holds the lock.
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        if self.maxsize is not None:
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions = self.evictions + 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self.generation = self.generation + 1
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation = self.generation + 1
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return self.hits / total
+
+    def stats(self):
+        """
+           Counters for monitoring, as a dict.
+        """
+        return {"size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hit_ratio()}
@@ -0,0 +1,52 @@
+# Where this process fits when the bot runs as several processes.
+import os
+
+def split_shards(shard_count, processes):
+    """
+       Split shards 0..shard_count-1 into processes contiguous runs, as
+       evenly as they'll go.
+    """
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ret = []
+    start = 0
+    for n in range(processes):
+        end = start + size + (1 if n < extra else 0)
+        ret.append(list(range(start, end)))
+        start = end
+    return ret
+
+class Cluster:
+    """
+       This process's place in the cluster, from the environment the
+       launcher (cluster.py) sets up for each worker:
+
+       CLUSTER_ID: this process's number, from 0.
+       CLUSTER_SIZE: how many processes there are.
+       SHARD_COUNT: total shards across all of them. Unset means let
+                    discord pick.
+       SHARD_IDS: the shards this process runs, comma separated. Unset
+                  means all of them.
+
+       Run on its own the bot is a one-process cluster running every
+       shard. Process 0 is the primary, and is the one that runs the web
+       server and the once-a-cluster jobs like stats retention.
+    """
+    def __init__(self):
+        self.cluster_id = int(os.getenv("CLUSTER_ID", "0"))
+        self.size = int(os.getenv("CLUSTER_SIZE", "1"))
+        count = os.getenv("SHARD_COUNT", "")
+        self.shard_count = int(count) if count else None
+        ids = os.getenv("SHARD_IDS", "")
+        self.shard_ids = [int(i) for i in ids.split(",")] if ids else None
+
+    @property
+    def primary(self):
+        return self.cluster_id == 0
+
+    @property
+    def clustered(self):
+        return self.size > 1
+
+    def __repr__(self):
+        return f"<Cluster(cluster_id={self.cluster_id}, size={self.size}, shard_count={self.shard_count}, shard_ids={self.shard_ids})>"
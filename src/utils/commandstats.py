@@ -0,0 +1,116 @@
+# Per-command timing and error tracking.
+import threading
+
+from collections import deque
+
+from src.utils.metrics import percentile
+
+# How many recent run times we keep per command for the percentiles.
+SAMPLES_PER_COMMAND = 1024
+# How often, in seconds, call counts get written to the stats tracker.
+COMMAND_STATS_FLUSH_INTERVAL = 60
+
+class CommandTiming:
+    """
+       What we know about one command: lifetime call and error counts, and
+       a ring buffer of its most recent run times.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.samples = deque(maxlen=SAMPLES_PER_COMMAND)
+
+class CommandStats:
+    """
+       Tracks how often each command runs, how often it fails, and how
+       long it takes. Recording is just a couple of counter bumps and a
+       deque append, so it's cheap enough to do on every invocation;
+       the counts are passed on to the stats tracker in a batch every
+       COMMAND_STATS_FLUSH_INTERVAL seconds as the command_calls,
+       command_errors and command_ms stats, with the command name as the
+       substat.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.commands = {}
+        self.lock = threading.Lock()
+        # Counts since the last flush, keyed by (guild_id, command).
+        self.pending = {}
+        bot.sched.add_job(self.flush, "interval",
+                          seconds=COMMAND_STATS_FLUSH_INTERVAL,
+                          id="commands:flush", replace_existing=True,
+                          executor="threadpool", coalesce=True,
+                          max_instances=1)
+
+    def record(self, name, guild_id, seconds, failed):
+        with self.lock:
+            timing = self.commands.get(name)
+            if timing is None:
+                timing = CommandTiming()
+                self.commands[name] = timing
+            timing.calls = timing.calls + 1
+            timing.samples.append(seconds)
+            if failed:
+                timing.errors = timing.errors + 1
+
+            key = (guild_id, name)
+            calls, errors, ms = self.pending.get(key, (0, 0, 0))
+            self.pending[key] = (calls + 1, errors + (1 if failed else 0),
+                                 ms + int(seconds * 1000))
+
+    def record_failure(self, name, guild_id):
+        """
+           Count a call that failed before the command itself ran (a check
+           or argument conversion), so there's no run time to keep.
+        """
+        with self.lock:
+            timing = self.commands.get(name)
+            if timing is None:
+                timing = CommandTiming()
+                self.commands[name] = timing
+            timing.calls = timing.calls + 1
+            timing.errors = timing.errors + 1
+
+            key = (guild_id, name)
+            calls, errors, ms = self.pending.get(key, (0, 0, 0))
+            self.pending[key] = (calls + 1, errors + 1, ms)
+
+    def flush(self):
+        """
+           Hand the counts gathered since the last flush to the stats
+           tracker.
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        deltas = []
+        for (guild_id, name), (calls, errors, ms) in pending.items():
+            deltas.append((guild_id, "command_calls", calls, name))
+            deltas.append((guild_id, "command_ms", ms, name))
+            if errors:
+                deltas.append((guild_id, "command_errors", errors, name))
+        if deltas:
+            self.bot.stats.increment_many(deltas)
+
+    def summary(self):
+        """
+           A list of dicts, one per command, with its name, calls, errors
+           and p50/p95/p99 run times in seconds.
+        """
+        with self.lock:
+            items = [(name, timing.calls, timing.errors, list(timing.samples))
+                     for name, timing in self.commands.items()]
+        ret = []
+        for name, calls, errors, samples in items:
+            samples.sort()
+            ret.append({"name": name, "calls": calls, "errors": errors,
+                        "p50": percentile(samples, 0.50),
+                        "p95": percentile(samples, 0.95),
+                        "p99": percentile(samples, 0.99)})
+        return ret
+
+    def slowest(self, count=10):
+        """
+           The count slowest commands, by 95th percentile run time.
+        """
+        return sorted(self.summary(), key=lambda e: -e["p95"])[:count]
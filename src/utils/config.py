@@ -1,10 +1,13 @@
 # Get and set config info.
+import os
 import sqlalchemy
+import time
 
-from sqlalchemy.orm import declarative_base, Session
+from sqlalchemy.orm import declarative_base
 from sqlalchemy import Column, Integer, String, Table
-from sqlalchemy import select
+from sqlalchemy import bindparam, delete, func, insert, select
 from src.logging import logger
+from src.utils.cache import TTLCache
 
 
 Base = declarative_base()
@@ -20,30 +23,175 @@ class ConfigEntry(Base):
     def __repr__(self):
         return f"<ConfigEntry(guild_id={self.guild_id}, setting={self.setting}, value={self.value})>"
 
+class ConfigChange(Base):
+    """
+       A log of which settings have been changed, so that when the bot
+       runs as several processes each can tell which of its cached
+       settings are out of date. AUTOINCREMENT so that ids never get
+       reused once old entries are pruned.
+    """
+    __tablename__ = "config_change"
+    __table_args__ = {"sqlite_autoincrement": True}
+    id = Column(Integer, primary_key = True, autoincrement = True)
+    guild_id = Column(Integer)
+    setting = Column(String(30))
+    changed_at = Column(Integer)
+
+    def __repr__(self):
+        return f"<ConfigChange(id={self.id}, guild_id={self.guild_id}, setting={self.setting})>"
+
+class ConfigPeer(Base):
+    """
+       How far through the change log each process of a cluster has got,
+       so a process can tell when the others have applied a change.
+    """
+    __tablename__ = "config_peer"
+    cluster_id = Column(Integer, primary_key = True)
+    last_change = Column(Integer)
+    seen_at = Column(Integer)
+
+    def __repr__(self):
+        return f"<ConfigPeer(cluster_id={self.cluster_id}, last_change={self.last_change})>"
+
+# How often, in seconds, each process checks the change log, and how long
+# the primary keeps entries in it.
+CONFIG_POLL_INTERVAL = float(os.getenv("CONFIG_POLL_INTERVAL", "2"))
+CONFIG_CHANGE_KEEP = 3600
+# How long wait_for_peers waits for the other processes, in seconds.
+CONFIG_PEER_TIMEOUT = float(os.getenv("CONFIG_PEER_TIMEOUT",
+                                      str(CONFIG_POLL_INTERVAL * 10)))
+
 class Config:
     """
        The config class gives access to configuration information for the
        bot. Both bot-wide and per-guild config data can be stored and
        recalled.
+
+       Settings are cached in memory, keyed by (guild_id, setting). The
+       cache is loaded in one go at startup and kept up to date by set(),
+       so most reads never touch the database. CONFIG_CACHE_SIZE and
+       CONFIG_CACHE_TTL (seconds) put bounds on it for bots in a lot of
+       guilds; by default it's unbounded.
+
+       When the bot runs as several processes, every change is also
+       written to the config_change table, and each process checks it
+       every CONFIG_POLL_INTERVAL seconds and drops the changed settings
+       from its cache. Anything that keeps a copy of a setting somewhere
+       else can add a function to listeners; it's called (from the
+       scheduler's thread) with the set of (guild_id, setting) keys that
+       changed. Once they've run, the process records how far through the
+       log it's got in config_peer, which is what wait_for_peers checks.
+
+       The queries are built once, up front, with bound parameters, and
+       run on plain connections rather than ORM sessions, since a cache
+       miss or a set is on the hot path for busy guilds and building the
+       statement and session each time cost more than SQLite did.
     """
     def __init__(self, bot):
         self.bot = bot
         # This can go once the code's running everywhere so the DB is up to
         # date everywhere.
         self.init_tables(bot)
+        self.prepare()
+
+        maxsize = int(os.getenv("CONFIG_CACHE_SIZE", "0")) or None
+        ttl = float(os.getenv("CONFIG_CACHE_TTL", "0")) or None
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+        self.changelog = bot.cluster.clustered
+        self.listeners = []
+        self.last_change = 0
+        if self.changelog:
+            # Note where the log is before loading the cache, so nothing
+            # changed in between gets missed.
+            with bot.engine.begin() as conn:
+                self.last_change = conn.execute(
+                    select(func.max(ConfigChange.__table__.c.id))).scalar() or 0
+                # We haven't cached anything yet, so we're as up to date
+                # as the log is.
+                conn.execute(self.peer_statement, self.peer_row())
+            bot.sched.add_job(self.poll_changes, "interval",
+                              seconds=CONFIG_POLL_INTERVAL,
+                              id="config:poll", replace_existing=True,
+                              executor="threadpool", coalesce=True,
+                              max_instances=1)
+        self.warm()
         
     def init_tables(self, bot):
         db = bot.database
         tables = bot.database.meta_data.tables
-        if tables.get("config_entry") is not None:
-            return
-
-        db.config_entry = Table("config_entry", db.meta_data,
-                                Column("guild_id", Integer, primary_key=True),
-                                Column("setting", String(30), primary_key=True),
-                                Column("value", String(30)))
+        if tables.get("config_change") is None:
+            db.config_change = ConfigChange.__table__.to_metadata(db.meta_data)
+        if tables.get("config_peer") is None:
+            db.config_peer = ConfigPeer.__table__.to_metadata(db.meta_data)
+        if tables.get("config_entry") is None:
+            db.config_entry = Table("config_entry", db.meta_data,
+                                    Column("guild_id", Integer,
+                                           primary_key=True),
+                                    Column("setting", String(30),
+                                           primary_key=True),
+                                    Column("value", String(30)))
         db.safe_start()
-        
+
+    def prepare(self):
+        """
+            Build the statements the hot paths use. Each call just
+            supplies the parameters, and since it's the same statement
+            object every time SQLAlchemy finds its compiled form in the
+            engine's cache straight away.
+        """
+        entries = ConfigEntry.__table__
+        changes = ConfigChange.__table__
+        db = self.bot.database
+        # Looks up a single setting.
+        self.get_statement = select(entries.c.value).where(
+            entries.c.guild_id == bindparam("guild_id"),
+            entries.c.setting == bindparam("setting"))
+        # Looks up a list of settings for a guild.
+        self.get_many_statement = select(entries.c.setting,
+                                         entries.c.value).where(
+            entries.c.guild_id == bindparam("guild_id"),
+            entries.c.setting.in_(bindparam("settings", expanding=True)))
+        # Looks up all of a guild's settings.
+        self.get_guild_statement = select(entries.c.setting,
+                                          entries.c.value).where(
+            entries.c.guild_id == bindparam("guild_id"))
+        # Records a default for a setting nobody has set, leaving it
+        # alone if it's already there.
+        self.default_statement = db.upsert(entries, ["guild_id", "setting"])
+        # Sets a setting.
+        self.set_statement = db.upsert(entries, ["guild_id", "setting"],
+                                       update=["value"])
+        # Records settings as changed in the change log, reads the log,
+        # and prunes it.
+        self.change_statement = insert(changes)
+        self.poll_statement = select(changes.c.id, changes.c.guild_id,
+                                     changes.c.setting).where(
+            changes.c.id > bindparam("last_change")).order_by(changes.c.id)
+        self.prune_statement = delete(changes).where(
+            changes.c.changed_at < bindparam("cutoff"))
+        # Records how far through the log this process has got, and reads
+        # everyone's.
+        peers = ConfigPeer.__table__
+        self.peer_statement = db.upsert(peers, ["cluster_id"],
+                                        update=["last_change", "seen_at"])
+        self.peers_statement = select(peers.c.cluster_id, peers.c.last_change)
+
+    def warm(self):
+        """
+            Load the config table into the cache with a single query. If
+            the cache is bounded we stop once it's full.
+        """
+        entries = ConfigEntry.__table__
+        s = select(entries.c.guild_id, entries.c.setting, entries.c.value)
+        if self.cache.maxsize is not None:
+            s = s.limit(self.cache.maxsize)
+        generation = self.cache.generation
+        with self.bot.engine.connect() as conn:
+            items = [((r[0], r[1]), r[2]) for r in conn.execute(s)]
+        self.cache.fill(items, generation)
+        logger.debug(f"Config cache warmed with {len(items)} settings")
+
     def get(self, guild_id, setting, default=None):
         """
             Get a config value. If it doesn't exist then create it for later
@@ -58,23 +206,62 @@ class Config:
         if guild_id is None:
             guild_id = -1
         setting = setting.lower()
-        
-        with Session(self.bot.engine) as session:
-            c = None
-            s = select(ConfigEntry).where(ConfigEntry.guild_id == guild_id,
-                                          ConfigEntry.setting == setting)
-            rows = session.execute(s)
-            for r in rows.unique():
-                return r[0].value
-
-            # If we're here then we didn't find a row, so create a new entry.
-            c = ConfigEntry(guild_id=guild_id, setting=setting, value=default)
-            session.add(c)
-            session.commit()
+        value = self.cache.get((guild_id, setting))
+        if value is not TTLCache.MISSING:
+            return value
+
+        # A set() or a change from another process can land while we're
+        # reading, and then what we read is already out of date. fill()
+        # only caches it if the cache hasn't changed since this.
+        generation = self.cache.generation
+        with self.bot.engine.connect() as conn:
+            row = conn.execute(self.get_statement,
+                               {"guild_id": guild_id,
+                                "setting": setting}).first()
+            if row is not None:
+                self.cache.fill([((guild_id, setting), row[0])], generation)
+                return row[0]
+
+            # If we're here then we didn't find a row, so create a new
+            # entry. Someone else may have beaten us to it, in which case
+            # their value stands.
+            conn.execute(self.default_statement,
+                         {"guild_id": guild_id, "setting": setting,
+                          "value": default})
+            conn.commit()
 
         # Didn't find anything so return the default.
         return default
-        
+
+    async def get_async(self, guild_id, setting, default=None):
+        """
+            Awaitable version of get(), which doesn't block the event loop.
+        """
+        if guild_id is None:
+            guild_id = -1
+        setting = setting.lower()
+        value = self.cache.get((guild_id, setting))
+        if value is not TTLCache.MISSING:
+            return value
+        if self.bot.async_engine is None:
+            return await self.bot.run_blocking(self.get, guild_id, setting,
+                                               default)
+
+        generation = self.cache.generation
+        async with self.bot.async_engine.connect() as conn:
+            row = (await conn.execute(self.get_statement,
+                                      {"guild_id": guild_id,
+                                       "setting": setting})).first()
+            if row is not None:
+                self.cache.fill([((guild_id, setting), row[0])], generation)
+                return row[0]
+
+            await conn.execute(self.default_statement,
+                               {"guild_id": guild_id, "setting": setting,
+                                "value": default})
+            await conn.commit()
+
+        return default
 
     def set(self, guild_id, setting, value):
         """
@@ -89,17 +276,206 @@ class Config:
         if guild_id is None:
             guild_id = -1
         setting = setting.lower()
-        with Session(self.bot.engine) as session:
-            c = None
-            s = select(ConfigEntry).where(ConfigEntry.guild_id == guild_id,
-                                          ConfigEntry.setting == setting)
-            rows = session.execute(s)
-            for r in rows.unique():
-                c = r[0]
-                break
-            if c is None:
-                c = ConfigEntry(guild_id = guild_id, setting = setting)
-
-            c.value = value
-            session.add(c)
-            session.commit()
+        with self.bot.engine.begin() as conn:
+            conn.execute(self.set_statement,
+                         {"guild_id": guild_id, "setting": setting,
+                          "value": value})
+            if self.changelog:
+                conn.execute(self.change_statement,
+                             self.change_rows(guild_id, [setting]))
+        self.cache.set((guild_id, setting), value)
+
+    async def set_async(self, guild_id, setting, value):
+        """
+            Awaitable version of set(), which doesn't block the event loop.
+        """
+        if self.bot.async_engine is None:
+            return await self.bot.run_blocking(self.set, guild_id, setting,
+                                               value)
+        if guild_id is None:
+            guild_id = -1
+        setting = setting.lower()
+        async with self.bot.async_engine.begin() as conn:
+            await conn.execute(self.set_statement,
+                               {"guild_id": guild_id, "setting": setting,
+                                "value": value})
+            if self.changelog:
+                await conn.execute(self.change_statement,
+                                   self.change_rows(guild_id, [setting]))
+        self.cache.set((guild_id, setting), value)
+
+    def get_many(self, guild_id, settings, defaults=None):
+        """
+            Get several config values for a guild at once. defaults is an
+            optional dict of setting -> default value.
+
+            Returns a dict of setting -> value. Anything that isn't cached
+            is fetched with a single query, and any settings that don't
+            exist yet are created with their defaults in one transaction,
+            just like get() does.
+        """
+        if guild_id is None:
+            guild_id = -1
+        settings = [setting.lower() for setting in settings]
+        defaults = {k.lower(): v for k, v in (defaults or {}).items()}
+
+        ret = {}
+        missing = []
+        for setting in settings:
+            value = self.cache.get((guild_id, setting))
+            if value is TTLCache.MISSING:
+                missing.append(setting)
+            else:
+                ret[setting] = value
+        if not missing:
+            return ret
+
+        generation = self.cache.generation
+        with self.bot.engine.connect() as conn:
+            rows = conn.execute(self.get_many_statement,
+                                {"guild_id": guild_id, "settings": missing})
+            found = {r[0]: r[1] for r in rows}
+            new = [{"guild_id": guild_id, "setting": setting,
+                    "value": defaults.get(setting)}
+                   for setting in missing if setting not in found]
+            if new:
+                conn.execute(self.default_statement, new)
+                conn.commit()
+
+        self.cache.fill([((guild_id, k), v) for k, v in found.items()],
+                        generation)
+        for setting in missing:
+            ret[setting] = found.get(setting, defaults.get(setting))
+        return ret
+
+    def get_guild(self, guild_id):
+        """
+            Get every config value for a guild with a single query, as a
+            dict of setting -> value. This also refreshes the cache for
+            that guild.
+        """
+        if guild_id is None:
+            guild_id = -1
+        generation = self.cache.generation
+        with self.bot.engine.connect() as conn:
+            rows = conn.execute(self.get_guild_statement,
+                                {"guild_id": guild_id})
+            ret = {r[0]: r[1] for r in rows}
+        self.cache.fill([((guild_id, k), v) for k, v in ret.items()],
+                        generation)
+        return ret
+
+    def set_many(self, guild_id, values):
+        """
+            Set several config values for a guild in one transaction.
+            values is a dict of setting -> value. The same caveats about
+            booleans as set() apply.
+        """
+        if guild_id is None:
+            guild_id = -1
+        values = {k.lower(): v for k, v in values.items()}
+        if not values:
+            return
+        with self.bot.engine.begin() as conn:
+            conn.execute(self.set_statement,
+                         [{"guild_id": guild_id, "setting": setting,
+                           "value": value}
+                          for setting, value in values.items()])
+            if self.changelog:
+                conn.execute(self.change_statement,
+                             self.change_rows(guild_id, values))
+        self.cache.update([((guild_id, k), v) for k, v in values.items()])
+
+    def poll_changes(self):
+        """
+            Drop any settings changed since we last looked from the
+            cache, and tell the listeners. That includes our own changes,
+            which costs a re-read but keeps this simple. The primary also
+            prunes old entries from the log.
+        """
+        with self.bot.engine.connect() as conn:
+            rows = conn.execute(self.poll_statement,
+                                {"last_change": self.last_change}).all()
+            if self.bot.cluster.primary:
+                conn.execute(self.prune_statement,
+                             {"cutoff": int(time.time()) - CONFIG_CHANGE_KEEP})
+                conn.commit()
+        if not rows:
+            return
+        self.last_change = rows[-1][0]
+        keys = {(r[1], r[2]) for r in rows}
+        for key in keys:
+            self.cache.invalidate(key)
+        for listener in list(self.listeners):
+            try:
+                listener(keys)
+            except Exception as e:
+                logger.warning("{}: {}".format(type(e).__name__, e),
+                               exc_info=True)
+        with self.bot.engine.begin() as conn:
+            conn.execute(self.peer_statement, self.peer_row())
+
+    def peer_row(self):
+        return {"cluster_id": self.bot.cluster.cluster_id,
+                "last_change": self.last_change, "seen_at": int(time.time())}
+
+    def wait_for_peers(self, timeout=CONFIG_PEER_TIMEOUT):
+        """
+            Block until every other process in the cluster has applied
+            the changes made up to now (dropped them from its cache and
+            run its listeners), or timeout seconds have gone by. Doesn't
+            wait at all if there aren't any other processes.
+
+            Returns True if they all caught up, False if some didn't in
+            time (they may be down, or stuck).
+        """
+        if not self.changelog:
+            return True
+        with self.bot.engine.connect() as conn:
+            target = conn.execute(
+                select(func.max(ConfigChange.__table__.c.id))).scalar() or 0
+        others = set(range(self.bot.cluster.size)) - {self.bot.cluster.cluster_id}
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.bot.engine.connect() as conn:
+                applied = dict(conn.execute(self.peers_statement).all())
+            behind = sorted(peer for peer in others
+                            if (applied.get(peer) or 0) < target)
+            if not behind:
+                return True
+            if time.monotonic() >= deadline:
+                logger.warning(f"Cluster processes {behind} haven't applied config change {target} after {timeout:g}s")
+                return False
+            time.sleep(CONFIG_POLL_INTERVAL / 2)
+
+    async def get_many_async(self, guild_id, settings, defaults=None):
+        """
+            Awaitable version of get_many(). Cached settings don't need
+            a thread at all.
+        """
+        if guild_id is None:
+            guild_id = -1
+        cached = [self.cache.get((guild_id, setting.lower()))
+                  for setting in settings]
+        if TTLCache.MISSING not in cached:
+            return {setting.lower(): value
+                    for setting, value in zip(settings, cached)}
+        return await self.bot.run_blocking(self.get_many, guild_id, settings,
+                                           defaults)
+
+    async def get_guild_async(self, guild_id):
+        """
+            Awaitable version of get_guild().
+        """
+        return await self.bot.run_blocking(self.get_guild, guild_id)
+
+    async def set_many_async(self, guild_id, values):
+        """
+            Awaitable version of set_many().
+        """
+        return await self.bot.run_blocking(self.set_many, guild_id, values)
+
+    def change_rows(self, guild_id, settings):
+        now = int(time.time())
+        return [{"guild_id": guild_id, "setting": setting, "changed_at": now}
+                for setting in settings]
@@ -0,0 +1,76 @@
+# A rough in-process equivalent of python -X importtime.
+import sys
+import threading
+import time
+
+from importlib import _bootstrap
+
+class ImportTimer:
+    """
+       Records how long each module took to import, both on its own
+       ("self") and including the modules it pulled in ("cumulative"), the
+       way -X importtime does. Only first imports are timed; imports of
+       something already in sys.modules go straight through.
+
+       It hooks the import machinery underneath both the import statement
+       and importlib.import_module (which is what load_extension and lazy
+       imports use), so it sees both. Imports on other threads are timed
+       against their own stack.
+
+       Install it as early as possible (main.py does it before anything
+       else) so it sees the imports we care about.
+    """
+    def __init__(self):
+        self.times = {}
+        self.local = threading.local()
+        self.real_find_and_load = None
+
+    def install(self):
+        if self.real_find_and_load is not None:
+            return
+        self.real_find_and_load = _bootstrap._find_and_load
+        _bootstrap._find_and_load = self.timed_find_and_load
+
+    def uninstall(self):
+        if self.real_find_and_load is None:
+            return
+        _bootstrap._find_and_load = self.real_find_and_load
+        self.real_find_and_load = None
+
+    def timed_find_and_load(self, name, import_):
+        # name is always absolute by the time it gets here.
+        if name in sys.modules:
+            return self.real_find_and_load(name, import_)
+
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self.real_find_and_load(name, import_)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            if name not in self.times:
+                self.times[name] = (elapsed - children, elapsed)
+
+    def report(self, count=20):
+        """
+           The count slowest imports by cumulative time, as a list of
+           (module, self seconds, cumulative seconds).
+        """
+        entries = [(name, own, total)
+                   for name, (own, total) in self.times.items()]
+        entries.sort(key=lambda e: -e[2])
+        return entries[:count]
+
+    def total(self):
+        """
+           Total time spent in top-level imports.
+        """
+        return sum(own for own, total in self.times.values())
+
+import_timer = ImportTimer()
@@ -0,0 +1,141 @@
+# Works out which gateway intents and caches the bot asks for.
+import ast
+import discord
+import os
+
+from src.logging import logger
+
+# What every bot needs: guilds for the guild cache, and messages and
+# their content for prefix commands. Cogs that need more say so with a
+# module-level INTENTS list, e.g. INTENTS = ["members", "reactions"].
+BASE_INTENTS = ["guilds", "messages", "message_content"]
+
+# Each of these can be set in the environment or, failing that, in the
+# bot-wide (-1) config. The environment wins.
+INTENTS_SETTING = "bot:intents"
+MEMBER_CACHE_SETTING = "bot:member_cache"
+MAX_MESSAGES_SETTING = "bot:max_messages"
+CHUNK_GUILDS_SETTING = "bot:chunk_guilds"
+SETTINGS = {INTENTS_SETTING: ("DISCORD_INTENTS", "auto"),
+            MEMBER_CACHE_SETTING: ("DISCORD_MEMBER_CACHE", "auto"),
+            MAX_MESSAGES_SETTING: ("DISCORD_MAX_MESSAGES", "1000"),
+            CHUNK_GUILDS_SETTING: ("DISCORD_CHUNK_GUILDS", "auto")}
+
+def declared_intents(path):
+    """
+       The INTENTS a cog's source file declares, found by parsing it
+       rather than importing it, since we need to know before the bot
+       connects and long before the cogs load.
+    """
+    try:
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+    except (OSError, SyntaxError) as e:
+        logger.warning(f"Can't read intents from {path}: {e}")
+        return []
+    for node in tree.body:
+        if (isinstance(node, ast.Assign)
+            and any(isinstance(t, ast.Name) and t.id == "INTENTS"
+                    for t in node.targets)):
+            try:
+                return list(ast.literal_eval(node.value))
+            except ValueError:
+                logger.warning(f"INTENTS in {path} isn't a plain list")
+    return []
+
+def cog_intents(names):
+    """
+       The union of the intents the named cogs declare, as a dict of
+       intent -> the cogs that want it.
+    """
+    wanted = {}
+    for name in names:
+        path = name.replace(".", os.sep) + ".py"
+        for intent in declared_intents(path):
+            wanted.setdefault(intent, []).append(name)
+    return wanted
+
+def parse_intents(names):
+    intents = discord.Intents.none()
+    for name in names:
+        name = name.strip()
+        if not name:
+            continue
+        if not hasattr(discord.Intents, name):
+            logger.warning(f"Unknown intent {name}")
+            continue
+        setattr(intents, name, True)
+    return intents
+
+def setting(settings, name):
+    env, default = SETTINGS[name]
+    return os.getenv(env) or settings.get(name) or default
+
+def gateway_options(settings, cogs):
+    """
+       The intents, member_cache_flags, max_messages and
+       chunk_guilds_at_startup arguments for the bot, given the bot-wide
+       config settings and the cogs that will be loaded.
+
+       bot:intents (DISCORD_INTENTS) is "auto" for the base intents plus
+       whatever the cogs declare, "all", or a comma separated list of
+       intents to use on top of the base ones. bot:member_cache
+       (DISCORD_MEMBER_CACHE) is "auto" to cache what the intents allow,
+       "none", "all", or a list of flags (voice, joined).
+       bot:max_messages (DISCORD_MAX_MESSAGES) sizes the message cache,
+       with 0 turning it off. bot:chunk_guilds (DISCORD_CHUNK_GUILDS) is
+       "auto" to fetch every guild's member list at startup if we have
+       the members intent, or true or false.
+    """
+    spec = setting(settings, INTENTS_SETTING).strip().lower()
+    if spec == "all":
+        intents = discord.Intents.all()
+    else:
+        names = list(BASE_INTENTS)
+        if spec == "auto":
+            names.extend(cog_intents(cogs))
+        else:
+            names.extend(spec.split(","))
+        intents = parse_intents(names)
+
+    spec = setting(settings, MEMBER_CACHE_SETTING).strip().lower()
+    if spec == "auto":
+        member_cache = discord.MemberCacheFlags.from_intents(intents)
+    elif spec == "all":
+        member_cache = discord.MemberCacheFlags.all()
+    elif spec == "none":
+        member_cache = discord.MemberCacheFlags.none()
+    else:
+        member_cache = discord.MemberCacheFlags.none()
+        for name in spec.split(","):
+            name = name.strip()
+            if hasattr(discord.MemberCacheFlags, name):
+                setattr(member_cache, name, True)
+            else:
+                logger.warning(f"Unknown member cache flag {name}")
+    # Caching joins needs the members intent, voice needs voice states.
+    if member_cache.joined and not intents.members:
+        logger.warning("Member cache wants joined members without the members intent; not caching them")
+        member_cache.joined = False
+    if member_cache.voice and not intents.voice_states:
+        logger.warning("Member cache wants voice members without the voice_states intent; not caching them")
+        member_cache.voice = False
+
+    max_messages = int(setting(settings, MAX_MESSAGES_SETTING)) or None
+
+    spec = setting(settings, CHUNK_GUILDS_SETTING).strip().lower()
+    if spec == "auto":
+        chunk_guilds = intents.members
+    else:
+        chunk_guilds = spec in ("1", "true", "yes", "on")
+
+    return {"intents": intents, "member_cache_flags": member_cache,
+            "max_messages": max_messages,
+            "chunk_guilds_at_startup": chunk_guilds}
+
+def describe(options):
+    intents = sorted(name for name, on in options["intents"] if on)
+    cache = sorted(name for name, on in options["member_cache_flags"] if on)
+    return (f"intents {','.join(intents)}; member cache {','.join(cache) or 'none'}; "
+            f"max_messages {options['max_messages']}; "
+            f"chunk_guilds_at_startup {options['chunk_guilds_at_startup']}")
@@ -0,0 +1,209 @@
+# The scheduler: its job stores and executors, and job run tracking.
+import os
+import threading
+import time
+
+from datetime import datetime, timezone
+
+from apscheduler.events import (EVENT_JOB_SUBMITTED, EVENT_JOB_EXECUTED,
+                                EVENT_JOB_ERROR, EVENT_JOB_MISSED)
+from apscheduler.executors.asyncio import AsyncIOExecutor
+from apscheduler.executors.pool import ProcessPoolExecutor, ThreadPoolExecutor
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from src.logging import logger
+from src.utils.metrics import registry
+
+# Threads for the sync jobs that do real work, like anything that talks
+# to the database, and processes for CPU-heavy jobs that don't need the
+# bot. No process pool unless JOB_PROCESSES is set.
+JOB_THREADS = int(os.getenv("JOB_THREADS", "10"))
+JOB_PROCESSES = int(os.getenv("JOB_PROCESSES", "0"))
+# Run a job that was due while we were down (or busy) if we come back
+# within this many seconds of when it should have run, and only run it
+# once however many runs it missed.
+JOB_MISFIRE_GRACE = int(os.getenv("JOB_MISFIRE_GRACE", "300"))
+JOB_COALESCE = os.getenv("JOB_COALESCE", "True").lower() in ("1", "true", "yes", "on")
+
+# The Jobs for the running bot, for run_bot_job to find.
+current = None
+
+def run_bot_job(path):
+    """
+       What persistent jobs actually call. Job stores pickle the job's
+       function and arguments, and a bound method of the bot can't be
+       pickled, so instead we store this function and the dotted path
+       to the method ("stats.compact") and look it up when it runs.
+    """
+    target = current.bot
+    for name in path.split("."):
+        target = getattr(target, name)
+    return target()
+
+class Jobs:
+    """
+       Owns the bot's scheduler. There are two job stores: "default",
+       in memory, for jobs the code sets up every time it starts (most
+       of them, and anything taking a bound method), and "persistent",
+       in the bot's database, for jobs that need to survive a restart,
+       typically so that a run missed while the bot was down still
+       happens.
+
+       The default executor runs coroutine jobs on the event loop and
+       sync ones in the loop's default thread pool, which is shared
+       with asyncio.to_thread. Jobs that do real work (database flushes,
+       retention) should ask for the "threadpool" executor, which has
+       JOB_THREADS threads of its own, so they don't hold up to_thread
+       callers. CPU-heavy jobs that only need their arguments can go to
+       "processpool", if JOB_PROCESSES is set, to get out from under the
+       GIL altogether.
+
+       Only the primary process of a cluster gets the database job
+       store. Otherwise every process would run its jobs.
+
+       Each run's time and outcome are tracked, exported as metrics, and
+       shown by the admin jobs command.
+    """
+    def __init__(self, bot):
+        global current
+        self.bot = bot
+        if bot.cluster.primary:
+            persistent = SQLAlchemyJobStore(engine=bot.engine)
+        else:
+            persistent = MemoryJobStore()
+        executors = {"default": AsyncIOExecutor(),
+                     "threadpool": ThreadPoolExecutor(JOB_THREADS)}
+        if JOB_PROCESSES:
+            executors["processpool"] = ProcessPoolExecutor(JOB_PROCESSES)
+        self.sched = AsyncIOScheduler(
+            jobstores={"default": MemoryJobStore(), "persistent": persistent},
+            executors=executors,
+            job_defaults={"coalesce": JOB_COALESCE,
+                          "misfire_grace_time": JOB_MISFIRE_GRACE},
+            timezone='UTC')
+
+        # id -> (path, trigger, add_job arguments) for persistent jobs.
+        self.persistent = {}
+        # id -> what we know about its runs.
+        self.runs = {}
+        # (id, scheduled run time) -> when it was handed to the executor.
+        # Events for thread pool jobs come from the pool's threads, hence
+        # the lock.
+        self.starts = {}
+        self.finished = set()
+        self.lock = threading.Lock()
+
+        self.job_seconds = registry.histogram("bot_job_seconds",
+                                              "Scheduled job run time",
+                                              ("job",))
+        self.job_errors = registry.counter("bot_job_errors_total",
+                                           "Scheduled jobs that raised",
+                                           ("job",))
+        self.job_missed = registry.counter("bot_job_missed_total",
+                                           "Scheduled runs skipped as too late",
+                                           ("job",))
+        self.sched.add_listener(self.job_event, EVENT_JOB_SUBMITTED |
+                                EVENT_JOB_EXECUTED | EVENT_JOB_ERROR |
+                                EVENT_JOB_MISSED)
+        current = self
+
+    def add_persistent(self, path, trigger, id, **kwargs):
+        """
+           Schedule the bot method at path (e.g. "stats.compact") in the
+           persistent job store. If the job's already in the store it's
+           left alone, so a run that was due while we were down still
+           fires, unless its trigger has changed.
+
+           **Example:**
+           `bot.jobs.add_persistent("stats.compact", CronTrigger(hour=4), "stats:compact")`
+        """
+        self.persistent[id] = (path, trigger, kwargs)
+        if self.sched.running:
+            self.apply_persistent(id)
+
+    def apply_persistent(self, id):
+        path, trigger, kwargs = self.persistent[id]
+        job = self.sched.get_job(id, jobstore="persistent")
+        if job is None:
+            self.sched.add_job(run_bot_job, trigger, args=[path], id=id,
+                               jobstore="persistent", **kwargs)
+        elif str(job.trigger) != str(trigger) or job.args != (path,):
+            job.modify(args=[path])
+            job.reschedule(trigger)
+            logger.info(f"Rescheduled persistent job {id}")
+
+    def start(self):
+        """
+           Start the scheduler, and add any persistent jobs that aren't
+           in the store yet. The store's only readable once the scheduler
+           is running, which is why they wait until now.
+        """
+        self.sched.start()
+        for id in self.persistent:
+            self.apply_persistent(id)
+
+    def shutdown(self):
+        if self.sched.running:
+            self.sched.shutdown(wait=False)
+
+    def job_event(self, event):
+        with self.lock:
+            self.record(event)
+
+    def record(self, event):
+        # Job runtime is from submission to completion, so it includes
+        # any wait for a free executor thread. A quick thread pool job
+        # can finish before the scheduler gets round to saying it was
+        # submitted, in which case we time it from when it was due.
+        if event.code == EVENT_JOB_SUBMITTED:
+            now = time.perf_counter()
+            for run_time in event.scheduled_run_times:
+                key = (event.job_id, run_time)
+                if key in self.finished:
+                    self.finished.discard(key)
+                else:
+                    self.starts[key] = now
+            return
+        run = self.runs.setdefault(event.job_id, {"runs": 0, "errors": 0,
+                                                  "missed": 0,
+                                                  "last_run": None,
+                                                  "last_seconds": None,
+                                                  "last_error": None})
+        if event.code == EVENT_JOB_MISSED:
+            run["missed"] = run["missed"] + 1
+            self.job_missed.inc(job=event.job_id)
+            return
+        run["runs"] = run["runs"] + 1
+        run["last_run"] = time.time()
+        key = (event.job_id, event.scheduled_run_time)
+        started = self.starts.pop(key, None)
+        if started is not None:
+            elapsed = time.perf_counter() - started
+        else:
+            self.finished.add(key)
+            elapsed = max(0.0, (datetime.now(timezone.utc)
+                                - event.scheduled_run_time).total_seconds())
+        run["last_seconds"] = elapsed
+        self.job_seconds.observe(elapsed, job=event.job_id)
+        if event.code == EVENT_JOB_ERROR:
+            run["errors"] = run["errors"] + 1
+            run["last_error"] = "{}: {}".format(type(event.exception).__name__,
+                                                event.exception)
+            self.job_errors.inc(job=event.job_id)
+
+    def summary(self):
+        """
+           A list of dicts, one per scheduled job, with where and when it
+           runs and how its runs have gone.
+        """
+        ret = []
+        for jobstore in ("default", "persistent"):
+            for job in self.sched.get_jobs(jobstore=jobstore):
+                run = self.runs.get(job.id, {})
+                ret.append({"id": job.id, "jobstore": jobstore,
+                            "executor": job.executor,
+                            "trigger": str(job.trigger),
+                            "next_run": job.next_run_time, **run})
+        return ret
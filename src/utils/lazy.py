@@ -0,0 +1,46 @@
+# Deferred imports, so heavyweight modules only cost us when they're used.
+import importlib
+import sys
+import time
+
+from src.logging import logger
+
+class LazyModule:
+    """
+       Stands in for a module that hasn't been imported yet. The real
+       import happens the first time an attribute is looked up, so a cog
+       can name its heavy dependencies at the top of the file without
+       paying for them until it actually needs them.
+    """
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            name = self.__dict__["_name"]
+            start = time.perf_counter()
+            module = importlib.import_module(name)
+            self.__dict__["_module"] = module
+            logger.debug(f"Lazily imported {name} in {(time.perf_counter() - start) * 1000:.1f}ms")
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_module"] is not None else "not loaded"
+        return f"<LazyModule {self.__dict__['_name']} ({state})>"
+
+def lazy_import(name):
+    """
+       Return the module if it's already imported, otherwise a proxy that
+       imports it on first use.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
@@ -0,0 +1,142 @@
+# Memory measurement: RSS, and tracemalloc attribution for cog loads.
+import gc
+import os
+import psutil
+import tracemalloc
+
+from collections import deque
+
+from src.logging import logger
+from src.utils.blocking import run_blocking
+
+# How many frames of traceback tracemalloc keeps per allocation. One is
+# enough to say which line allocated; more costs memory and time.
+MEMTRACE_FRAMES = int(os.getenv("MEMTRACE_FRAMES", "1"))
+# A cog whose retained memory grows by at least LEAK_MIN_BYTES on each of
+# LEAK_RELOADS reloads in a row gets flagged as leaking.
+LEAK_RELOADS = 3
+LEAK_MIN_BYTES = 16 * 1024
+
+def mem_usage():
+    process = psutil.Process(os.getpid())
+    mem_info = process.memory_info()
+    return mem_info.rss
+
+def where(frame):
+    filename = frame.filename
+    if filename.startswith(os.getcwd() + os.sep):
+        filename = os.path.relpath(filename)
+    return f"{filename}:{frame.lineno}"
+
+class MemoryTracer:
+    """
+       Measures what loading or reloading a cog costs in memory. RSS is
+       always measured, but it's a noisy, process-wide figure. With
+       tracing on (COG_TRACEMALLOC=1, or `cog memtrace on`) we also take
+       tracemalloc snapshots either side of the load and diff them, which
+       says how much memory the load left allocated and which lines
+       allocated it.
+
+       Each cog's retained memory is remembered across reloads. A reload
+       that cleans up after itself should retain next to nothing, so a
+       cog that keeps growing on every reload gets flagged as a leak.
+
+       Tracing slows every allocation down and costs memory of its own,
+       so it's off unless asked for.
+    """
+    def __init__(self, enabled=None):
+        # Retained bytes for each reload, per cog.
+        self.history = {}
+        # The latest report, per cog.
+        self.reports = {}
+        if enabled is None:
+            enabled = os.getenv("COG_TRACEMALLOC", "0").lower() in ("1", "true", "yes", "on")
+        if enabled:
+            self.enable()
+
+    @property
+    def enabled(self):
+        return tracemalloc.is_tracing()
+
+    def enable(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(MEMTRACE_FRAMES)
+
+    def disable(self):
+        tracemalloc.stop()
+
+    def snapshot(self):
+        """
+           A tracemalloc snapshot of what's live right now, after a
+           collection so garbage doesn't count. None if tracing is off.
+        """
+        if not self.enabled:
+            return None
+        gc.collect()
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def measure(self, name, kind="load"):
+        """
+           Measures the memory used by a cog load or reload. Use it as an
+           async context manager around the load; the report it hands
+           back is filled in when the block finishes without raising.
+           The measuring (psutil, and snapshots if tracing) happens in the
+           blocking pool.
+
+           **Example:**
+           ```
+           async with bot.memtrace.measure(name, "reload") as report:
+               await bot.reload_extension(name)
+           ```
+        """
+        return Measurement(self, name, kind)
+
+    def finish(self, report, before, top=10):
+        after = self.snapshot()
+        if before is None or after is None:
+            return
+        stats = after.compare_to(before, "lineno")
+        report["retained"] = sum(stat.size_diff for stat in stats)
+        report["blocks"] = sum(stat.count_diff for stat in stats)
+        report["top"] = [(where(stat.traceback[0]), stat.size_diff, stat.count_diff)
+                         for stat in stats[:top] if stat.size_diff]
+
+        name = report["name"]
+        if report["kind"] == "reload":
+            history = self.history.setdefault(name, deque(maxlen=LEAK_RELOADS))
+            history.append(report["retained"])
+            report["leak"] = (len(history) == LEAK_RELOADS
+                              and all(size >= LEAK_MIN_BYTES for size in history))
+            if report["leak"]:
+                logger.warning(f"{name} retained {', '.join(f'{size:,}' for size in history)} bytes over its last {LEAK_RELOADS} reloads; it may be leaking")
+        else:
+            self.history.pop(name, None)
+        self.reports[name] = report
+
+class Measurement:
+    def __init__(self, tracer, name, kind):
+        self.tracer = tracer
+        self.report = {"name": name, "kind": kind, "rss_delta": 0,
+                       "retained": None, "blocks": None, "top": [],
+                       "leak": False}
+        self.before = None
+        self.rss = 0
+
+    def start(self):
+        self.before = self.tracer.snapshot()
+        self.rss = mem_usage()
+
+    def end(self):
+        self.report["rss_delta"] = mem_usage() - self.rss
+        self.tracer.finish(self.report, self.before)
+
+    async def __aenter__(self):
+        await run_blocking(self.start)
+        return self.report
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await run_blocking(self.end)
+        self.before = None
+        return False
@@ -0,0 +1,182 @@
+# Runtime metrics, exported in the Prometheus text format.
+import threading
+
+# Latency buckets, in seconds.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+def percentile(ordered, fraction):
+    """
+       The value a fraction of the way through an already sorted list, or
+       0.0 if it's empty.
+    """
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_value(value):
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return str(value)
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+class Metric:
+    """
+       Base for the metric types. Each metric has a name, help text and
+       optional label names; values are kept per set of label values.
+    """
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self):
+        """
+           Yields (suffix, label string, value) for each sample.
+        """
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in items:
+            yield "", format_labels(self.labels, key), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """
+       A value that goes up and down. Either set() it, or give it a
+       function that's called at scrape time and returns a number, or a
+       list of (labels dict, number) pairs.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), fn=None):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.fn is None:
+            yield from super().samples()
+            return
+        value = self.fn()
+        if isinstance(value, (int, float)):
+            yield "", "", value
+            return
+        for labels, v in value:
+            yield "", format_labels(self.labels, self.key(labels)), v
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                # Per-bucket (not cumulative) counts, then sum and count.
+                entry = [[0] * len(self.buckets), 0.0, 0]
+                self.values[key] = entry
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] = entry[0][i] + 1
+                    break
+            entry[1] = entry[1] + value
+            entry[2] = entry[2] + 1
+
+    def samples(self):
+        with self.lock:
+            items = [(key, (list(counts), total, count))
+                     for key, (counts, total, count) in self.values.items()]
+        for key, (counts, total, count) in items:
+            running = 0
+            for bound, n in zip(self.buckets, counts):
+                running = running + n
+                yield "_bucket", format_labels(self.labels, key, ("le", bound)), running
+            yield "_bucket", format_labels(self.labels, key, ("le", "+Inf")), count
+            yield "_sum", format_labels(self.labels, key), total
+            yield "_count", format_labels(self.labels, key), count
+
+class Registry:
+    """
+       The set of metrics we export. Registering a metric with a name
+       that's already taken replaces the old one, so cogs can register
+       theirs again when they're reloaded.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name):
+        with self.lock:
+            self.metrics.pop(name, None)
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), fn=None):
+        return self.register(Gauge(name, help, labels, fn))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """
+           All the metrics, in the Prometheus text exposition format.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        parts = []
+        for metric in metrics:
+            try:
+                parts.append(metric.render())
+            except Exception:
+                # One broken gauge function shouldn't take out the page.
+                continue
+        return "\n".join(parts) + "\n"
+
+registry = Registry()
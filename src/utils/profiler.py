@@ -0,0 +1,104 @@
+# A low-overhead statistical profiler that can run inside the live bot.
+import os
+import sys
+import threading
+import time
+
+from collections import Counter
+
+from src.logging import logger
+
+# The longest a profile is allowed to run, in seconds, so a forgotten one
+# doesn't run forever.
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "300"))
+
+class SamplingProfiler:
+    """
+       Samples the stacks of every thread (the event loop and any worker
+       threads) at a fixed interval from a background thread, and counts
+       how often each stack turns up. Nothing is hooked into the code
+       being profiled, so the cost is one stack walk per thread per
+       sample, and none at all when it's not running.
+
+       The result comes out in the collapsed-stack format that
+       flamegraph.pl, speedscope and friends take: one line per distinct
+       stack, frames separated by semicolons, then the sample count.
+    """
+    def __init__(self):
+        self.samples = Counter()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.started = None
+        self.stopped = None
+        self.interval = None
+        self.sample_count = 0
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, duration=30, interval=0.01):
+        """
+           Start a fresh profile that stops on its own after duration
+           seconds (capped at PROFILE_MAX_SECONDS). Returns False if one's
+           already running.
+        """
+        if self.running:
+            return False
+        duration = min(duration, PROFILE_MAX_SECONDS)
+        with self.lock:
+            self.samples = Counter()
+        self.sample_count = 0
+        self.interval = interval
+        self.started = time.time()
+        self.stopped = None
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, args=(duration,),
+                                       name="sampling-profiler", daemon=True)
+        self.thread.start()
+        logger.info(f"Profiling for up to {duration}s every {interval * 1000:.0f}ms")
+        return True
+
+    def stop(self):
+        """
+           Stop the profile if it's running. Returns False if it wasn't.
+        """
+        if not self.running:
+            return False
+        self.stop_event.set()
+        self.thread.join()
+        return True
+
+    def run(self, duration):
+        me = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while not self.stop_event.wait(self.interval):
+            if time.monotonic() > deadline:
+                break
+            names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks.append(";".join(reversed(stack)))
+            with self.lock:
+                self.samples.update(stacks)
+            self.sample_count = self.sample_count + 1
+        self.stopped = time.time()
+        logger.info(f"Profiling stopped after {self.sample_count} samples")
+
+    def collapsed(self):
+        """
+           The profile so far, in collapsed-stack format.
+        """
+        with self.lock:
+            samples = list(self.samples.items())
+        samples.sort(key=lambda e: -e[1])
+        return "".join(f"{stack} {count}\n" for stack, count in samples)
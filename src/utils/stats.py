@@ -1,13 +1,51 @@
 import sqlalchemy
+import threading
+import time
 
 from datetime import datetime
 from sqlalchemy.orm import declarative_base, Session
-from sqlalchemy import Column, Integer, String, Table, DateTime
-from sqlalchemy import select, func
+from sqlalchemy import Column, Integer, String, Table, DateTime, Index
+from sqlalchemy import select, func, delete, insert, union_all, literal_column
+from sqlalchemy import bindparam
+from apscheduler.triggers.cron import CronTrigger
 from src.logging import logger
 
 Base = declarative_base()
 
+# How often, in seconds, buffered counter updates are written out, and how
+# many distinct buffered counters we let pile up before forcing a write.
+FLUSH_INTERVAL_SETTING = "stats:flush_interval"
+FLUSH_INTERVAL_DEFAULT = "10"
+FLUSH_THRESHOLD_SETTING = "stats:flush_threshold"
+FLUSH_THRESHOLD_DEFAULT = "5000"
+
+# How long per-day and per-week rows are kept before the nightly
+# compaction drops them, leaving the coarser rollups to cover that time.
+KEEP_DAYS_SETTING = "stats:keep_days"
+KEEP_DAYS_DEFAULT = "90"
+KEEP_WEEKS_SETTING = "stats:keep_weeks"
+KEEP_WEEKS_DEFAULT = "104"
+# Where compaction has got to: the first day still held per-day, and the
+# first day still held per-week. Maintained by compact().
+DAY_FLOOR_SETTING = "stats:day_floor"
+WEEK_FLOOR_SETTING = "stats:week_floor"
+
+# Per-stat retention policies live in settings named this plus the stat
+# name, with a value of "delete:<days>" (drop everything older, from every
+# table) or "downsample:<days>" (drop per-day rows older, keeping the
+# rollups). A bare number of days means delete. Downsampling progress is
+# kept per stat under STAT_FLOOR_PREFIX.
+RETENTION_PREFIX = "stats:retention:"
+STAT_FLOOR_PREFIX = "stats:floor:"
+# Old rows are deleted this many at a time, with a short pause between
+# batches so we don't hog the database's write lock.
+RETENTION_BATCH_SETTING = "stats:retention_batch"
+RETENTION_BATCH_DEFAULT = "5000"
+RETENTION_PAUSE = 0.05
+# How late the nightly compaction can be and still run, e.g. after the
+# bot was down at 4am.
+COMPACT_MISFIRE_GRACE = 6 * 60 * 60
+
 class StatEntry(Base):
     __tablename__ = "stats"
     guild_id = Column(Integer, primary_key = True)
@@ -27,26 +65,132 @@ class StatsDay(Base):
     day_number = Column(Integer, primary_key = True)
     count = Column(Integer)
 
+    # The primary key covers lookups of a single substat. Leaderboards
+    # (fetch) filter on guild, stat and a day range and then group by
+    # substat, so they get their own index with day_number ahead of
+    # substat, and count on the end so the query never has to visit the
+    # table itself.
+    __table_args__ = (Index("ix_stats_granular_leaderboard", "guild_id",
+                            "statname", "day_number", "substat", "count"),)
+
+class StatsWeek(Base):
+    __tablename__ = "stats_weekly"
+    guild_id = Column(Integer, primary_key = True)
+    statname = Column(String(100), primary_key = True)
+    substat = Column(String(100), primary_key = True)
+    week_number = Column(Integer, primary_key = True)
+    count = Column(Integer)
+
+    __table_args__ = (Index("ix_stats_weekly_leaderboard", "guild_id",
+                            "statname", "week_number", "substat", "count"),)
+
+class StatsMonth(Base):
+    __tablename__ = "stats_monthly"
+    guild_id = Column(Integer, primary_key = True)
+    statname = Column(String(100), primary_key = True)
+    substat = Column(String(100), primary_key = True)
+    month_number = Column(Integer, primary_key = True)
+    count = Column(Integer)
+
+    __table_args__ = (Index("ix_stats_monthly_leaderboard", "guild_id",
+                            "statname", "month_number", "substat", "count"),)
+
+# The tables counts are kept in, finest first, with the column holding the
+# bucket number and how many days go in a bucket. A bucket number is just
+# day_number // days. A "month" is four weeks so the buckets nest neatly.
+ROLLUPS = [(StatsDay, StatsDay.day_number, 1),
+           (StatsWeek, StatsWeek.week_number, 7),
+           (StatsMonth, StatsMonth.month_number, 28)]
+
 class StatsTracker():
     """
         The stats tracker class tracks stats. Stats are normally per-guild,
         but stats with a guild_id of -1 are global.
+
+        Increments and decrements aren't written to the database right
+        away. They're merged into an in-memory buffer and written out in
+        one transaction every so often (or when the buffer gets big), so
+        a busy guild costs us one commit per interval rather than one per
+        message.
+
+        Alongside the per-day counts we keep weekly and monthly rollups,
+        updated by the same flush. Queries over a window of days sum the
+        coarsest buckets that fit, so long windows cost a handful of rows
+        per substat rather than one per day, and a nightly job drops old
+        per-day and per-week rows once the rollups cover them.
     """
 
     def __init__(self, bot):
         self.bot = bot
         # Because we keep adding stuff, track the version so code can
         # check this and maybe refresh the object if need be.
-        self.version = 1
+        self.version = 3
         # Make sure the tables exist, in case we've hot-loaded this into
         # a running bot.
         self.init_tables(bot)
+        self.init_indexes(bot)
+        self.prepare()
+
+        # Buffered counter deltas, keyed by (guild_id, statname, substat,
+        # day_number). The flush job runs on a worker thread, so access
+        # is guarded by the lock.
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.flush_interval = int(bot.config.get(-1, FLUSH_INTERVAL_SETTING,
+                                                 FLUSH_INTERVAL_DEFAULT))
+        self.flush_threshold = int(bot.config.get(-1, FLUSH_THRESHOLD_SETTING,
+                                                  FLUSH_THRESHOLD_DEFAULT))
+        bot.sched.add_job(self.flush, "interval", seconds=self.flush_interval,
+                          id="stats:flush", replace_existing=True,
+                          executor="threadpool", coalesce=True,
+                          max_instances=1)
+
+        # The first day each rollup level still has rows for. The
+        # monthly rollup is never compacted.
+        self.floors = [0, 0, 0]
+        # Per-stat day floors from downsampling retention policies, keyed
+        # by lowercased stat name, since that's how config stores them.
+        self.stat_floors = {}
+        self.load_floors()
+        self.last_compaction = None
+        # Retention only needs doing once for the whole cluster. The other
+        # processes pick up the new floors when the config changes. It
+        # goes in the persistent job store so a night's compaction missed
+        # while we were down still gets done when we come back, if that's
+        # the same day.
+        if bot.cluster.primary:
+            bot.jobs.add_persistent("stats.compact",
+                                    CronTrigger(hour=4, minute=0,
+                                                timezone="UTC"),
+                                    "stats:compact", executor="threadpool",
+                                    misfire_grace_time=COMPACT_MISFIRE_GRACE,
+                                    coalesce=True, max_instances=1)
+        else:
+            bot.config.listeners.append(self.config_changed)
+
+    def load_floors(self):
+        """
+            Read the compaction floors from the config.
+        """
+        settings = self.bot.config.get_guild(-1)
+        self.floors = [int(settings.get(DAY_FLOOR_SETTING) or 0),
+                       int(settings.get(WEEK_FLOOR_SETTING) or 0),
+                       0]
+        self.stat_floors = {k[len(STAT_FLOOR_PREFIX):]: int(v)
+                            for k, v in settings.items()
+                            if k.startswith(STAT_FLOOR_PREFIX)}
+
+    def config_changed(self, keys):
+        for guild_id, setting in keys:
+            if guild_id == -1 and (setting in (DAY_FLOOR_SETTING,
+                                               WEEK_FLOOR_SETTING)
+                                   or setting.startswith(STAT_FLOOR_PREFIX)):
+                self.load_floors()
+                return
 
     def init_tables(self, bot):
         db = bot.database
         tables = bot.database.meta_data.tables
-        if tables.get("stats") is not None and tables.get("stats_granular") is not None:
-            return
 
         if tables.get("stats") is None:
             db.stats = Table("stats", db.meta_data,
@@ -66,8 +210,77 @@ class StatsTracker():
                                              primary_key=True),
                                       Column("day_number", Integer, primary_key=True),
                                       Column("count", Integer))
+
+        # The rollup tables came later, so there may be daily stats from
+        # before they existed. Any we create get filled in from those.
+        inspector = sqlalchemy.inspect(bot.engine)
+        backfill = []
+        for model, column, days in ROLLUPS[1:]:
+            name = model.__tablename__
+            if not inspector.has_table(name):
+                backfill.append((model, column, days))
+            if tables.get(name) is None:
+                setattr(db, name, model.__table__.to_metadata(db.meta_data))
         db.safe_start()
 
+        for model, column, days in backfill:
+            self.backfill(bot, model, column, days)
+
+    def backfill(self, bot, model, column, days):
+        """
+            Fill a rollup table in from the per-day counts.
+        """
+        bucket = StatsDay.day_number // days
+        s = select(StatsDay.guild_id, StatsDay.statname, StatsDay.substat,
+                   bucket, func.sum(StatsDay.count)).group_by(
+                       StatsDay.guild_id, StatsDay.statname, StatsDay.substat,
+                       bucket)
+        s = insert(model.__table__).from_select(
+            ["guild_id", "statname", "substat", column.key, "count"], s)
+        with Session(bot.engine) as session:
+            session.execute(s)
+            session.commit()
+        logger.info(f"Backfilled {model.__tablename__} from stats_granular")
+
+    def init_indexes(self, bot):
+        """
+            Create any indexes that are missing. create_all won't add
+            indexes to tables that already exist, so existing databases
+            need this.
+        """
+        for model, column, days in ROLLUPS:
+            for index in model.__table__.indexes:
+                index.create(bind=bot.engine, checkfirst=True)
+
+    def prepare(self):
+        """
+            Build the statements that don't depend on the query window
+            once, with bound parameters. Windowed queries depend on which
+            rollup tables the window needs, so those are built the first
+            time each combination comes up and kept in window_statements
+            and fetch_statements.
+        """
+        stats = StatEntry.__table__
+        db = self.bot.database
+        self.total_statement = select(stats.c["count"]).where(
+            stats.c.guild_id == bindparam("guild_id"),
+            stats.c.statname == bindparam("stat"),
+            stats.c.substat == bindparam("substat"))
+        self.window_statements = {}
+        self.fetch_statements = {}
+
+        # The upserts a flush does, for the all-time totals and then each
+        # rollup level.
+        self.totals_upsert = db.upsert(stats,
+                                       ["guild_id", "statname", "substat"],
+                                       increment=["count"],
+                                       update=["last_update"])
+        self.rollup_upserts = [db.upsert(model.__table__,
+                                         ["guild_id", "statname", "substat",
+                                          column.key],
+                                         increment=["count"])
+                               for model, column, days in ROLLUPS]
+
     def get_current_day(self):
         """
            Returns the current day, which is the number of days since Jan 1 1970.
@@ -83,37 +296,96 @@ class StatsTracker():
             'all history'.
     
             Returns the current value of the tracked stat, or None if the
-            stat has no value.
+            stat has no value. Counts still sitting in the buffer are
+            included.
+        """
+        stmt, params = self.get_statement(guild_id, stat, substat, days)
+        with self.bot.engine.connect() as conn:
+            value = conn.execute(stmt, params).scalar()
+        return self.add_pending(value, guild_id, stat, substat, days)
+
+    async def get_async(self, guild_id, stat, substat="", days = None):
+        """
+            Awaitable version of get(), which doesn't block the event loop.
+        """
+        if self.bot.async_engine is None:
+            return await self.bot.run_blocking(self.get, guild_id, stat,
+                                               substat, days)
+        stmt, params = self.get_statement(guild_id, stat, substat, days)
+        async with self.bot.async_engine.connect() as conn:
+            result = await conn.execute(stmt, params)
+            value = result.scalar()
+        return self.add_pending(value, guild_id, stat, substat, days)
+
+    def add_pending(self, value, guild_id, stat, substat, days):
+        """
+            Add the buffered counts for one substat to a value read from
+            the database, so reads don't have to flush to be current.
+            A read that races a flush can miss the batch being written.
         """
         if guild_id is None:
             guild_id = -1
+        first = None if days is None else self.get_current_day() - days
+        total = 0
+        found = False
+        with self.pending_lock:
+            for (g, s, sub, day), count in self.pending.items():
+                if (g == guild_id and s == stat and sub == substat
+                        and (first is None or day >= first)):
+                    total = total + count
+                    found = True
+        if not found:
+            return value
+        return (value or 0) + total
 
-        with Session(self.bot.engine) as session:
-            if days is None:
-                s = select(StatEntry).where(StatEntry.guild_id == guild_id,
-                                            StatEntry.statname == stat,
-                                            StatEntry.substat == substat)
-                rows = session.execute(s)
-                for r in rows.unique():
-                    return r[0].count
-                # Maybe nothing? Just return then.
-                return None
-
-            # OK, they want days. Use that instead.
-            today = self.get_current_day()
-            s = select(StatsEntry).where(StatsDay.guild_id == guild_id,
-                                         StatsDay.statname == stat,
-                                         StatsDay.substat == substat,
-                                         StatsDay.day_number >= (today-days))
-            count = 0
-            rows = session.execute(s)
-            for r in rows.unique():
-                count = count + r[0].count
-
-            return count
-            
-        # If we didn't find anything then return None
-        return None
+    def get_statement(self, guild_id, stat, substat, days):
+        """
+            The query behind get(), and the parameters to run it with.
+        """
+        if guild_id is None:
+            guild_id = -1
+        params = {"guild_id": guild_id, "stat": stat, "substat": substat}
+
+        if days is None:
+            return self.total_statement, params
+
+        # OK, they want days. Use that instead, summing whichever
+        # rollup buckets cover the window.
+        today = self.get_current_day()
+        plan = self.plan_window(today-days, today, stat)
+        shape = tuple(model for model, column, first, last in plan)
+        stmt = self.window_statements.get(shape)
+        if stmt is None:
+            stmt = self.window_statement(plan)
+            self.window_statements[shape] = stmt
+        return stmt, {**params, **self.plan_params(plan)}
+
+    def window_statement(self, plan):
+        """
+            Build the query that sums one substat over the rollup buckets
+            in a window plan, with the bucket ranges as parameters.
+        """
+        legs = []
+        for n, (model, column, first, last) in enumerate(plan):
+            table = model.__table__
+            legs.append(select(func.sum(table.c["count"]).label("count")).where(
+                table.c.guild_id == bindparam("guild_id"),
+                table.c.statname == bindparam("stat"),
+                table.c.substat == bindparam("substat"),
+                table.c[column.key].between(bindparam(f"first{n}"),
+                                            bindparam(f"last{n}"))))
+        if len(legs) == 1:
+            u = legs[0].subquery()
+        else:
+            u = union_all(*legs).subquery()
+        return select(func.coalesce(func.sum(u.c["count"]), 0))
+
+    def plan_params(self, plan):
+        params = {}
+        for n, (model, column, first, last) in enumerate(plan):
+            params[f"first{n}"] = first
+            params[f"last{n}"] = last
+        return params
 
     def fetch(self, guild_id, stat, count=10, days=7, descending=True, submatch=None):
         """
@@ -121,75 +393,167 @@ class StatsTracker():
           <stat>. If <stat> was "emoji", for example, then this would return
           the most commonly used emoji in the most recent days.
 
-          Returns a dict of substat and count
+          Returns a list of [substat, count] pairs. Counts still in the
+          buffer aren't included, so this can be up to one flush interval
+          behind.
+        """
+        stmt, params = self.fetch_statement(guild_id, stat, count, days,
+                                            descending, submatch)
+        with self.bot.engine.connect() as conn:
+            rows = conn.execute(stmt, params)
+            return [[r[0], r[1]] for r in rows]
+
+    async def fetch_async(self, guild_id, stat, count=10, days=7,
+                          descending=True, submatch=None):
         """
-        ret = []
-        start_day = self.get_current_day()-days
-        like_param = "%"
+            Awaitable version of fetch(), which doesn't block the event loop.
+        """
+        if self.bot.async_engine is None:
+            return await self.bot.run_blocking(self.fetch, guild_id, stat,
+                                               count, days, descending,
+                                               submatch)
+        stmt, params = self.fetch_statement(guild_id, stat, count, days,
+                                            descending, submatch)
+        async with self.bot.async_engine.connect() as conn:
+            rows = await conn.execute(stmt, params)
+            return [[r[0], r[1]] for r in rows]
+
+    def fetch_statement(self, guild_id, stat, count, days, descending,
+                        submatch):
+        """
+            The query behind fetch(), and the parameters to run it with.
+        """
+        today = self.get_current_day()
+        plan = self.plan_window(today-days, today, stat)
+        shape = (tuple(model for model, column, first, last in plan),
+                 descending, submatch is not None)
+        stmt = self.fetch_statements.get(shape)
+        if stmt is None:
+            stmt = self.leaderboard_statement(plan, descending,
+                                              submatch is not None)
+            self.fetch_statements[shape] = stmt
+        params = {"guild_id": guild_id, "stat": stat, "count": count,
+                  **self.plan_params(plan)}
         if submatch is not None:
-            like_param = "%" + submatch + "%"
-        with Session(self.bot.engine) as session:
-            s = None
-            if descending:
-                s = select(StatsDay.substat,
-                           func.sum(StatsDay.count)).group_by(StatsDay.substat).where(StatsDay.guild_id == guild_id, StatsDay.statname == stat, StatsDay.day_number >= start_day, StatsDay.substat.like(like_param)).order_by(func.sum(StatsDay.count).desc()).limit(count)
-            else:
-                s = select(StatsDay.substat,
-                           func.sum(StatsDay.count)).group_by(StatsDay.substat).where(StatsDay.guild_id == guild_id, StatsDay.statname == stat, StatsDay.day_number >= start_day, StatsDay.substat.like(like_param)).order_by(func.sum(StatsDay.count)).limit(count)
-                
-            rows = session.execute(s)
-            for r in rows:
-                ret.append([r[0], r[1]])
-            
-        return ret
+            params["submatch"] = "%" + submatch + "%"
+        return stmt, params
+
+    def leaderboard_statement(self, plan, descending, submatch):
+        """
+            Build the query that finds the top substats over the rollup
+            buckets in a window plan.
+        """
+        legs = []
+        for n, (model, column, first, last) in enumerate(plan):
+            table = model.__table__
+            s = select(table.c.substat, table.c["count"]).where(
+                table.c.guild_id == bindparam("guild_id"),
+                table.c.statname == bindparam("stat"),
+                table.c[column.key].between(bindparam(f"first{n}"),
+                                            bindparam(f"last{n}")))
+            # Only filter on the substat if we were asked to. A LIKE '%'
+            # is still a per-row string match.
+            if submatch:
+                s = s.where(table.c.substat.like(bindparam("submatch")))
+            legs.append(s)
+
+        if len(legs) == 1:
+            # The common case of a short window. Group straight off the
+            # table so the planner can use its index.
+            table = plan[0][0].__table__
+            substat = table.c.substat
+            total = func.sum(table.c["count"])
+            s = legs[0].with_only_columns(substat, total)
+        else:
+            u = union_all(*legs).subquery()
+            substat = u.c.substat
+            total = func.sum(u.c["count"])
+            s = select(substat, total)
+        if descending:
+            order = total.desc()
+        else:
+            order = total
+        return s.group_by(substat).order_by(order).limit(bindparam("count", type_=Integer))
+
+    def plan_window(self, first_day, last_day, stat=None):
+        """
+            Work out which rollup buckets to sum to cover days first_day
+            through last_day. Returns a list of (model, bucket column,
+            first bucket, last bucket), using whole months where they
+            fit, then whole weeks, then single days.
+
+            Any part of the window from before compaction has to come from
+            a coarser table, so it's rounded out to the enclosing week or
+            month and may count a few days more than asked for.
+        """
+        plan = []
+        self.plan_level(first_day, last_day, len(ROLLUPS) - 1,
+                        self.floors_for(stat), plan)
+        return plan
+
+    def floors_for(self, stat):
+        """
+            The first day each rollup level holds rows for, for a stat.
+        """
+        floors = list(self.floors)
+        if stat is not None:
+            floors[0] = max(floors[0], self.stat_floors.get(stat.lower(), 0))
+        return floors
+
+    def plan_level(self, first_day, last_day, level, floors, plan):
+        if first_day > last_day:
+            return
+        floor = floors[level]
+        if first_day < floor:
+            self.plan_round_out(first_day, min(last_day, floor - 1),
+                                level + 1, floors, plan)
+            first_day = floor
+            if first_day > last_day:
+                return
+
+        model, column, days = ROLLUPS[level]
+        first = -(-first_day // days)
+        last = (last_day + 1) // days - 1
+        if first > last:
+            # No whole bucket at this level; try the next finer one.
+            self.plan_level(first_day, last_day, level - 1, floors, plan)
+            return
+        plan.append((model, column, first, last))
+        if level > 0:
+            self.plan_level(first_day, first * days - 1, level - 1, floors,
+                            plan)
+            self.plan_level((last + 1) * days, last_day, level - 1, floors,
+                            plan)
+
+    def plan_round_out(self, first_day, last_day, level, floors, plan):
+        floor = floors[level]
+        if first_day < floor:
+            self.plan_round_out(first_day, min(last_day, floor - 1),
+                                level + 1, floors, plan)
+            first_day = floor
+            if first_day > last_day:
+                return
+        model, column, days = ROLLUPS[level]
+        plan.append((model, column, first_day // days, last_day // days))
 
     def increment(self, guild_id, stat, count=1, substat=""):
         """
             Increment the specified counter. If no count is given then the
             count will be incremented by one.
                                                                         
-            Creates the counter entry if there isn't one already.
+            Creates the counter entry if there isn't one already. The
+            change is buffered and written out on the next flush.
         """
         if guild_id is None:
             guild_id = -1
-            
-        with Session(self.bot.engine) as session:
-            c = None
-            s = select(StatEntry).where(StatEntry.guild_id == guild_id,
-                                        StatEntry.statname == stat,
-                                        StatEntry.substat == substat)
-            rows = session.execute(s)
-            for r in rows.unique():
-                c = r[0]
-                break
-            if c is None:
-                c = StatEntry(guild_id = guild_id,
-                              statname = stat,
-                              substat = substat,
-                              count = 0)
-            c.count = c.count + count
-            c.last_update = datetime.now()
-            session.add(c)
-                
-            doobj = None
-            day = self.get_current_day()
-            s = select(StatsDay).where(StatsDay.guild_id == guild_id,
-                                       StatsDay.statname == stat,
-                                       StatsDay.substat == substat,
-                                       StatsDay.day_number == day)
-            rows = session.execute(s)
-            for r in rows.unique():
-                doobj = r[0]
-                break
-            if doobj is None:
-                doobj = StatsDay(guild_id = guild_id,
-                                 statname = stat,
-                                 substat = substat,
-                                 day_number = day,
-                                 count = 0)
-            doobj.count = doobj.count + count
-            session.add(doobj)
-            session.commit()
+
+        key = (guild_id, stat, substat, self.get_current_day())
+        with self.pending_lock:
+            self.pending[key] = self.pending.get(key, 0) + count
+            pending = len(self.pending)
+
+        if pending >= self.flush_threshold:
+            self.request_flush()
             
     def decrement(self, guild_id, stat, count=1, substat=""):
         """
@@ -198,44 +562,277 @@ class StatsTracker():
 
             Creates the counter entry if there isn't one already.
         """
-        if guild_id is None:
-            guild_id = -1
-            
+        self.increment(guild_id, stat, -count, substat)
+
+    def increment_many(self, deltas):
+        """
+            Apply a batch of counter changes at once. deltas is a list of
+            (guild_id, stat, count) or (guild_id, stat, count, substat)
+            tuples; negative counts decrement.
+
+            The whole batch goes into the buffer under one lock, and is
+            written out with the rest of it as a single executemany on
+            the next flush.
+        """
+        day = self.get_current_day()
+        with self.pending_lock:
+            for delta in deltas:
+                guild_id, stat, count = delta[0], delta[1], delta[2]
+                substat = delta[3] if len(delta) > 3 else ""
+                if guild_id is None:
+                    guild_id = -1
+                key = (guild_id, stat, substat, day)
+                self.pending[key] = self.pending.get(key, 0) + count
+            pending = len(self.pending)
+
+        if pending >= self.flush_threshold:
+            self.request_flush()
+
+    def request_flush(self):
+        """
+            Ask for the buffer to be flushed soon. If the scheduler's
+            running the flush goes to it so we don't do database work
+            on the caller's thread, otherwise we just do it now.
+        """
+        if self.bot.sched.running:
+            self.bot.sched.add_job(self.flush, id="stats:flush_now",
+                                   executor="threadpool",
+                                   replace_existing=True)
+        else:
+            self.flush()
+
+    def flush(self):
+        """
+            Write all buffered counter changes to the database in a
+            single transaction. Safe to call from any thread.
+
+            Returns the number of buffered counters written.
+        """
+        pending = self.take_pending()
+        if not pending:
+            return 0
+
+        try:
+            with self.bot.engine.begin() as conn:
+                for stmt, params in self.flush_statements(pending):
+                    conn.execute(stmt, params)
+        except Exception:
+            self.restore_pending(pending)
+            raise
+
+        logger.debug(f"Flushed {len(pending)} buffered stat counters")
+        return len(pending)
+
+    async def flush_async(self):
+        """
+            Awaitable version of flush(), which doesn't block the event loop.
+        """
+        if self.bot.async_engine is None:
+            return await self.bot.run_blocking(self.flush)
+
+        pending = self.take_pending()
+        if not pending:
+            return 0
+
+        try:
+            async with self.bot.async_engine.begin() as conn:
+                for stmt, params in self.flush_statements(pending):
+                    await conn.execute(stmt, params)
+        except Exception:
+            self.restore_pending(pending)
+            raise
+
+        logger.debug(f"Flushed {len(pending)} buffered stat counters")
+        return len(pending)
+
+    def take_pending(self):
+        """
+            Grab everything in the buffer, leaving it empty.
+        """
+        with self.pending_lock:
+            pending = self.pending
+            self.pending = {}
+        return pending
+
+    def restore_pending(self, pending):
+        """
+            Put deltas from a failed flush back so they go out with the
+            next one rather than vanishing.
+        """
+        with self.pending_lock:
+            for key, count in pending.items():
+                self.pending[key] = self.pending.get(key, 0) + count
+
+    def flush_statements(self, pending):
+        """
+            Build the (statement, parameter list) pairs that write a batch
+            of buffered deltas out.
+        """
+        # Collapse the per-day deltas down to the all-time totals too.
+        totals = {}
+        for (guild_id, stat, substat, day), count in pending.items():
+            key = (guild_id, stat, substat)
+            totals[key] = totals.get(key, 0) + count
+
+        now = datetime.now()
+        ret = [(self.totals_upsert,
+                [{"guild_id": guild_id, "statname": stat,
+                  "substat": substat, "count": count, "last_update": now}
+                 for (guild_id, stat, substat), count in totals.items()])]
+
+        # And the per-day counts, plus the weekly and monthly rollups.
+        for (model, column, days), stmt in zip(ROLLUPS, self.rollup_upserts):
+            buckets = {}
+            for (guild_id, stat, substat, day), count in pending.items():
+                key = (guild_id, stat, substat, day // days)
+                buckets[key] = buckets.get(key, 0) + count
+            ret.append((stmt,
+                        [{"guild_id": guild_id, "statname": stat,
+                          "substat": substat, column.key: bucket,
+                          "count": count}
+                         for (guild_id, stat, substat, bucket), count
+                         in buckets.items()]))
+        return ret
+
+    def compact(self):
+        """
+            The nightly retention run. Drops per-day rows older than
+            stats:keep_days days and per-week rows older than
+            stats:keep_weeks weeks, now that the coarser rollups cover
+            them, then applies any per-stat retention policies and gives
+            the space back to the filesystem. Monthly rows are kept unless
+            a policy says otherwise.
+
+            Returns (and logs) a report of rows removed and time taken.
+        """
+        start = time.perf_counter()
+        config = self.bot.config
+        keep_days = int(config.get(-1, KEEP_DAYS_SETTING, KEEP_DAYS_DEFAULT))
+        keep_weeks = int(config.get(-1, KEEP_WEEKS_SETTING,
+                                    KEEP_WEEKS_DEFAULT))
+        today = self.get_current_day()
+        # Round down to the start of the next coarser bucket, so we never
+        # leave a bucket half in one table and half in another.
+        day_floor = max(self.floors[0], (today - keep_days) // 7 * 7)
+        week_floor = max(self.floors[1], (today - keep_weeks * 7) // 28 * 28)
+
+        # Everything has to be in the rollups before we throw days away.
+        self.flush()
+        policies = self.retention_policies()
+
+        # Move the floors up first, and wait for any other processes to
+        # pick them up, so nobody goes looking for rows that are about to
+        # go. If some don't in time (wait_for_peers logs which), we go
+        # ahead anyway; a process that's down isn't reading anything.
+        floors = {DAY_FLOOR_SETTING: str(day_floor),
+                  WEEK_FLOOR_SETTING: str(week_floor)}
+        self.floors = [day_floor, week_floor, 0]
+        stat_floors = {}
+        for stat, (mode, days) in policies.items():
+            if mode == "downsample":
+                floor = max(self.stat_floors.get(stat.lower(), 0),
+                            (today - days) // 7 * 7)
+                stat_floors[stat] = floor
+                self.stat_floors[stat.lower()] = floor
+                floors[STAT_FLOOR_PREFIX + stat] = str(floor)
+        config.set_many(-1, floors)
+        config.wait_for_peers()
+
+        report = {"daily": 0, "weekly": 0, "monthly": 0}
+        report["daily"] += self.delete_batched(
+            StatsDay, StatsDay.day_number < day_floor)
+        report["weekly"] += self.delete_batched(
+            StatsWeek, StatsWeek.week_number < week_floor // 7)
+
+        for stat, (mode, days) in policies.items():
+            cutoff = today - days
+            if mode == "downsample":
+                report["daily"] += self.delete_batched(
+                    StatsDay, StatsDay.statname == stat,
+                    StatsDay.day_number < stat_floors[stat])
+            else:
+                # Only buckets that are entirely past the cutoff go.
+                for (model, column, width), name in zip(ROLLUPS,
+                                                        ("daily", "weekly",
+                                                         "monthly")):
+                    report[name] += self.delete_batched(
+                        model, model.statname == stat,
+                        column < cutoff // width)
+
+        report.update(self.vacuum())
+        report["seconds"] = time.perf_counter() - start
+        self.last_compaction = report
+        logger.info("Stats retention: removed {daily} daily, {weekly} weekly, "
+                    "{monthly} monthly rows, freed {freed_bytes:,} bytes "
+                    "in {seconds:.2f}s".format(**report))
+        return report
+
+    def retention_policies(self):
+        """
+            Returns the per-stat retention policies as a dict of
+            statname -> (mode, days), for stats that exist.
+        """
+        settings = self.bot.config.get_guild(-1)
+        policies = {}
         with Session(self.bot.engine) as session:
-            c = None
-            s = select(StatEntry).where(StatEntry.guild_id == guild_id,
-                                        StatEntry.statname == stat,
-                                        StatEntry.substat == substat)
-            rows = session.execute(s)
-            for r in rows.unique():
-                c = r[0]
-                break
-            if c is None:
-                c = StatEntry(guild_id = guild_id,
-                              statname = stat,
-                              substat = substat,
-                              count = 0)
-            c.count = c.count - count
-            c.last_update = datetime.now()
-            session.add(c)
-            
-            doobj = None
-            day = self.get_current_day()
-            s = select(StatsDay).where(StatsDay.guild_id == guild_id,
-                                       StatsDay.statname == stat,
-                                       StatsDay.substat == substat,
-                                       StatsDay.day_number == day)
-            rows = session.execute(s)
-            for r in rows.unique():
-                do = r[0]
-                break
-            if doobj is None:
-                doobj = StatsDay(guild_id = guild_id,
-                                 statname = stat,
-                                 substat = substat,
-                                 day_number = day,
-                                 count = 0)
-            doobj.count = doobj.count + count
-            session.add(doobj)
-            session.commit()
-            
+            stats = [r[0] for r in
+                     session.execute(select(StatEntry.statname).distinct())]
+        for stat in stats:
+            value = settings.get(RETENTION_PREFIX + stat.lower())
+            if not value:
+                continue
+            mode, _, days = value.rpartition(":")
+            mode = mode or "delete"
+            if mode not in ("delete", "downsample") or not days.isdigit():
+                logger.warning(f"Bad retention policy for {stat}: {value}")
+                continue
+            policies[stat] = (mode, int(days))
+        return policies
+
+    def delete_batched(self, model, *where):
+        """
+            Delete the rows of model matching where, a batch at a time,
+            committing between batches so other writers get a look in.
+            Returns the number of rows deleted.
+        """
+        batch = int(self.bot.config.get(-1, RETENTION_BATCH_SETTING,
+                                        RETENTION_BATCH_DEFAULT))
+        # Bounded deletes need SQLite's rowid; elsewhere do it in one go.
+        sqlite = self.bot.engine.dialect.name == "sqlite"
+        if sqlite:
+            rowid = literal_column("rowid")
+            s = delete(model).where(rowid.in_(
+                select(rowid).select_from(model).where(*where).limit(batch)))
+        else:
+            s = delete(model).where(*where)
+
+        total = 0
+        while True:
+            with Session(self.bot.engine) as session:
+                deleted = session.execute(s).rowcount
+                session.commit()
+            total = total + deleted
+            if not sqlite or deleted < batch:
+                return total
+            time.sleep(RETENTION_PAUSE)
+
+    def vacuum(self):
+        """
+            Hand free pages back to the filesystem and truncate the WAL.
+            Returns how many bytes were freed.
+        """
+        if self.bot.engine.dialect.name != "sqlite":
+            return {"freed_bytes": 0}
+        engine = self.bot.engine.execution_options(isolation_level="AUTOCOMMIT")
+        with engine.connect() as conn:
+            page_size = conn.exec_driver_sql("pragma page_size").scalar()
+            before = conn.exec_driver_sql("pragma freelist_count").scalar()
+            # incremental_vacuum frees a page per step and returns no
+            # rows, so executing it through a cursor stops after one page
+            # (and fetching from it raises). executescript steps it until
+            # it's done.
+            conn.connection.driver_connection.executescript(
+                "pragma incremental_vacuum;")
+            after = conn.exec_driver_sql("pragma freelist_count").scalar()
+            conn.exec_driver_sql("pragma wal_checkpoint(TRUNCATE)").fetchall()
+        return {"freed_bytes": (before - after) * page_size}
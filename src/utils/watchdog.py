@@ -0,0 +1,130 @@
+# Event loop lag monitoring and stall detection.
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+
+from collections import Counter, deque
+
+from src.logging import logger
+from src.utils.metrics import percentile, registry
+
+class LoopWatchdog:
+    """
+       Keeps an eye on the event loop. A heartbeat coroutine wakes up every
+       interval and notes how late it was, which gives us a running lag
+       figure. Meanwhile a sampling thread watches the heartbeat, and if
+       the loop has been stuck for longer than the threshold it grabs the
+       loop thread's stack, repeatedly, until the loop comes back. Then
+       it logs an incident saying how long the stall was and where the
+       loop was stuck most of that time.
+
+       LOOP_LAG_THRESHOLD (seconds, default 0.25) sets what counts as a
+       stall. The same value is used as asyncio's slow callback
+       threshold, which it reports on if the loop is in debug mode
+       (PYTHONASYNCIODEBUG=1).
+    """
+    def __init__(self, interval=0.1, threshold=None, history=600):
+        self.interval = interval
+        if threshold is None:
+            threshold = float(os.getenv("LOOP_LAG_THRESHOLD", "0.25"))
+        self.threshold = threshold
+        self.lags = deque(maxlen=history)
+        self.incidents = deque(maxlen=50)
+        self.last_tick = time.monotonic()
+        self.stall = None
+        self.loop_thread = None
+        self.task = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+        self.lag_gauge = registry.gauge("bot_event_loop_lag_seconds",
+                                        "How late the event loop last ran a timer")
+        self.stall_count = registry.counter("bot_event_loop_stalls_total",
+                                            "Times the event loop was blocked past the threshold")
+
+    def start(self):
+        """
+           Start watching. Has to be called from the event loop's thread.
+        """
+        if self.task is not None:
+            return
+        loop = asyncio.get_running_loop()
+        loop.slow_callback_duration = self.threshold
+        self.loop_thread = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.stop_event.clear()
+        self.task = loop.create_task(self.heartbeat())
+        self.thread = threading.Thread(target=self.sample, name="loop-watchdog",
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def heartbeat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            self.last_tick = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.lags.append(lag)
+            self.lag_gauge.set(lag)
+
+    def sample(self):
+        while not self.stop_event.wait(self.interval / 2):
+            stalled = time.monotonic() - self.last_tick - self.interval
+            if stalled >= self.threshold:
+                if self.stall is None:
+                    self.stall = {"start": self.last_tick + self.interval,
+                                  "wall_start": time.time() - stalled,
+                                  "stacks": Counter()}
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is not None:
+                    stack = tuple((f.filename, f.lineno, f.name)
+                                  for f in traceback.extract_stack(frame))
+                    self.stall["stacks"][stack] += 1
+            elif self.stall is not None:
+                self.finish_stall()
+
+    def finish_stall(self):
+        stall = self.stall
+        self.stall = None
+        duration = time.monotonic() - stall["start"]
+        stack = ()
+        if stall["stacks"]:
+            stack = stall["stacks"].most_common(1)[0][0]
+        incident = {"when": stall["wall_start"],
+                    "duration": duration,
+                    "where": self.where(stack),
+                    "samples": sum(stall["stacks"].values()),
+                    "stack": [f"{filename}:{lineno} in {name}"
+                              for filename, lineno, name in stack]}
+        self.incidents.append(incident)
+        self.stall_count.inc()
+        logger.warning(f"event_loop_stall duration_ms={duration * 1000:.0f} where={incident['where']} samples={incident['samples']}")
+        logger.debug("event_loop_stall stack:\n" + "\n".join(incident["stack"]))
+
+    def where(self, stack):
+        """
+           Pick the frame to blame: the innermost one in our own code if
+           there is one, otherwise the innermost one.
+        """
+        if not stack:
+            return "unknown"
+        ours = [f for f in stack if os.sep + "src" + os.sep in f[0]]
+        filename, lineno, name = (ours or stack)[-1]
+        return f"{filename}:{lineno} in {name}"
+
+    def percentiles(self):
+        ordered = sorted(self.lags)
+        return {"p50": percentile(ordered, 0.50),
+                "p95": percentile(ordered, 0.95),
+                "p99": percentile(ordered, 0.99),
+                "max": ordered[-1] if ordered else 0.0}